@@ -0,0 +1,235 @@
+"""
+analysis_pipeline.py
+====================================
+This module runs the stages of a replay analysis as a DAG. A stage starts as soon as the stages
+it depends on completed, so the UNLOADs of the system tables run concurrently over a small pool
+of connections, and the report is generated as soon as the data it's built from was read, while
+the remaining UNLOADs still run. Each completed stage is checkpointed to the analysis prefix in
+S3, so an analysis that failed part way is resumed after the stages that already completed,
+instead of starting over.
+"""
+
+import datetime
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger("SimpleReplayLogger")
+
+# object holding the checkpoints of an analysis, in the analysis prefix of the replay
+CHECKPOINT_FILE = "checkpoints.json"
+
+
+class Stage:
+    """
+    Step of an analysis
+    :param name: unique name of the stage
+    :param run: function called without arguments to run the stage
+    :param depends_on: names of the stages that must complete before this one starts
+    :param checkpoint: whether the completion of the stage is checkpointed, and the stage skipped
+    when the analysis is resumed. Stages whose output only lives in memory, like the data read into
+    the report, aren't checkpointed, and run again if a stage that needs them still has to run
+    """
+
+    def __init__(self, name, run, depends_on=(), checkpoint=True):
+        self.name = name
+        self.run = run
+        self.depends_on = list(depends_on)
+        self.checkpoint = checkpoint
+
+
+class Checkpoints:
+    """
+    Completed stages of an analysis, kept in a JSON object in S3 along with the arguments of the
+    analysis, so it can be resumed from the command line
+    :param bucket_name: bucket of the analysis output
+    :param key: key of the checkpoint object
+    """
+
+    def __init__(self, bucket_name, key):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.s3_client = boto3.client("s3")
+        self.state = {"arguments": None, "stages": {}}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read the checkpoints of a previous run of the analysis, if there was one"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return self
+            raise e
+        self.state = json.loads(response["Body"].read().decode("utf-8"))
+        self.state.setdefault("stages", {})
+        return self
+
+    @property
+    def arguments(self):
+        return self.state.get("arguments")
+
+    def save_arguments(self, arguments):
+        with self.lock:
+            self.state["arguments"] = arguments
+            self._save()
+
+    def completed(self, name):
+        return name in self.state["stages"]
+
+    def mark_completed(self, name):
+        with self.lock:
+            self.state["stages"][name] = datetime.datetime.now(tz=datetime.timezone.utc).isoformat(
+                timespec="seconds"
+            )
+            self._save()
+
+    def _save(self):
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            Body=json.dumps(self.state, indent=4, default=str),
+        )
+
+
+class UnloadConnectionPool:
+    """
+    Up to size connections the UNLOADs of an analysis run over, opened on demand, each used by one
+    stage at a time. Unlike connection_pool.ConnectionPool of the replay, connections aren't reset
+    or keyed by user, as all UNLOADs run as the same user
+    :param connect: function returning a context manager that opens a connection
+    :param size: maximum number of open connections
+    """
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.idle = queue.Queue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        # connections are opened one at a time, as opening one creates boto3 clients on the default
+        # session to get cluster credentials, and boto3 sessions aren't thread safe
+        self.open_lock = threading.Lock()
+        self.exit_stack = ExitStack()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def _acquire(self):
+        while True:
+            with self.lock:
+                try:
+                    return self.idle.get_nowait()
+                except queue.Empty:
+                    pass
+                open_new = self.opened < self.size
+                if open_new:
+                    self.opened += 1
+            if open_new:
+                return self._open()
+            # connections that fail to open free their slot, so waiting stages check again
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def _open(self):
+        try:
+            with self.open_lock:
+                manager = self.connect()
+                conn = manager.__enter__()
+        except BaseException:
+            with self.lock:
+                self.opened -= 1
+            raise
+        with self.lock:
+            self.exit_stack.push(manager)
+        return conn
+
+    def close(self):
+        with self.lock:
+            self.exit_stack.close()
+
+
+def run_pipeline(stages, checkpoints, max_workers=4):
+    """
+    Run the stages of an analysis, each one as soon as the stages it depends on completed.
+    Checkpointed stages that completed in a previous run are skipped. When a stage fails, the
+    stages that depend on it are skipped, while the others still run and are checkpointed
+    :param stages: list of Stage
+    :param checkpoints: Checkpoints of the analysis
+    :param max_workers: number of stages run at once
+    :return: names of the stages that failed or were skipped because of a failure
+    """
+    by_name = {stage.name: stage for stage in stages}
+    done = {stage.name for stage in stages if stage.checkpoint and checkpoints.completed(stage.name)}
+    for name in sorted(done):
+        logger.debug(f"Analysis stage {name} completed in a previous run, skipping it")
+
+    pending = _needed_stages(stages, done)
+    failed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                stage = by_name[name]
+                if any(dependency in failed for dependency in stage.depends_on):
+                    logger.warning(f"Skipping analysis stage {name}, a stage it depends on failed")
+                    failed.add(name)
+                    pending.discard(name)
+                elif all(dependency in done for dependency in stage.depends_on):
+                    logger.debug(f"Starting analysis stage {name}")
+                    running[executor.submit(stage.run)] = stage
+                    pending.discard(name)
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Analysis stages {sorted(pending)} depend on unknown stages or on each other")
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                # stages may exit() on errors, so SystemExit is a failure like any exception
+                error = future.exception()
+                if error is not None:
+                    logger.error(f"Analysis stage {stage.name} failed. {error}")
+                    failed.add(stage.name)
+                    continue
+                if stage.checkpoint:
+                    checkpoints.mark_completed(stage.name)
+                done.add(stage.name)
+
+    return sorted(failed)
+
+
+def _needed_stages(stages, done):
+    """Names of the stages to run: all checkpointed stages not done yet, the stages nothing
+    depends on, and the stages they depend on, directly or not, that aren't done"""
+    by_name = {stage.name: stage for stage in stages}
+    dependents = {dependency for stage in stages for dependency in stage.depends_on}
+    needed = set()
+    to_visit = [
+        stage.name
+        for stage in stages
+        if stage.name not in done and (stage.checkpoint or stage.name not in dependents)
+    ]
+    while to_visit:
+        name = to_visit.pop()
+        if name in needed or name in done:
+            continue
+        needed.add(name)
+        to_visit.extend(dependency for dependency in by_name[name].depends_on if dependency in by_name)
+    return needed
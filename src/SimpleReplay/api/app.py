@@ -1,3 +1,5 @@
+import os
+import sys
 from string import ascii_uppercase
 
 import numpy as np
@@ -5,6 +7,12 @@ import pandas as pd
 from flask import *
 from pandas.errors import EmptyDataError
 
+from replay_cache import ReplayDataLoader, cache_from_environment
+from rollups import QueryRollups, paginate
+
+# modules shared with replay analysis are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from query_fingerprint import FINGERPRINT_INDEX_FILE, compare_fingerprints, fingerprint_index
 from utils import *
 from utils import remove_comments
 
@@ -16,6 +24,9 @@ selected_replays = None         # List of dictionaries, each replay dict = repla
 selected_query_data = None      # Pandas dataframe, with sysqueryhistory data compiled from each selected replay
 selected_error_data = None      # Pandas dataframe, with replayerrors data compiled from each selected replay
 selected_copy_data = None       # df with sysloadhistory data joined with sysqueryhistory from each selected replay
+selected_rollups = None         # QueryRollups of selected_query_data, built on first use
+selected_fingerprints = None    # dict of sid to the fingerprint index of each selected replay and its ETag
+selected_fingerprint_diffs = {} # (baseline sid, target sid) -> diff of fingerprint indexes built from query history
 
 
 @app.after_request
@@ -28,6 +39,48 @@ def after_request(response):
     return response
 
 
+def parse_replay_data(body, replay, filename):
+    """Parses the unloaded sys view data of one replay, as cached by replay_cache
+    @param body: file-like CSV content of the S3 object
+    @param replay: dict, replay/info.json of the replay
+    @param filename: str, filename of unloaded sys view data in S3
+    """
+    temp = pd.read_csv(body)
+    # missing text is filled with "" rather than 0, so text columns keep a single type and the
+    # frame can be cached as parquet
+    text_columns = temp.select_dtypes(include=['object', 'string']).columns
+    temp = temp.fillna({column: "" for column in text_columns}).fillna(0)
+
+    # calculate relative execution timestamp to replay start for server side filtering, in milliseconds
+    if {'start_time', 'end_time'}.issubset(temp.columns):
+        temp["start_diff"] = calc_diff_series(replay['start_time'], temp['start_time'])
+        temp["end_diff"] = calc_diff_series(replay['start_time'], temp['end_time'])
+    elif {'timestamp'}.issubset(temp.columns):
+        temp["time_diff"] = calc_diff_series(replay['start_time'], temp['timestamp'])
+
+    for i in ['elapsed_time', 'queue_time', 'execution_time']:    # convert microseconds to milliseconds
+        if {i}.issubset(temp.columns):
+            temp[i] = temp[i] / 1000
+
+    if {'query_text'}.issubset(temp.columns):
+        if "query" in filename:     # filter out non-replay executed statements
+            temp = temp[temp['query_text'].str.contains("replay_start")]
+        temp['query_hash'] = hash_query_series(temp['query_text'])
+        temp['query_text'] = remove_comments_series(temp['query_text'])
+
+    return temp.reset_index(drop=True)
+
+
+def parse_fingerprint_index(body, replay, filename):
+    """Parses the fingerprint index written by replay analysis, as cached by replay_cache"""
+    return pd.read_csv(body, dtype={'fingerprint': np.int64})
+
+
+# parsed data of each replay, kept across analysis sessions
+replay_data_loader = ReplayDataLoader(parse_replay_data, cache_from_environment())
+fingerprint_loader = ReplayDataLoader(parse_fingerprint_index, replay_data_loader.cache, folder="aggregated_data")
+
+
 def request_s3_data(filename):
     """Iterates through selected replays to compile data results of given file in one data frame
     Analysis uses replayerrors000, sys_query_history000, and sys_load_history000 as of 08/08/22
@@ -35,51 +88,73 @@ def request_s3_data(filename):
     """
 
     global boto3_session
-    s3_client = boto3_session.client('s3')
 
     global selected_replays
     if not selected_replays:
         return None
 
-    df = pd.DataFrame()
+    # cached frames are shared between requests, so the short ids are added to copies
+    frames = replay_data_loader.load(boto3_session, selected_replays, filename)
+    df = pd.concat([temp.assign(sid=replay['sid'])     # associate short id with entries in df
+                    for replay, temp in zip(selected_replays, frames)], ignore_index=True)
 
-    for replay in selected_replays:
-        temp = None     # temporary df for individual replay
-        try:
-            response = s3_client.get_object(Bucket=replay['bucket'],
-                                            Key=f"analysis/{replay['replay_id']}/raw_data/{filename}")
-            temp = pd.read_csv(response.get("Body")).fillna(0)
-        except Exception as e:
-            temp = pd.DataFrame()
-
-        temp['sid'] = replay['sid']     # associate short id with entries in df
-
-        # calculate relative execution timestamp to replay start for server side filtering, in milliseconds
-        if {'start_time', 'end_time'}.issubset(temp.columns):
-            temp["start_diff"] = temp['start_time'].apply(lambda x: calc_diff(replay['start_time'], x)).astype(np.int64)
-            temp["end_diff"] = temp['end_time'].apply(lambda x: calc_diff(replay['start_time'], x)).astype(np.int64)
-        elif {'timestamp'}.issubset(temp.columns):
-            temp["time_diff"] = temp['timestamp'].apply(lambda x: calc_diff(replay['start_time'], x)).astype(np.int64)
+    if "load" in filename and selected_query_data is not None:
+        df = pd.merge(left=df, right=selected_query_data, on=['query_id', 'sid'], how='inner')
 
-        df = pd.concat([df, temp], ignore_index=True)
+    return df
 
-    for i in ['elapsed_time', 'queue_time', 'execution_time']:    # convert microseconds to milliseconds
-        if {i}.issubset(df.columns):
-            df[i] = df[i].apply(lambda x: x / 1000)
 
-    if {'query_text'}.issubset(df.columns):
-        if "query" in filename:     # filter out non-replay executed statements
-            df = df[df['query_text'].str.contains("replay_start")]
-        df['query_hash'] = df['query_text'].apply(lambda x: hash_query(x))
-        df['query_text'] = df['query_text'].apply(lambda x: remove_comments(x))
+def query_rollups():
+    """Rollups of the query data of the selected replays, downloading the data if needed. The
+    rollups are built again whenever the query data changes
+    """
+    global selected_query_data
+    global selected_rollups
 
-    if "load" in filename and selected_query_data is not None:
-        df = pd.merge(left=df, right=selected_query_data, on=['query_id', 'sid'], how='inner')
+    if selected_query_data is None:
+        selected_query_data = request_s3_data("sys_query_history000")
+    if selected_rollups is None or selected_rollups.query_data is not selected_query_data:
+        selected_rollups = QueryRollups(selected_query_data)
+    return selected_rollups
 
-    # export df to csv locally for debugging
-    df.to_csv(f"{filename}.csv")
 
-    return df
+def fingerprint_indexes():
+    """Fingerprint index of each selected replay, by sid, with the ETag of the index in S3. Replays
+    analyzed without an index get one built from their query history, with an ETag of None
+    """
+    global selected_fingerprints
+
+    if selected_fingerprints is None:
+        indexes = fingerprint_loader.load_with_etags(boto3_session, selected_replays, FINGERPRINT_INDEX_FILE)
+        rollups = None
+        selected_fingerprints = {}
+        for replay, (index, etag) in zip(selected_replays, indexes):
+            if 'fingerprint' not in index.columns:
+                rollups = rollups or query_rollups()
+                data = rollups.replay_data(replay['sid'])
+                if {'query_text', 'elapsed_time', 'execution_time'}.issubset(data.columns):
+                    index = fingerprint_index(data['query_text'], data['elapsed_time'], data['execution_time'])
+                else:
+                    index = fingerprint_index(pd.Series([], dtype=object), pd.Series([], dtype=float),
+                                              pd.Series([], dtype=float))
+            selected_fingerprints[replay['sid']] = (index, etag)
+    return selected_fingerprints
+
+
+def page_args():
+    """offset and limit of the page requested, from the offset and limit arguments. Without a limit
+    argument, all rows from offset are returned"""
+    offset = max(int(request.args.get('offset', 0)), 0)
+    limit = request.args.get('limit')
+    return offset, None if limit is None else max(int(limit), 0)
+
+
+def page_response(page, total, offset, limit):
+    return jsonify({"success": True,
+                    "data": json.loads(page.to_json(orient="records")),
+                    "total": total,
+                    "offset": offset,
+                    "limit": limit}), 201
 
 
 @app.route('/getprofile')
@@ -89,10 +164,18 @@ def profiles():
     global boto3_session
     global selected_query_data
     global selected_error_data
+    global selected_copy_data
+    global selected_rollups
+    global selected_fingerprints
+    global selected_fingerprint_diffs
     boto3_session = None
     selected_replays = None
     selected_query_data = None
     selected_error_data = None
+    selected_copy_data = None
+    selected_rollups = None
+    selected_fingerprints = None
+    selected_fingerprint_diffs = {}
 
     profile_session = boto3.Session()
     return jsonify({"success": True, "profiles": profile_session.available_profiles}), 201
@@ -148,12 +231,25 @@ def search_s3():
 @app.route('/submit_replays', methods=['GET', 'POST'])
 def replays():
     global selected_replays
+    global selected_query_data
+    global selected_error_data
+    global selected_copy_data
+    global selected_rollups
+    global selected_fingerprints
+    global selected_fingerprint_diffs
 
     if request.method == 'POST':
         if len(request.json) == 0:
             return jsonify({"success": True, "message": "No replays selected."}), 400
         # request.json is a list of dicts
         selected_replays = request.json
+        # data and rollups of the previous selection are loaded again, from the replay cache
+        selected_query_data = None
+        selected_error_data = None
+        selected_copy_data = None
+        selected_rollups = None
+        selected_fingerprints = None
+        selected_fingerprint_diffs = {}
         return jsonify({"success": True, "message": "Replays saved."}), 201
 
     if request.method == 'GET':
@@ -191,13 +287,10 @@ def time_range():
 @app.route('/compare_throughput')
 def compare_throughput():
     global selected_replays
-    global selected_query_data
-    global boto3_session
 
     if not selected_replays:
         return jsonify({"success": False}), 400
-    if selected_query_data is None:
-        selected_query_data = request_s3_data("sys_query_history000")
+    rollups = query_rollups()
 
     q_types = [d['label'] for d in json.loads(request.args.get('qtype'))]
     users = [d['label'] for d in json.loads(request.args.get('user'))]
@@ -206,14 +299,8 @@ def compare_throughput():
     replay_throughput = []
 
     for replay in selected_replays:
-
-        replay_data = filter_data(selected_query_data, replay, q_types, users)
-
-        replay_data["time"] = replay_data['end_diff'].apply(lambda x: 1000*int(x/1000))
-        if not replay_data.empty:
-            data = {'rel_time': replay_data.groupby(by="time").size().index,
-                    'freq': replay_data.groupby(by="time").size().values}
-            tp = pd.DataFrame(data)
+        tp = rollups.throughput(replay['sid'], users, q_types)
+        if not tp.empty:
             replay_throughput.append({'replay': replay['sid'], 'values': json.loads(tp.to_json(orient="records"))})
 
     return jsonify({"success": True,
@@ -223,30 +310,40 @@ def compare_throughput():
 
 @app.route('/agg_metrics')
 def agg_metrics():
-    global selected_query_data
     global selected_replays
 
     q_types = [d['label'] for d in json.loads(request.args.get('qtype'))]
     users = [d['label'] for d in json.loads(request.args.get('user'))]
     duration = [int(request.args.get('start')),int(request.args.get('end'))]
 
-    if selected_query_data is None:
-        selected_query_data = request_s3_data("sys_query_history000")
+    rollups = query_rollups()
 
-    metrics = pd.DataFrame(columns=['sid', 'p25', 'p50', 'p75', 'p99', 'avg', 'std'])
+    metrics = []
 
     for replay in selected_replays:
-        replay_data = filter_data(selected_query_data, replay, q_types, users, duration)
-        entry = {'sid': replay['sid'],
-                 'p25': replay_data['execution_time'].quantile(q=0.25),
-                 'p50': replay_data['execution_time'].quantile(q=0.50),
-                 'p75': replay_data['execution_time'].quantile(q=0.75),
-                 'p99': replay_data['execution_time'].quantile(q=0.99),
-                 'avg': replay_data['execution_time'].mean(),
-                 'std': replay_data['execution_time'].std()}
-
-        metrics = metrics.append(entry, ignore_index=True)
-
+        if rollups.covers(replay['sid'], duration):
+            # the time frame keeps all queries of the replay, so the latency sketch can answer
+            sketch = rollups.latency(replay['sid'], 'execution_time', users, q_types)
+            entry = {'sid': replay['sid'],
+                     'p25': sketch.quantile(0.25),
+                     'p50': sketch.quantile(0.50),
+                     'p75': sketch.quantile(0.75),
+                     'p99': sketch.quantile(0.99),
+                     'avg': sketch.mean,
+                     'std': sketch.std()}
+        else:
+            replay_data = filter_data(rollups.replay_data(replay['sid']), replay, q_types, users, duration)
+            entry = {'sid': replay['sid'],
+                     'p25': replay_data['execution_time'].quantile(q=0.25),
+                     'p50': replay_data['execution_time'].quantile(q=0.50),
+                     'p75': replay_data['execution_time'].quantile(q=0.75),
+                     'p99': replay_data['execution_time'].quantile(q=0.99),
+                     'avg': replay_data['execution_time'].mean(),
+                     'std': replay_data['execution_time'].std()}
+
+        metrics.append(entry)
+
+    metrics = pd.DataFrame(metrics, columns=['sid', 'p25', 'p50', 'p75', 'p99', 'avg', 'std'])
     return jsonify({"success": True, "data": json.loads(metrics.to_json(orient="records"))}), 201
 
 
@@ -256,18 +353,14 @@ def query_latency():
     users = [d['label'] for d in json.loads(request.args.get('user'))]
     # duration = [int(request.args.get('start')), int(request.args.get('end'))]
 
-    global selected_query_data
     global selected_replays
 
-    if selected_query_data is None:
-        selected_query_data = request_s3_data("sys_query_history000")
+    rollups = query_rollups()
 
     all_bins = []
     all_hist = []
-    df = None
     for replay in selected_replays:
-        df = filter_data(selected_query_data, replay, q_types, users)
-        hist, bins = np.histogram(a=df['elapsed_time'].to_numpy(), bins=3)
+        hist, bins = rollups.latency(replay['sid'], 'elapsed_time', users, q_types).histogram(bins=3)
         all_bins.append(bins)
         all_hist.append({"replay": replay['sid'], "counts": hist})
 
@@ -284,44 +377,76 @@ def query_latency():
 
 @app.route('/top_queries')
 def top_queries():
-    global selected_query_data
-
-    if selected_query_data is not None:
-        selected_query_data = selected_query_data.sort_values(by="elapsed_time", ascending=False)
-        return jsonify({"success": True, "data": json.loads(selected_query_data.to_json(orient="records"))}), 201
-
-    df = request_s3_data("sys_query_history000")
-
-    if df is not None:
-        df = df.sort_values(by="elapsed_time", ascending=False)
+    """Queries of all selected replays, longest elapsed time first, optionally paginated by the
+    offset and limit arguments
+    """
+    global selected_replays
 
-        return jsonify({"success": True, "data": json.loads(df.to_json(orient="records"))}), 201
+    if not selected_replays:
+        return jsonify({"success": False}), 400
 
-    return jsonify({"success": False}), 400
+    offset, limit = page_args()
+    page, total = query_rollups().top_queries(offset, limit)
+    return page_response(page, total, offset, limit)
 
 
 @app.route('/perf_diff')
 def perf_diff():
+    """Queries replayed in both baseline and target, with their times summed over the statements
+    of each query, largest elapsed time change first, optionally paginated by the offset and
+    limit arguments
+    """
+    global selected_replays
+
+    if not selected_replays:
+        return jsonify({"success": False}), 400
+
     baseline = request.args.get('baseline')
     target = request.args.get('target')
 
-    global selected_query_data
-    if selected_query_data is None:
-        selected_query_data = request_s3_data("sys_query_history000")
+    offset, limit = page_args()
+    page, total = query_rollups().perf_diff(baseline, target, offset, limit)
+    return page_response(page, total, offset, limit)
 
 
-    baseline_data = selected_query_data.loc[selected_query_data['sid'] == baseline]
-    baseline_data = baseline_data[baseline_data['query_hash'] != 0]
-    target_data = selected_query_data.loc[selected_query_data['sid'] == target]
-    target_data = target_data[target_data['query_hash'] != 0]
-
-    df = pd.merge(left=baseline_data, right=target_data, on='query_hash', how='inner', suffixes=('_b', '_t'))
+@app.route('/fingerprint_diff')
+def fingerprint_diff():
+    """Latency percentiles of the query fingerprints executed in both baseline and target, with
+    their change, largest change of the median elapsed time first, optionally paginated by the
+    offset and limit arguments
+    """
+    global selected_replays
 
-    df['elapsed_diff'] = ((df['elapsed_time_b'] - df['elapsed_time_t']) / df['elapsed_time_b']) * 100
-    df['exec_diff'] = ((df['execution_time_b'] - df['execution_time_t']) / df['execution_time_b']) * 100
-    df = df.reindex(df['elapsed_diff'].abs().sort_values(ascending=False).index)
+    if not selected_replays:
+        return jsonify({"success": False}), 400
 
-    return jsonify({"success": True, "data": json.loads(df.to_json(orient="records"))}), 201
+    baseline = request.args.get('baseline')
+    target = request.args.get('target')
+    replay_ids = {replay['sid']: replay['replay_id'] for replay in selected_replays}
+    if baseline not in replay_ids or target not in replay_ids:
+        return jsonify({"success": False, "message": "Unknown baseline or target replay."}), 400
+
+    indexes = fingerprint_indexes()
+    (baseline_index, baseline_etag), (target_index, target_etag) = indexes[baseline], indexes[target]
+    if baseline_etag is None or target_etag is None:
+        # indexes built from query history are replaced once the index is written, so their diff
+        # is only kept for the current selection
+        if (baseline, target) not in selected_fingerprint_diffs:
+            selected_fingerprint_diffs[(baseline, target)] = compare_fingerprints(baseline_index, target_index)
+        diff = selected_fingerprint_diffs[(baseline, target)]
+    else:
+        # fingerprints are stable, so diffs of written indexes are cached by their ETags across
+        # replay selections, in memory up to the cache limit and on disk
+        replay = next(replay for replay in selected_replays if replay['sid'] == baseline)
+        key = (replay['bucket'], replay['replay_id'], f"fingerprint_diff_{replay_ids[target]}",
+               f"{baseline_etag}-{target_etag}")
+        diff = replay_data_loader.cache.get(key)
+        if diff is None:
+            diff = compare_fingerprints(baseline_index, target_index).reset_index(drop=True)
+            replay_data_loader.cache.put(key, diff)
+
+    offset, limit = page_args()
+    return page_response(paginate(diff, offset, limit), len(diff), offset, limit)
 
 
 @app.route('/err_table')
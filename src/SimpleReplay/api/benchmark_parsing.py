@@ -0,0 +1,119 @@
+"""
+benchmark_parsing.py
+====================================
+Benchmarks the column-wise parsing of the query history against the row-wise helpers it replaced,
+on a synthetic query history, and checks that both give the same results. Run from the api folder:
+
+    python3 benchmark_parsing.py --rows 1000000
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils import (
+    calc_diff,
+    calc_diff_series,
+    hash_query,
+    hash_query_series,
+    remove_comments,
+    remove_comments_series,
+)
+
+REPLAY_START = "2022-08-08T17:00:00.123456+00:00"
+
+
+def synthetic_query_history(rows, seed=1):
+    """Query history of rows queries, with start times of varying precision around the replay
+    start, and query texts tagged by replay, except for one in ten
+    @param rows: int, number of queries
+    @param seed: int, seed of the random start times
+    """
+    rng = random.Random(seed)
+    base = datetime.datetime(2022, 8, 8, 17, 0, 0)
+
+    def start_time():
+        time_str = (base + datetime.timedelta(microseconds=rng.randrange(-10**9, 4 * 10**9))).strftime(
+            "%Y-%m-%d %H:%M:%S.%f"
+        )
+        # drop trailing digits, as Redshift does for fractions ending with zeros
+        return time_str[: len(time_str) - rng.choice([0, 0, 0, 1, 3])]
+
+    texts = []
+    for i in range(rows):
+        text = f"select * from t{i % 500} where a = 'x /* y */' /* c */ and b = {i % 97}"
+        if i % 10:
+            text = f'/* {{"xid": "{i % 20000}", "query_idx": {i % 7}, "replay_start": "{REPLAY_START}"}} */ ' + text
+        texts.append(text)
+
+    return pd.DataFrame(
+        {
+            "start_time": [start_time() for _ in range(rows)],
+            "elapsed_time": np.arange(rows),
+            "query_text": texts,
+        }
+    )
+
+
+def same_groups(expected, result):
+    """Whether two columns of hashes group the rows the same way. hash_query uses the built-in
+    hash(), which differs between processes, so only the grouping can be compared"""
+    return (pd.factorize(expected)[0] == pd.factorize(result)[0]).all() and (
+        (expected == 0) == (result == 0)
+    ).all()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark query history parsing of the analysis API")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="number of queries")
+    args = parser.parse_args()
+
+    df = synthetic_query_history(args.rows)
+    print(f"Synthetic query history of {args.rows} queries")
+
+    columns = [
+        (
+            "start offset",
+            lambda: df["start_time"].apply(lambda x: calc_diff(REPLAY_START, x)).astype(np.int64),
+            lambda: calc_diff_series(REPLAY_START, df["start_time"]),
+            pd.Series.equals,
+        ),
+        (
+            "query hash",
+            lambda: df["query_text"].apply(lambda x: hash_query(x)),
+            lambda: hash_query_series(df["query_text"]),
+            same_groups,
+        ),
+        (
+            "comments removed",
+            lambda: df["query_text"].apply(lambda x: remove_comments(x)),
+            lambda: remove_comments_series(df["query_text"]),
+            pd.Series.equals,
+        ),
+    ]
+
+    row_wise_total = column_wise_total = 0
+    for name, row_wise, column_wise, equivalent in columns:
+        expected, row_wise_sec = timed(row_wise)
+        result, column_wise_sec = timed(column_wise)
+        if not equivalent(expected, result):
+            raise AssertionError(f"{name}: column-wise result differs from row-wise")
+        row_wise_total += row_wise_sec
+        column_wise_total += column_wise_sec
+        print(f"{name:<18} row-wise {row_wise_sec:7.2f}s  column-wise {column_wise_sec:7.2f}s")
+
+    print(f"{'total':<18} row-wise {row_wise_total:7.2f}s  column-wise {column_wise_total:7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+replay_cache.py
+====================================
+Loads the unloaded system table data of the selected replays for the analysis API. Replays are
+downloaded from S3 concurrently, and the parsed data frame of each replay is kept in memory, up to
+a size limit with the least recently used frames evicted first, and on local disk as Parquet.
+Frames are keyed by the ETag of their S3 object, so a replay that's selected again is read back
+from the cache, while data that was unloaded again is downloaded again.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+# bumped whenever the parsed frames change, so frames cached by an older version are not read
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "simplereplay", "analysis")
+DEFAULT_MAX_MEMORY_MB = 1024
+DEFAULT_MAX_WORKERS = 8
+
+try:
+    import pyarrow  # noqa: F401 - required by DataFrame.to_parquet
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+
+class ReplayFrameCache:
+    """Parsed data frames of replays, keyed by (bucket, replay id, filename, ETag). At most
+    max_memory_bytes of frames are kept in memory, and all of them are written to directory when
+    pyarrow is available, so they outlive the API process
+    @param directory: str, local directory of the cached Parquet files, or None to cache in memory only
+    @param max_memory_bytes: int, memory used by the frames kept in memory
+    """
+
+    def __init__(self, directory=None, max_memory_bytes=DEFAULT_MAX_MEMORY_MB * 1024 * 1024):
+        self.directory = Path(directory) if directory and PARQUET_AVAILABLE else None
+        self.max_memory_bytes = max_memory_bytes
+        self.frames = OrderedDict()     # key -> (frame, size in bytes), least recently used first
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Cached frame of key, or None if it has to be downloaded"""
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is not None:
+                self.frames.move_to_end(key)
+                return entry[0]
+
+        path = self._path(key)
+        if path is None or not path.exists():
+            return None
+        try:
+            frame = pd.read_parquet(path)
+        except Exception as e:
+            print(f"Unable to read cached replay data {path}, downloading it again. {e}")
+            return None
+        self._remember(key, frame)
+        return frame
+
+    def put(self, key, frame):
+        """Cache the frame of key, replacing the frames cached for older ETags of the same file"""
+        self._remember(key, frame)
+
+        path = self._path(key)
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        for stale in path.parent.glob(f"{key[2]}.v*.parquet"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+        temp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        try:
+            frame.to_parquet(temp_path, index=False)
+            os.replace(temp_path, path)
+        except Exception as e:
+            # columns mixing types can't be written to Parquet, those frames stay in memory only
+            print(f"Unable to cache replay data to {path}. {e}")
+            temp_path.unlink(missing_ok=True)
+
+    def clear(self):
+        """Drop the frames kept in memory"""
+        with self.lock:
+            self.frames.clear()
+            self.memory_bytes = 0
+
+    def _remember(self, key, frame):
+        size = int(frame.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            previous = self.frames.pop(key, None)
+            if previous is not None:
+                self.memory_bytes -= previous[1]
+            self.frames[key] = (frame, size)
+            self.memory_bytes += size
+            # the frame just added is kept even if it's larger than the limit on its own
+            while self.memory_bytes > self.max_memory_bytes and len(self.frames) > 1:
+                _, (_, evicted_size) = self.frames.popitem(last=False)
+                self.memory_bytes -= evicted_size
+
+    def _path(self, key):
+        if self.directory is None:
+            return None
+        bucket, replay_id, filename, etag = key
+        etag = re.sub(r"[^A-Za-z0-9_-]", "", etag)
+        return self.directory / bucket / replay_id / f"{filename}.v{CACHE_VERSION}-{etag}.parquet"
+
+
+class ReplayDataLoader:
+    """Downloads the raw data of replays from S3, through a ReplayFrameCache
+    @param parse: function(body, replay, filename) returning the data frame of a downloaded object
+    @param cache: ReplayFrameCache
+    @param max_workers: int, number of replays downloaded at once
+    @param folder: str, folder of the replay analysis output the files are read from
+    """
+
+    def __init__(self, parse, cache, max_workers=DEFAULT_MAX_WORKERS, folder="raw_data"):
+        self.parse = parse
+        self.cache = cache
+        self.max_workers = max_workers
+        self.folder = folder
+
+    def load(self, session, replays, filename):
+        """Data frames of filename for each replay, in the order of replays. Replays
+        that weren't unloaded, or whose data is empty, get an empty frame. Errors parsing the data
+        of a replay are raised
+        @param session: boto3 session
+        @param replays: list of replay dicts, as in replay/info.json
+        @param filename: str, filename of unloaded sys view data in S3
+        """
+        return [frame for frame, _ in self.load_with_etags(session, replays, filename)]
+
+    def load_with_etags(self, session, replays, filename):
+        """Data frames of filename for each replay, as load, each with the ETag of its S3 object, or
+        None for replays without data
+        """
+        # boto3 clients are thread safe, unlike sessions, so one client is shared by all downloads
+        s3_client = session.client('s3')
+        if len(replays) <= 1:
+            return [self._load_replay(s3_client, replay, filename) for replay in replays]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(replays))) as executor:
+            return list(executor.map(lambda replay: self._load_replay(s3_client, replay, filename), replays))
+
+    def _load_replay(self, s3_client, replay, filename):
+        bucket = replay['bucket']
+        key = f"analysis/{replay['replay_id']}/{self.folder}/{filename}"
+        try:
+            etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+            frame = self.cache.get((bucket, replay['replay_id'], filename, etag))
+            if frame is not None:
+                return frame, etag
+
+            response = s3_client.get_object(Bucket=bucket, Key=key, IfMatch=etag)
+            frame = self.parse(response.get("Body"), replay, filename)
+        except (ClientError, pd.errors.EmptyDataError):
+            return pd.DataFrame(), None
+
+        self.cache.put((bucket, replay['replay_id'], filename, etag), frame)
+        return frame, etag
+
+
+def cache_from_environment():
+    """ReplayFrameCache configured by the SIMPLEREPLAY_ANALYSIS_CACHE_DIR (empty to disable the
+    disk cache) and SIMPLEREPLAY_ANALYSIS_CACHE_MB environment variables"""
+    directory = os.environ.get("SIMPLEREPLAY_ANALYSIS_CACHE_DIR", DEFAULT_CACHE_DIR)
+    max_memory_mb = int(os.environ.get("SIMPLEREPLAY_ANALYSIS_CACHE_MB", DEFAULT_MAX_MEMORY_MB))
+    return ReplayFrameCache(directory or None, max_memory_mb * 1024 * 1024)
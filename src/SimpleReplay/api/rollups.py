@@ -0,0 +1,205 @@
+"""
+rollups.py
+====================================
+Rollups of the query history of the selected replays, built once per replay selection, so the
+comparison endpoints answer from small pre-aggregated tables instead of filtering and grouping
+every query of every replay on each request. The rollups hold:
+- throughput: queries completed per second, by replay, user and query type
+- latency sketches: log-bucketed histograms of execution and elapsed times, by replay, user and
+  query type, giving quantiles within RELATIVE_ACCURACY of the exact value
+- query aggregates: times and status of each replayed query, by replay and query hash
+- the queries of all replays in order of elapsed time, for paginated top queries
+"""
+
+import numpy as np
+import pandas as pd
+
+GROUP_COLUMNS = ['sid', 'user_name', 'query_type']
+LATENCY_COLUMNS = ['execution_time', 'elapsed_time']
+
+# quantiles read from a sketch are within 1% of the exact value
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+# latencies at or below this many milliseconds are counted in the zero bucket
+MIN_LATENCY_MS = 1e-3
+ZERO_BUCKET = -(2 ** 31)
+
+# columns of the query aggregates taken from the first statement of each query
+FIRST_COLUMNS = ['query_id', 'user_name', 'database_name', 'query_type', 'query_text', 'start_time']
+SUM_COLUMNS = ['elapsed_time', 'queue_time', 'execution_time']
+
+
+def bucket_index(values):
+    """Sketch bucket of each latency: bucket k holds the latencies in (GAMMA^(k-1), GAMMA^k]"""
+    values = np.asarray(values, dtype=np.float64)
+    indexes = np.full(len(values), ZERO_BUCKET, dtype=np.int64)
+    positive = values > MIN_LATENCY_MS
+    indexes[positive] = np.ceil(np.log(values[positive]) / np.log(GAMMA)).astype(np.int64)
+    return indexes
+
+
+def bucket_value(indexes):
+    """Latency each bucket stands for, within RELATIVE_ACCURACY of all latencies of the bucket"""
+    indexes = np.asarray(indexes, dtype=np.int64)
+    values = 2 * np.power(GAMMA, indexes.astype(np.float64)) / (GAMMA + 1)
+    return np.where(indexes == ZERO_BUCKET, 0.0, values)
+
+
+class LatencySketch:
+    """Latency distribution merged from the sketches of some groups. Count, mean, standard
+    deviation, minimum and maximum are exact, quantiles are read from the buckets
+    @param buckets: Series of counts, indexed by sorted bucket index
+    @param moments: DataFrame of count, mean, m2 (sum of squared deviations), min and max per group
+    """
+
+    def __init__(self, buckets, moments):
+        self.buckets = buckets
+        self.count = int(moments['count'].sum())
+        if self.count == 0:
+            self.mean = self.m2 = self.min = self.max = np.nan
+            return
+        self.mean = (moments['count'] * moments['mean']).sum() / self.count
+        # combines the deviations of the groups around their own mean, as in Chan et al.
+        self.m2 = (moments['m2'] + moments['count'] * (moments['mean'] - self.mean) ** 2).sum()
+        self.min = moments['min'].min()
+        self.max = moments['max'].max()
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        position = np.searchsorted(self.buckets.to_numpy().cumsum(), rank, side='right')
+        value = bucket_value([self.buckets.index[position]])[0]
+        return float(min(max(value, self.min), self.max))
+
+    def std(self):
+        """Sample standard deviation, like Series.std()"""
+        if self.count < 2:
+            return np.nan
+        return float(np.sqrt(self.m2 / (self.count - 1)))
+
+    def histogram(self, bins=3):
+        """Counts in equal width bins between the minimum and the maximum, like np.histogram"""
+        if self.count == 0:
+            return np.histogram([], bins=bins)
+        values = np.clip(bucket_value(self.buckets.index), self.min, self.max)
+        return np.histogram(values, bins=bins, range=(self.min, self.max), weights=self.buckets.to_numpy())
+
+
+class QueryRollups:
+    """Rollups of the query data of the selected replays, as compiled by request_s3_data
+    @param query_data: DataFrame of sys_query_history rows of all selected replays
+    """
+
+    def __init__(self, query_data):
+        self.query_data = query_data
+        data = query_data
+        if not set(GROUP_COLUMNS + LATENCY_COLUMNS + ['start_diff', 'end_diff']).issubset(data.columns):
+            data = pd.DataFrame(columns=list(data.columns.union(GROUP_COLUMNS + LATENCY_COLUMNS +
+                                                                ['start_diff', 'end_diff', 'query_hash'])))
+
+        # queries completed in each second of the replay, in milliseconds as the GUI expects
+        seconds = (data['end_diff'].to_numpy(dtype=np.float64) / 1000).astype(np.int64) * 1000
+        self.throughput_counts = data.groupby(GROUP_COLUMNS + [pd.Series(seconds, index=data.index, name='time')],
+                                              dropna=False).size()
+
+        self.latency_buckets = {}
+        self.latency_moments = {}
+        groups = [data[column] for column in GROUP_COLUMNS]
+        for column in LATENCY_COLUMNS:
+            latencies = data[column].astype(np.float64)
+            buckets = pd.Series(bucket_index(latencies), index=data.index, name='bucket')
+            self.latency_buckets[column] = latencies.groupby(groups + [buckets], dropna=False).size()
+            moments = latencies.groupby(groups, dropna=False).agg(['count', 'mean', 'var', 'min', 'max'])
+            moments['m2'] = moments['var'].fillna(0) * (moments['count'] - 1)
+            self.latency_moments[column] = moments
+
+        self.time_bounds = data.groupby('sid')[['start_diff', 'end_diff']].agg(['min', 'max'])
+        self.replays = {sid: replay_data for sid, replay_data in query_data.groupby('sid')} \
+            if 'sid' in query_data.columns else {}
+        self.query_aggregates = self._aggregate_queries(data)
+        self.top = query_data.sort_values(by="elapsed_time", ascending=False) \
+            if 'elapsed_time' in query_data.columns else query_data
+        self.diffs = {}
+
+    def throughput(self, sid, users=None, query_types=None):
+        """Queries completed per second of one replay, as a DataFrame of rel_time and freq"""
+        counts = self.throughput_counts[self._matching(self.throughput_counts.index, sid, users, query_types)]
+        counts = counts.groupby(level='time').sum()
+        return pd.DataFrame({'rel_time': counts.index, 'freq': counts.values})
+
+    def latency(self, sid, column, users=None, query_types=None):
+        """LatencySketch of a column of LATENCY_COLUMNS for the queries of one replay"""
+        buckets = self.latency_buckets[column]
+        buckets = buckets[self._matching(buckets.index, sid, users, query_types)]
+        moments = self.latency_moments[column]
+        moments = moments[self._matching(moments.index, sid, users, query_types)]
+        return LatencySketch(buckets.groupby(level='bucket').sum(), moments)
+
+    def covers(self, sid, duration):
+        """Whether filtering the queries of a replay by duration, as filter_data does, keeps all of them"""
+        if duration is None or duration == [0, 0] or sid not in self.time_bounds.index:
+            return True
+        bounds = self.time_bounds.loc[sid]
+        return (duration[0] <= bounds[('start_diff', 'min')] and bounds[('start_diff', 'max')] <= duration[1]) or \
+               (duration[0] <= bounds[('end_diff', 'min')] and bounds[('end_diff', 'max')] <= duration[1])
+
+    def replay_data(self, sid):
+        """Query data of one replay"""
+        return self.replays.get(sid, self.query_data.iloc[0:0])
+
+    def top_queries(self, offset=0, limit=None):
+        """Page of the queries of all replays, longest elapsed time first
+        @return: (DataFrame of the page, total number of queries)
+        """
+        return paginate(self.top, offset, limit), len(self.top)
+
+    def perf_diff(self, baseline, target, offset=0, limit=None):
+        """Page of the queries replayed in both baseline and target, largest elapsed time change first
+        @return: (DataFrame of the page, total number of queries)
+        """
+        if (baseline, target) not in self.diffs:
+            aggregates = self.query_aggregates
+            df = pd.merge(left=aggregates[aggregates['sid'] == baseline],
+                          right=aggregates[aggregates['sid'] == target],
+                          on='query_hash', how='inner', suffixes=('_b', '_t'))
+            df['elapsed_diff'] = ((df['elapsed_time_b'] - df['elapsed_time_t']) / df['elapsed_time_b']) * 100
+            df['exec_diff'] = ((df['execution_time_b'] - df['execution_time_t']) / df['execution_time_b']) * 100
+            self.diffs[(baseline, target)] = df.reindex(df['elapsed_diff'].abs().sort_values(ascending=False).index)
+
+        diff = self.diffs[(baseline, target)]
+        return paginate(diff, offset, limit), len(diff)
+
+    @staticmethod
+    def _matching(index, sid, users, query_types):
+        mask = index.get_level_values('sid') == sid
+        if users:
+            mask &= index.get_level_values('user_name').isin(users)
+        if query_types:
+            mask &= index.get_level_values('query_type').isin(query_types)
+        return mask
+
+    @staticmethod
+    def _aggregate_queries(data):
+        """Times of each tagged query by replay, summed over the statements it was split into"""
+        tagged = data[data['query_hash'] != 0].sort_values(by='start_diff', kind='stable')
+        keys = ['sid', 'query_hash']
+        aggregations = {column: (column, 'first') for column in FIRST_COLUMNS if column in tagged.columns}
+        aggregations.update({column: (column, 'sum') for column in SUM_COLUMNS if column in tagged.columns})
+        aggregations.update(start_diff=('start_diff', 'min'), end_diff=('end_diff', 'max'),
+                            statements=('start_diff', 'size'))
+        if 'end_time' in tagged.columns:
+            aggregations['end_time'] = ('end_time', 'last')
+        aggregates = tagged.groupby(keys, sort=False).agg(**aggregations)
+
+        if 'status' in tagged.columns:
+            # a query succeeded if all of its statements did, otherwise it has the first failed status
+            failed = tagged[tagged['status'] != 'success'].groupby(keys, sort=False)['status'].first()
+            aggregates['status'] = failed.reindex(aggregates.index).fillna('success')
+        return aggregates.reset_index()
+
+
+def paginate(df, offset=0, limit=None):
+    """Rows offset to offset + limit of df, or all rows from offset if limit is None"""
+    return df.iloc[offset:] if limit is None else df.iloc[offset:offset + limit]
@@ -6,6 +6,7 @@ import json
 from urllib.parse import urlparse
 
 import botocore
+import numpy as np
 import pandas as pd
 from boto3 import client
 from botocore.exceptions import *
@@ -72,19 +73,37 @@ def list_replays(bucket_url, session):
     return bucket.get("bucket_name"), table
 
 
+# first group captures quoted strings (double or single)
+# second group captures comments (//single-line or /* multi-line */)
+COMMENT_PATTERN = re.compile(r"(\".*?\"|\'.*?\')|(/\*.*?\*/|//[^\r\n]*$)", re.MULTILINE|re.DOTALL)
+# a comment at the start of a text, which COMMENT_PATTERN removes before looking at the rest. Kept
+# as a string, so pandas can run it with its own regex engine
+LEADING_COMMENT_PATTERN = r"(?s)\A/\*.*?\*/"
+
+
+def _comment_replacer(match):
+    # if the 2nd group (capturing comments) is not None,
+    # it means we have captured a non-quoted (real) comment string.
+    if match.group(2) is not None:
+        return "" # so we will return empty to remove the comment
+    else: # otherwise, we will return the 1st group
+        return match.group(1) # captured quoted-string
+
+
 def remove_comments(string):
-    pattern = r"(\".*?\"|\'.*?\')|(/\*.*?\*/|//[^\r\n]*$)"
-    # first group captures quoted strings (double or single)
-    # second group captures comments (//single-line or /* multi-line */)
-    regex = re.compile(pattern, re.MULTILINE|re.DOTALL)
-    def _replacer(match):
-        # if the 2nd group (capturing comments) is not None,
-        # it means we have captured a non-quoted (real) comment string.
-        if match.group(2) is not None:
-            return "" # so we will return empty to remove the comment
-        else: # otherwise, we will return the 1st group
-            return match.group(1) # captured quoted-string
-    return regex.sub(_replacer, string)
+    return COMMENT_PATTERN.sub(_comment_replacer, string)
+
+
+def remove_comments_series(texts):
+    """Removes comments from a column of query texts, keeping quoted strings. Replay tags are
+    leading comments that make every text distinct, so they are stripped first, and the comments
+    of each distinct remainder are then only removed once
+    @param texts: Series of str
+    """
+    untagged = texts.astype(str).str.replace(LEADING_COMMENT_PATTERN, "", regex=True)
+    codes, distinct = pd.factorize(untagged)
+    removed = np.array([remove_comments(text) for text in distinct], dtype=object)
+    return pd.Series(removed[codes], index=texts.index)
 
 
 def hash_query(st):
@@ -96,6 +115,26 @@ def hash_query(st):
     return 0
 
 
+def hash_query_series(texts):
+    """Hashes the replay tag (xid and query index) of a column of query texts, with 0 for texts
+    that aren't tagged. The tag is the same slice as in hash_query, but hashed with a hash that
+    doesn't change between processes, so hashes of cached data still match. Each distinct text
+    is only hashed once
+    @param texts: Series of str
+    """
+    if texts.empty:
+        return pd.Series(0, index=texts.index, dtype=np.int64)
+    codes, distinct = pd.factorize(texts.astype(str))
+    starts = distinct.str.find("xid")
+    ends = distinct.str.find("replay_start") - 3
+    tags = np.array(
+        [text[start:end] for text, start, end in zip(distinct.tolist(), starts.tolist(), ends.tolist())],
+        dtype=object,
+    )
+    hashes = np.where(np.asarray(starts) >= 0, pd.util.hash_array(tags, categorize=False).astype(np.int64), 0)
+    return pd.Series(hashes[codes], index=texts.index)
+
+
 def calc_diff(replay_start, timestamp):
     if len(timestamp.split(".")[-1]) < 6:
         for i in range(6 - len(timestamp.split(".")[-1])):
@@ -112,6 +151,31 @@ def calc_diff(replay_start, timestamp):
     return ((stamp - start).total_seconds()) * 1000
 
 
+def to_utc_timestamps(timestamps):
+    """Parses a column of ISO timestamps, taking timestamps without a timezone as UTC"""
+    try:
+        return pd.to_datetime(timestamps, utc=True, format="ISO8601")
+    except (TypeError, ValueError):
+        # pandas < 2.0 has no ISO8601 format, and infers the format from the column instead
+        return pd.to_datetime(timestamps, utc=True)
+
+
+def calc_diff_series(replay_start, timestamps):
+    """Milliseconds from the replay start to each timestamp of a column, truncated like
+    calc_diff(...) cast to int
+    @param replay_start: str, ISO timestamp of the replay start
+    @param timestamps: Series of str, ISO timestamps
+    """
+    start = pd.Timestamp(replay_start)
+    if start.tzinfo is None:
+        start = start.tz_localize("UTC")
+    stamps = to_utc_timestamps(timestamps)
+
+    # same arithmetic as timedelta.total_seconds() * 1000, from whole microseconds
+    micros = (stamps - start).to_numpy().astype("timedelta64[us]").astype(np.int64)
+    return pd.Series((micros / 1e6 * 1000).astype(np.int64), index=timestamps.index)
+
+
 def filter_data(data, replay, query_types=None, users=None, duration=None):
     if users is None:
         users = []
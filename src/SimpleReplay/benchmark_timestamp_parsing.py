@@ -0,0 +1,125 @@
+"""
+benchmark_timestamp_parsing.py
+====================================
+Benchmarks the timestamp parsers of timestamp_parsing.py against the generic parsers they fall
+back to, on the timestamps of a synthetic log, and checks that both give the same values:
+
+    python3 benchmark_timestamp_parsing.py --lines 10000000
+"""
+
+import argparse
+import datetime
+import time
+
+import dateutil.parser
+
+from timestamp_parsing import (
+    CONNECTION_LOG_TIME_FORMAT,
+    parse_connection_log_time,
+    parse_iso_time,
+    parse_start_node_log_time,
+    parse_user_activity_log_time,
+)
+
+BASE_TIME = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+# records per second of log time, as on a busy cluster
+RECORDS_PER_SECOND = 200
+
+
+def record_times(lines, time_format):
+    """Record times of a log of lines records, at RECORDS_PER_SECOND records per second
+    :param lines: number of records
+    :param time_format: strftime format of the record times
+    """
+    times = []
+    for second in range(-(-lines // RECORDS_PER_SECOND)):
+        value = (BASE_TIME + datetime.timedelta(seconds=second)).strftime(time_format)
+        times.extend([value] * RECORDS_PER_SECOND)
+    return times[:lines]
+
+
+def connection_log_times(lines):
+    """Distinct connection log event times, with microsecond fractions"""
+    times = []
+    for second in range(-(-lines // RECORDS_PER_SECOND)):
+        prefix = (BASE_TIME + datetime.timedelta(seconds=second)).strftime("%a, %d %b %Y %H:%M:%S:")
+        times.extend(f"{prefix}{(i * 4999) % 10 ** 6:06d}" for i in range(RECORDS_PER_SECOND))
+    return times[:lines]
+
+
+def iso_times(lines):
+    """Distinct ISO times, as written to extracted workloads"""
+    return [(BASE_TIME + datetime.timedelta(microseconds=i * 7919)).isoformat() for i in range(lines)]
+
+
+def parse_connection_log_time_strptime(value):
+    return datetime.datetime.strptime(value, CONNECTION_LOG_TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+
+
+def timed(fn, values):
+    start = time.perf_counter()
+    result = [fn(value) for value in values]
+    return result, time.perf_counter() - start
+
+
+def benchmark(name, values, fast, fallback, sample):
+    """Times fast over values and fallback over the first sample values, and checks that both
+    give the same times, for the sampled values and for all distinct values
+    :param name: name of the format
+    :param values: timestamps to parse
+    :param fast: parser of timestamp_parsing.py
+    :param fallback: generic parser
+    :param sample: number of values the fallback parser is timed on
+    """
+    if hasattr(fast, "cache_clear"):
+        fast.cache_clear()
+    result, fast_sec = timed(fast, values)
+    expected, fallback_sec = timed(fallback, values[:sample])
+    if result[:sample] != expected:
+        raise AssertionError(f"{name}: fast path differs from the fallback parser")
+
+    distinct = list(dict.fromkeys(values))
+    if len(distinct) <= sample and [fast(value) for value in distinct] != [fallback(value) for value in distinct]:
+        raise AssertionError(f"{name}: fast path differs from the fallback parser")
+
+    print(
+        f"{name:<22} fast {len(values) / fast_sec:12,.0f} records/s  "
+        f"fallback {min(sample, len(values)) / fallback_sec:12,.0f} records/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark timestamp parsing of extract and replay")
+    parser.add_argument("--lines", type=int, default=10_000_000, help="number of log records")
+    parser.add_argument(
+        "--sample", type=int, default=200_000, help="number of records the fallback parsers are run on"
+    )
+    args = parser.parse_args()
+
+    print(f"Synthetic log of {args.lines} records")
+    benchmark(
+        "user activity log",
+        record_times(args.lines, "%Y-%m-%dT%H:%M:%SZ"),
+        parse_user_activity_log_time,
+        dateutil.parser.parse,
+        args.sample,
+    )
+    benchmark(
+        "start node log",
+        record_times(args.lines, "%Y-%m-%d %H:%M:%S UTC"),
+        parse_start_node_log_time,
+        dateutil.parser.parse,
+        args.sample,
+    )
+    benchmark(
+        "connection log",
+        connection_log_times(args.lines),
+        parse_connection_log_time,
+        parse_connection_log_time_strptime,
+        args.sample,
+    )
+    benchmark("workload ISO times", iso_times(args.lines), parse_iso_time, dateutil.parser.isoparse, args.sample)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+benchmark_transaction_assignment.py
+====================================
+Benchmarks the binary search matching of transactions to connections in replay.py against the
+linear scan it replaced, on a synthetic workload of pooled pids with many sessions each, and checks
+that both assign the same transactions to the same connections:
+
+    python3 benchmark_transaction_assignment.py --transactions 1000000 --sessions 100000
+"""
+
+import argparse
+import datetime
+import logging
+import random
+import time
+
+import replay
+from replay import ConnectionLog, Query, Transaction, assign_transactions, get_connection_key
+
+BASE_TIME = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+# seconds between two sessions of the same pid, and between two transactions of a session
+SESSION_INTERVAL_SEC = 60
+TRANSACTION_INTERVAL_SEC = 5
+
+
+def synthetic_workload(transactions, sessions, pids, seed=1):
+    """Connections sorted by session initiation time, as parse_connections returns them, and
+    shuffled transactions, spread evenly over the sessions. Sessions start with a fraction of a
+    second, and the first transaction of each session in the same second. One transaction in a
+    hundred has no connection, and one in a hundred starts before the first session of its pid
+    :param transactions: number of transactions
+    :param sessions: number of sessions
+    :param pids: number of pids the sessions are spread over
+    :param seed: seed of the transaction order
+    """
+    connection_logs = []
+    for session in range(sessions):
+        pid = str(session % pids)
+        start = BASE_TIME + datetime.timedelta(
+            seconds=(session // pids) * SESSION_INTERVAL_SEC + session % pids % SESSION_INTERVAL_SEC,
+            microseconds=(session * 7919) % 10**6,
+        )
+        connection_logs.append(
+            ConnectionLog(
+                start,
+                start + datetime.timedelta(seconds=SESSION_INTERVAL_SEC - 1),
+                "",
+                "dev",
+                "user",
+                pid,
+                0,
+                0,
+                get_connection_key("dev", "user", pid),
+            )
+        )
+    connection_logs.sort(key=lambda c: c.session_initiation_time)
+
+    workload = []
+    for i in range(transactions):
+        connection = connection_logs[i % sessions]
+        pid = connection.pid
+        start = connection.session_initiation_time.replace(microsecond=0) + datetime.timedelta(
+            seconds=(i // sessions) * TRANSACTION_INTERVAL_SEC % SESSION_INTERVAL_SEC
+        )
+        if i % 100 == 1:
+            pid = "unknown"
+        elif i % 100 == 2:
+            start = BASE_TIME - datetime.timedelta(seconds=1)
+        query = Query(start, start, "select 1")
+        workload.append(Transaction(0, "dev", "user", pid, str(i), [query], f"dev_user_{pid}_{i}"))
+    random.Random(seed).shuffle(workload)
+    return connection_logs, workload
+
+
+def assign_transactions_linear(connection_logs, transactions):
+    """The linear scan assign_transactions replaced, returning the index of the connection each
+    transaction is assigned to, or None"""
+    connection_idx_by_key = {}
+    for idx, c in enumerate(connection_logs):
+        connection_key = get_connection_key(c.database_name, c.username, c.pid)
+        connection_idx_by_key.setdefault(connection_key, []).append(idx)
+
+    assignments = []
+    for t in transactions:
+        connection_key = get_connection_key(t.database_name, t.username, t.pid)
+        best_match_idx = None
+        for c_idx in connection_idx_by_key.get(connection_key, []):
+            if connection_logs[c_idx].session_initiation_time.replace(microsecond=0) > t.start_time():
+                break
+            best_match_idx = c_idx
+        assignments.append(best_match_idx)
+    return assignments
+
+
+def bisect_assignments(connection_logs, transactions):
+    """Index of the connection assign_transactions assigns each transaction to, or None"""
+    assign_transactions(connection_logs, transactions)
+    connection_idx = {}
+    for idx, c in enumerate(connection_logs):
+        for t in c.transactions:
+            connection_idx[id(t)] = idx
+    return [connection_idx.get(id(t)) for t in transactions]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark matching transactions to connections")
+    parser.add_argument("--transactions", type=int, default=1_000_000, help="number of transactions")
+    parser.add_argument("--sessions", type=int, default=100_000, help="number of sessions")
+    parser.add_argument("--pids", type=int, default=100, help="number of pids the sessions are spread over")
+    parser.add_argument(
+        "--sample", type=int, default=10_000, help="number of transactions the linear scan is run on"
+    )
+    args = parser.parse_args()
+
+    # unmatched transactions are logged one by one
+    replay.logger = logging.getLogger("SimpleReplayLogger")
+    replay.logger.setLevel(logging.ERROR)
+
+    connection_logs, transactions = synthetic_workload(args.transactions, args.sessions, args.pids)
+    print(
+        f"Synthetic workload of {args.transactions} transactions over {args.sessions} sessions "
+        f"of {args.pids} pids"
+    )
+
+    result, bisect_sec = timed(bisect_assignments, connection_logs, transactions)
+    sample = transactions[: args.sample]
+    expected, linear_sec = timed(assign_transactions_linear, connection_logs, sample)
+    if result[: len(sample)] != expected:
+        raise AssertionError("binary search assigns transactions to other connections than the linear scan")
+
+    print(f"{'linear scan':<14} {len(sample) / linear_sec:12,.0f} transactions/s  ({len(sample)} transactions)")
+    print(f"{'binary search':<14} {len(transactions) / bisect_sec:12,.0f} transactions/s  ({len(transactions)} transactions)")
+    print(
+        f"{'full workload':<14} linear scan {len(transactions) * linear_sec / len(sample):9.1f}s "
+        f"(extrapolated)  binary search {bisect_sec:6.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
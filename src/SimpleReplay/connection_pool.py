@@ -0,0 +1,94 @@
+"""
+connection_pool.py
+====================================
+This module holds the connection pool used by the session reuse replay mode. Workloads from
+pooled clients (BI tools, application servers) rarely open a connection per session, so
+replaying each extracted session on a new connection measures TLS and authentication overhead
+that the source cluster never saw. With pooling, each worker keeps idle connections per
+(interface, user, database) and leases them to the sessions it replays, resetting the session
+state in between. RESET ALL only resets configuration parameters, so connections whose session
+created temporary tables or changed its user are closed instead of pooled.
+"""
+
+import logging
+import re
+import threading
+
+logger = logging.getLogger("SimpleReplayLogger")
+
+# statements run on a connection before it's leased again, to drop the configuration parameters
+# set by the previous session
+RESET_STATEMENTS = ("RESET ALL",)
+
+# statements leaving session state that RESET ALL doesn't clear: temporary tables, which live until
+# the session ends, and a changed session user
+SESSION_STATE_PATTERN = re.compile(
+    r"\bcreate\s+(?:local\s+)?(?:temp|temporary)\s+table\b"
+    r"|\bcreate\s+table\s+(?:if\s+not\s+exists\s+)?#"
+    r"|\binto\s+(?:(?:temp|temporary)\b|#)"
+    r"|\bset\s+session\s+authorization\b",
+    flags=re.IGNORECASE,
+)
+
+
+def keeps_session_state(sql_text):
+    """Whether a statement leaves session state that a pooled connection can't be reset from"""
+    return SESSION_STATE_PATTERN.search(sql_text) is not None
+
+
+class ConnectionPool:
+    """
+    Idle connections of one worker process, keyed by (interface, user, database). Connections
+    are opened on demand, so the pool grows to the peak concurrency of each key, and at most
+    max_idle connections per key are kept open when they are given back.
+    """
+
+    def __init__(self, max_idle=8):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def lease(self, key):
+        """An idle connection for key, or None if a new connection has to be opened"""
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def release(self, key, conn):
+        """Give a connection back to the pool once its session ended. The connection is closed
+        instead if its session state can't be reset, or if enough connections are idle"""
+        try:
+            conn.rollback()
+            cursor = conn.cursor()
+            for statement in RESET_STATEMENTS:
+                cursor.execute(statement)
+            cursor.close()
+            conn.commit()
+        except Exception as e:
+            logger.debug(f"Failed to reset pooled connection, closing it: {e}")
+            self._close(conn)
+            return
+
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        self._close(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f"Failed to close pooled connection: {e}")
@@ -0,0 +1,120 @@
+"""
+credential_broker.py
+====================================
+This module holds the credential broker of a replay. The broker runs in the replay manager
+process, fetches the database credentials of every user in the workload once and in parallel
+before the replay starts, and shares them with the worker processes through the Manager. A
+background thread fetches them again before they expire, so workers never call the credentials
+API themselves, unless a user is missing from the broker.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("SimpleReplayLogger")
+
+# lifetime requested for cluster credentials, see get_cluster_credentials DurationSeconds
+CREDENTIALS_DURATION_SEC = 3600
+
+# credentials are fetched again once they are this old
+REFRESH_AFTER_SEC = 1800
+
+# how often the refresh thread looks for credentials to refresh
+REFRESH_CHECK_INTERVAL_SEC = 60
+
+# credentials are not handed out by the broker once they are this close to expiring
+EXPIRY_MARGIN_SEC = 300
+
+MAX_FETCH_THREADS = 16
+
+
+class CredentialBroker:
+    """
+    Fetches user credentials in the replay manager and shares them with the workers. fetch is
+    called with a username and returns the credentials to share, which must be picklable.
+    """
+
+    def __init__(self, manager, fetch):
+        self.fetch = fetch
+        # username -> {"credentials": ..., "fetched_at": epoch seconds}
+        self.credentials = manager.dict()
+        # (worker pid, username) pairs served, each of which would have needed its own API call
+        # without the broker
+        self.served = manager.dict()
+        # pairs recorded in self.served by this process, to skip the round trip to the Manager
+        self.served_locally = set()
+        self.fetches = 0
+        self.fetch_errors = 0
+        self.stopped = threading.Event()
+        self.refresh_thread = None
+
+    def _fetch(self, username):
+        try:
+            credentials = self.fetch(username)
+        except Exception as e:
+            logger.warning(f"Credential broker failed to fetch credentials for {username}: {e}")
+            self.fetch_errors += 1
+            return
+        self.credentials[username] = {"credentials": credentials, "fetched_at": time.time()}
+        self.fetches += 1
+
+    def prefetch(self, usernames):
+        """Fetch the credentials of all the given users in parallel"""
+        usernames = sorted(set(usernames))
+        if not usernames:
+            return
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=min(MAX_FETCH_THREADS, len(usernames))) as executor:
+            list(executor.map(self._fetch, usernames))
+        logger.info(
+            f"Fetched credentials for {len(self.credentials)} of {len(usernames)} users in "
+            f"{time.time() - start:.1f} sec"
+        )
+
+    def start(self):
+        """Start refreshing credentials in the background, ahead of their expiry"""
+        self.refresh_thread = threading.Thread(target=self._refresh_loop, name="credential_broker", daemon=True)
+        self.refresh_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.refresh_thread is not None:
+            self.refresh_thread.join()
+
+    def _refresh_loop(self):
+        while not self.stopped.wait(REFRESH_CHECK_INTERVAL_SEC):
+            now = time.time()
+            expiring = [
+                username
+                for username, record in self.credentials.items()
+                if now - record["fetched_at"] >= REFRESH_AFTER_SEC
+            ]
+            if expiring:
+                logger.debug(f"Refreshing credentials for {len(expiring)} users")
+                with ThreadPoolExecutor(max_workers=min(MAX_FETCH_THREADS, len(expiring))) as executor:
+                    list(executor.map(self._fetch, expiring))
+
+    def get(self, username):
+        """Credentials of username, or None if the broker doesn't have valid ones. Called from the
+        workers"""
+        record = self.credentials.get(username)
+        if record is None:
+            return None
+        if time.time() - record["fetched_at"] >= CREDENTIALS_DURATION_SEC - EXPIRY_MARGIN_SEC:
+            return None
+        key = f"{os.getpid()}:{username}"
+        if key not in self.served_locally:
+            self.served_locally.add(key)
+            self.served[key] = True
+        return record["credentials"]
+
+    def summary(self):
+        served = len(self.served)
+        return (
+            f"Credential broker made {self.fetches} credential requests ({self.fetch_errors} failed) for "
+            f"{len(self.credentials)} users, serving {served} worker/user pairs. "
+            f"{max(served - self.fetches, 0)} credential requests saved."
+        )
@@ -1,11 +1,17 @@
-import datetime
+import collections
+import concurrent.futures
+import gzip
+import io
 import logging
 import re
 
-import dateutil.parser
-
 from audit_logs_parsing import (Log, ConnectionLog)
 from log_validation import is_valid_log, is_duplicate
+from timestamp_parsing import (
+    parse_connection_log_time,
+    parse_start_node_log_time,
+    parse_user_activity_log_time,
+)
 
 logger = logging.getLogger("SimpleReplayLogger")
 
@@ -45,13 +51,93 @@ def parse_log(
         _parse_start_node_log(log_file, logs, databases, start_time, end_time)
 
 
+def parse_log_files(
+        log_files,
+        connections,
+        last_connections,
+        logs,
+        databases,
+        start_time,
+        end_time,
+        processes,
+):
+    """
+    Parses logs in file order, with user activity logs parsed on a pool of processes. Each user
+    activity log is parsed into its own list of Log records by a worker, and the lists are merged
+    back into logs in file order. Other logs are parsed in the main process once the user activity
+    logs before them are merged, so the result is the same as parsing the files one after the
+    other with parse_log()
+
+    :param log_files: iterable of (filename, gzip compressed file content), in file order
+    :param connections: the connections dict
+    :param last_connections: last_connections dict
+    :param logs: logs dict
+    :param databases: databases dict
+    :param start_time: start_time of extract
+    :param end_time: end_time of extract
+    :param processes: number of worker processes
+    """
+    fetch_pattern = _get_fetch_pattern()
+    pending = collections.deque()
+
+    def merge_next():
+        filename, shard = pending.popleft().result()
+        logger.debug(f"Merging {len(shard)} records from user activity log: {filename}")
+        for user_activity_log in shard:
+            _add_user_activity_log(user_activity_log, logs, databases, fetch_pattern)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        for filename, content in log_files:
+            if "useractivitylog" in filename:
+                if len(pending) >= 2 * processes:
+                    merge_next()
+                pending.append(
+                    executor.submit(_parse_user_activity_shard, (filename, content, start_time, end_time))
+                )
+                continue
+
+            while pending:
+                merge_next()
+            log_file = io.BytesIO(gzip.decompress(content))
+            if "start_node" in filename:
+                log_file = io.TextIOWrapper(log_file, encoding="ISO-8859-1")
+            parse_log(
+                log_file,
+                filename,
+                connections,
+                last_connections,
+                logs,
+                databases,
+                start_time,
+                end_time,
+            )
+        while pending:
+            merge_next()
+
+
+def _parse_user_activity_shard(args):
+    filename, content, start_time, end_time = args
+    log_file = io.BytesIO(gzip.decompress(content))
+    return filename, list(_read_user_activity_log(log_file, start_time, end_time))
+
+
 def _parse_user_activity_log(file, logs, databases, start_time, end_time):
-    user_activity_log = Log()
-    datetime_pattern = re.compile(r"'\d+-\d+-\d+T\d+:\d+:\d+Z UTC")
-    fetch_pattern = re.compile(
+    fetch_pattern = _get_fetch_pattern()
+    for user_activity_log in _read_user_activity_log(file, start_time, end_time):
+        _add_user_activity_log(user_activity_log, logs, databases, fetch_pattern)
+
+
+def _get_fetch_pattern():
+    return re.compile(
         r"fetch\s+(next|all|forward all|\d+|forward\s+\d+)\s+(from|in)\s+\S+",
         flags=re.IGNORECASE,
     )
+
+
+def _read_user_activity_log(file, start_time, end_time):
+    """Yields the valid records of a user activity log, in file order"""
+    user_activity_log = Log()
+    datetime_pattern = re.compile(r"'\d+-\d+-\d+T\d+:\d+:\d+Z UTC")
     for line in file.readlines():
 
         line = line.decode("utf-8")
@@ -60,27 +146,12 @@ def _parse_user_activity_log(file, logs, databases, start_time, end_time):
             if user_activity_log.xid and is_valid_log(
                     user_activity_log, start_time, end_time
             ):
-                filename = user_activity_log.get_filename()
-                if filename in logs:
-                    # Check if duplicate. This happens with JDBC connections.
-                    prev_query = logs[filename][-1]
-                    if not is_duplicate(prev_query.text, user_activity_log.text):
-                        if fetch_pattern.search(
-                                prev_query.text
-                        ) and fetch_pattern.search(user_activity_log.text):
-                            user_activity_log.text = f"--{user_activity_log.text}"
-                            logs[filename].append(user_activity_log)
-                        else:
-                            logs[filename].append(user_activity_log)
-                else:
-                    logs[filename] = [user_activity_log]
-
-                databases.add(user_activity_log.database_name)
-                user_activity_log = Log()
+                yield user_activity_log
+            user_activity_log = Log()
             line_split = line.split(" LOG: ")
             query_information = line_split[0].split(" ")
 
-            user_activity_log.record_time = dateutil.parser.parse(
+            user_activity_log.record_time = parse_user_activity_log_time(
                 query_information[0][1:]
             )
             user_activity_log.username = query_information[4][5:]
@@ -92,6 +163,25 @@ def _parse_user_activity_log(file, logs, databases, start_time, end_time):
             user_activity_log.text += line
 
 
+def _add_user_activity_log(user_activity_log, logs, databases, fetch_pattern):
+    filename = user_activity_log.get_filename()
+    if filename in logs:
+        # Check if duplicate. This happens with JDBC connections.
+        prev_query = logs[filename][-1]
+        if not is_duplicate(prev_query.text, user_activity_log.text):
+            if fetch_pattern.search(
+                    prev_query.text
+            ) and fetch_pattern.search(user_activity_log.text):
+                user_activity_log.text = f"--{user_activity_log.text}"
+                logs[filename].append(user_activity_log)
+            else:
+                logs[filename].append(user_activity_log)
+    else:
+        logs[filename] = [user_activity_log]
+
+    databases.add(user_activity_log.database_name)
+
+
 def _parse_start_node_log(file, logs, databases, start_time, end_time):
     start_node_log = Log()
 
@@ -121,7 +211,7 @@ def _parse_start_node_log(file, logs, databases, start_time, end_time):
             if len(line_split) == 2:
                 query_information = line_split[0].split(" ")
 
-                start_node_log.record_time = dateutil.parser.parse(
+                start_node_log.record_time = parse_start_node_log_time(
                     query_information[0][1:]
                     + " "
                     + query_information[1]
@@ -144,9 +234,7 @@ def _parse_connection_log(file, connections, last_connections, start_time, end_t
 
         connection_information = line.split("|")
         connection_event = connection_information[0]
-        event_time = datetime.datetime.strptime(
-            connection_information[1], "%a, %d %b %Y %H:%M:%S:%f"
-        ).replace(tzinfo=datetime.timezone.utc)
+        event_time = parse_connection_log_time(connection_information[1])
         pid = connection_information[4]
         database_name = connection_information[5].strip()
         if connection_information[7].strip() == "IAM AssumeUser":
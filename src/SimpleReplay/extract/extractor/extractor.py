@@ -8,6 +8,7 @@ import datetime
 import gzip
 import json
 import logging
+import os
 import pathlib
 import re
 from collections import OrderedDict
@@ -22,6 +23,7 @@ from audit_logs_parsing import (
 )
 from helper import aws_service as aws_service_helper
 from log_validation import remove_line_comments
+import workload_index
 from .cloudwatch_extractor import CloudwatchExtractor
 from .s3_extractor import S3Extractor
 from .local_extractor import LocalExtractor
@@ -78,7 +80,8 @@ class Extractor:
     def save_logs(self, logs, last_connections, output_directory, connections, start_time, end_time):
         """
         saving the extracted logs in S3 location in the following format:
-        connections.json, copy_replacements.csv, SQLs.json.gz
+        connections.json, copy_replacements.csv, SQLs.json.gz (or SQLs.jsonl.gz and its index, or the
+        SQLs.transactions.parquet and SQLs.queries.parquet tables)
         :param logs:
         :param last_connections:
         :param output_directory:
@@ -102,25 +105,67 @@ class Extractor:
             output_s3_location = output_directory[5:].partition("/")
             bucket_name = output_s3_location[0]
             output_prefix = output_s3_location[2]
-            archive_filename = "/tmp/SQLs.json.gz"
+            archive_directory = "/tmp"
         else:
             is_s3 = False
-            archive_filename = output_directory + "/SQLs.json.gz"
+            archive_directory = output_directory
             logger.info(
                 f"Creating directory {output_directory} if it doesn't already exist"
             )
             pathlib.Path(output_directory).mkdir(parents=True, exist_ok=True)
 
-        sql_json, missing_audit_log_connections, replacements = self.get_sql_connections_replacements(last_connections,
-                                                                                                      log_items)
+        missing_audit_log_connections = set()
+        replacements = set()
+        transactions = self.iter_sql_transactions(
+            last_connections, log_items, missing_audit_log_connections, replacements
+        )
 
-        with gzip.open(archive_filename, "wb") as f:
-            f.write(json.dumps(sql_json, indent=2).encode("utf-8"))
+        workload_format = self.config.get("workload_format", "json")
+        if workload_format == "parquet":
+            import parquet_workload
+
+            archive_filenames = [
+                archive_directory + "/" + parquet_workload.TRANSACTIONS_FILENAME,
+                archive_directory + "/" + parquet_workload.QUERIES_FILENAME,
+            ]
+            parquet_workload.write_transactions(transactions, *archive_filenames)
+        elif workload_format == "jsonl":
+            # one transaction per line, written as it is generated so the archive never has to
+            # be held in memory as a whole. The archive is written in chunks, and the index lets
+            # replay read only the chunks it needs
+            archive_filenames = [
+                archive_directory + "/" + workload_index.ARCHIVE_FILENAME,
+                archive_directory + "/" + workload_index.INDEX_FILENAME,
+            ]
+            with workload_index.ChunkedArchiveWriter(*archive_filenames) as writer:
+                for transaction in transactions:
+                    writer.write(transaction)
+        else:
+            archive_filenames = [archive_directory + "/SQLs.json.gz"]
+            sql_json = {"transactions": OrderedDict()}
+            for transaction in transactions:
+                sql_json["transactions"][transaction["xid"]] = transaction
+            with gzip.open(archive_filenames[0], "wb") as f:
+                f.write(json.dumps(sql_json, indent=2).encode("utf-8"))
 
         if is_s3:
-            dest = output_prefix + "/SQLs.json.gz"
-            logger.info(f"Transferring SQL archive to {dest}")
-            aws_service_helper.s3_upload(archive_filename, bucket_name, dest)
+            for archive_filename in archive_filenames:
+                dest = output_prefix + "/" + archive_filename.split("/")[-1]
+                logger.info(f"Transferring SQL archive to {dest}")
+                aws_service_helper.s3_upload(archive_filename, bucket_name, dest)
+
+        # replay reads the first archive format it finds, so archives of other formats left by an
+        # earlier extract to the same location would shadow this one
+        written_format = workload_format if workload_format in ("parquet", "jsonl") else "json"
+        for stale_format, stale_filenames in workload_index.WORKLOAD_ARCHIVE_FILENAMES.items():
+            if stale_format == written_format:
+                continue
+            for stale_filename in stale_filenames:
+                if is_s3:
+                    aws_service_helper.s3_delete_object(bucket_name, output_prefix + "/" + stale_filename)
+                elif os.path.exists(archive_directory + "/" + stale_filename):
+                    logger.info(f"Removing {stale_filename} of an earlier extract from {output_directory}")
+                    os.remove(archive_directory + "/" + stale_filename)
 
         logger.info(f"Generating {len(missing_audit_log_connections)} missing connections.")
         for missing_audit_log_connection_info in missing_audit_log_connections:
@@ -169,69 +214,106 @@ class Extractor:
         sql_json = {"transactions": OrderedDict()}
         missing_audit_log_connections = set()
         replacements = set()
-        for filename, queries in tqdm(
-                log_items,
+        for transaction in self.iter_sql_transactions(
+                last_connections, log_items, missing_audit_log_connections, replacements
+        ):
+            sql_json["transactions"][transaction["xid"]] = transaction
+        return sql_json, missing_audit_log_connections, replacements
+
+    def iter_sql_transactions(self, last_connections, log_items, missing_audit_log_connections, replacements):
+        """
+        Generates the transactions of the extracted workload one at a time, in the order their
+        xid is first seen. Each transaction has the form
+        { "xid": xxx, "pid": xxx, etc..., queries: [] }
+        :param last_connections:
+        :param log_items: (filename, queries) pairs of the parsed logs
+        :param missing_audit_log_connections: set filled with connections missing from the audit logs
+        :param replacements: set filled with the COPY locations found
+        :return: generator of transaction dicts
+        """
+        # all queries of a log entry share the same xid. Group the entries by xid first, so each
+        # transaction can be emitted once it has been assembled
+        log_items_by_xid = OrderedDict()
+        for filename, queries in log_items:
+            if queries:
+                log_items_by_xid.setdefault(queries[0].xid, []).append((filename, queries))
+
+        for xid_log_items in tqdm(
+                log_items_by_xid.values(),
                 disable=self.disable_progress_bar,
-                unit="files",
-                desc="Files processed",
+                unit="transactions",
+                desc="Transactions processed",
                 bar_format=self.bar_format,
         ):
-            for idx, query in enumerate(queries):
-                try:
-                    if query.xid not in sql_json["transactions"]:
-                        sql_json["transactions"][query.xid] = {
-                            "xid": query.xid,
-                            "pid": query.pid,
-                            "db": query.database_name,
-                            "user": query.username,
-                            "time_interval": True,
-                            "queries": [],
+            transaction = None
+            for filename, queries in xid_log_items:
+                for query in queries:
+                    try:
+                        if transaction is None:
+                            transaction = {
+                                "xid": query.xid,
+                                "pid": query.pid,
+                                "db": query.database_name,
+                                "user": query.username,
+                                "time_interval": True,
+                                "queries": [],
+                            }
+                        query_info = {
+                            "record_time": query.record_time.isoformat(),
+                            "start_time": query.start_time.isoformat()
+                            if query.start_time
+                            else None,
+                            "end_time": query.end_time.isoformat() if query.end_time else None,
                         }
-                    query_info = {
-                        "record_time": query.record_time.isoformat(),
-                        "start_time": query.start_time.isoformat()
-                        if query.start_time
-                        else None,
-                        "end_time": query.end_time.isoformat() if query.end_time else None,
-                    }
-                except AttributeError:
-                    logger.error(
-                        f"Query is missing header info, skipping {filename}: {query}"
-                    )
-                    continue
-
-                query.text = remove_line_comments(query.text).strip()
-
-                if "copy " in query.text.lower() and "from 's3:" in query.text.lower():
-                    bucket = re.search(
-                        r"from 's3:\/\/[^']*", query.text, re.IGNORECASE
-                    ).group()[6:]
-                    replacements.add(bucket)
-                    query.text = re.sub(
-                        r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
-                        f" IAM_ROLE ''",
-                        query.text,
-                        flags=re.IGNORECASE,
-                    )
-                if "unload" in query.text.lower() and "to 's3:" in query.text.lower():
-                    query.text = re.sub(
-                        r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
-                        f" IAM_ROLE ''",
-                        query.text,
-                        flags=re.IGNORECASE,
-                    )
+                    except AttributeError:
+                        logger.error(
+                            f"Query is missing header info, skipping {filename}: {query}"
+                        )
+                        continue
 
-                query.text = f"{query.text.strip()}"
-                if not len(query.text) == 0:
-                    if not query.text.endswith(";"):
-                        query.text += ";"
+                    query_info["text"] = self.clean_query_text(query, replacements)
+                    transaction["queries"].append(query_info)
 
-                query_info["text"] = query.text
-                sql_json["transactions"][query.xid]["queries"].append(query_info)
+                    if not hash((query.database_name, query.username, query.pid)) in last_connections:
+                        missing_audit_log_connections.add((query.database_name, query.username, query.pid))
+            if transaction is not None:
+                yield transaction
 
-                if not hash((query.database_name, query.username, query.pid)) in last_connections:
-                    missing_audit_log_connections.add((query.database_name, query.username, query.pid))
-        return sql_json, missing_audit_log_connections, replacements
+    @staticmethod
+    def clean_query_text(query, replacements):
+        """
+        Removes line comments and IAM roles from the query text, and records the location of COPY
+        statements in replacements
+        :param query: Log
+        :param replacements: set of COPY locations
+        :return: the cleaned query text
+        """
+        query.text = remove_line_comments(query.text).strip()
+
+        if "copy " in query.text.lower() and "from 's3:" in query.text.lower():
+            bucket = re.search(
+                r"from 's3:\/\/[^']*", query.text, re.IGNORECASE
+            ).group()[6:]
+            replacements.add(bucket)
+            query.text = re.sub(
+                r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
+                f" IAM_ROLE ''",
+                query.text,
+                flags=re.IGNORECASE,
+            )
+        if "unload" in query.text.lower() and "to 's3:" in query.text.lower():
+            query.text = re.sub(
+                r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
+                f" IAM_ROLE ''",
+                query.text,
+                flags=re.IGNORECASE,
+            )
+
+        query.text = f"{query.text.strip()}"
+        if not len(query.text) == 0:
+            if not query.text.endswith(";"):
+                query.text += ";"
+        return query.text
 
     def unload_system_table(
             self,
@@ -17,6 +17,7 @@ class LocalExtractor:
 
     def __init__(self, config):
         self.config = config
+        self.parse_processes = config.get("log_parse_processes") or 1
 
     def get_extract_locally(self, log_directory_path, start_time, end_time):
         """
@@ -34,13 +35,29 @@ class LocalExtractor:
         unsorted_list = os.listdir(log_directory_path)
         log_directory = sorted(unsorted_list)
 
-        for filename in tqdm(
-                log_directory,
-                disable=self.disable_progress_bar,
-                unit="files",
-                desc="Files processed",
-                bar_format=self.bar_format,
-        ):
+        log_directory = tqdm(
+            log_directory,
+            disable=self.disable_progress_bar,
+            unit="files",
+            desc="Files processed",
+            bar_format=self.bar_format,
+        )
+
+        if self.parse_processes > 1:
+            logger.info(f"Parsing user activity logs with {self.parse_processes} processes")
+            extract_parser.parse_log_files(
+                self._read_log_files(log_directory_path, log_directory),
+                connections,
+                last_connections,
+                logs,
+                databases,
+                start_time,
+                end_time,
+                self.parse_processes,
+            )
+            return connections, logs, databases, last_connections
+
+        for filename in log_directory:
             if self.disable_progress_bar:
                 logger.info(f"Processing {filename}")
             if "start_node" in filename:
@@ -63,3 +80,10 @@ class LocalExtractor:
             log_file.close()
 
         return connections, logs, databases, last_connections
+
+    def _read_log_files(self, log_directory_path, filenames):
+        for filename in filenames:
+            if self.disable_progress_bar:
+                logger.info(f"Processing {filename}")
+            with open(log_directory_path + "/" + filename, "rb") as log_file:
+                yield filename, log_file.read()
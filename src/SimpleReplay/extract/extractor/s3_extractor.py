@@ -1,11 +1,15 @@
+import concurrent.futures
 import gzip
+import io
 import logging
+import time
 
 import helper.aws_service as aws_service_helper
+from helper.concurrency import ordered_map
 from tqdm import tqdm
 
 import log_validation
-from .extract_parser import parse_log
+from .extract_parser import parse_log, parse_log_files
 
 logger = logging.getLogger("SimpleReplayLogger")
 
@@ -17,6 +21,8 @@ class S3Extractor:
 
     def __init__(self, config):
         self.disable_progress_bar = config.get("disable_progress_bar")
+        self.download_concurrency = config.get("log_download_concurrency") or 8
+        self.parse_processes = config.get("log_parse_processes") or 1
 
     def get_extract_from_s3(self, log_bucket, log_prefix, start_time, end_time):
         """
@@ -67,6 +73,7 @@ class S3Extractor:
             logs,
             databases,
             last_connections,
+            parse_processes=self.parse_processes,
         )
         return connections, logs, databases, last_connections
 
@@ -81,6 +88,7 @@ class S3Extractor:
             logs,
             databases,
             last_connections,
+            parse_processes=1,
     ):
         """
         Getting  audit logs from S3 for the cluster from get_s3_logs  and calling the pasrse_log()
@@ -94,6 +102,7 @@ class S3Extractor:
         :param logs:
         :param databases:
         :param last_connections:
+        :param parse_processes: number of processes to parse user activity logs with
         :return:
         """
 
@@ -104,28 +113,88 @@ class S3Extractor:
         logger.info(f"Processing {len(log_filenames)} files")
 
         curr_index = index_of_last_valid_log
-        for filename in tqdm(
+
+        # Downloads and decompression run on a bounded pool of threads, while parsing consumes
+        # the files in their original order. Connection logs depend on the state left by earlier
+        # files, so merging in file order keeps the result identical to a sequential run. When
+        # parsing on a process pool, the compressed files are handed to the parse workers as is.
+        decompress = parse_processes <= 1
+        s3_client = aws_service_helper.s3_get_client()
+        downloaded_bytes = 0
+        fetch_start = time.monotonic()
+
+        def track_downloads(fetched_logs):
+            nonlocal downloaded_bytes
+            for filename, log_size, log_content in fetched_logs:
+                downloaded_bytes += log_size
+                yield filename, log_content
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.download_concurrency) as executor:
+            fetched_logs = ordered_map(
+                executor,
+                lambda filename: self._fetch_log(s3_client, log_bucket, filename, decompress),
                 log_filenames,
+                max_pending=2 * self.download_concurrency,
+            )
+            fetched_logs = track_downloads(tqdm(
+                fetched_logs,
+                total=len(log_filenames),
                 disable=self.disable_progress_bar,
                 unit="files",
                 desc="Files processed",
                 bar_format=self.bar_format,
-        ):
-            log_object = aws_service_helper.s3_get_object(log_bucket, filename)
-            log_file = gzip.GzipFile(fileobj=log_object.get()["Body"])
-
-            parse_log(
-                log_file,
-                filename,
-                connections,
-                last_connections,
-                logs,
-                databases,
-                start_time,
-                end_time,
-            )
+            ))
+            if decompress:
+                for filename, log_content in fetched_logs:
+                    parse_log(
+                        io.BytesIO(log_content),
+                        filename,
+                        connections,
+                        last_connections,
+                        logs,
+                        databases,
+                        start_time,
+                        end_time,
+                    )
+            else:
+                logger.info(f"Parsing with {parse_processes} processes")
+                parse_log_files(
+                    fetched_logs,
+                    connections,
+                    last_connections,
+                    logs,
+                    databases,
+                    start_time,
+                    end_time,
+                    parse_processes,
+                )
+
+        self._log_throughput(len(log_filenames), downloaded_bytes, time.monotonic() - fetch_start)
 
         logger.debug(
             f'First audit log in start_time range: {audit_objects[curr_index]["Key"].split("/")[-1]}'
         )
         return connections, logs, databases, last_connections
+
+    @staticmethod
+    def _fetch_log(s3_client, log_bucket, filename, decompress=True):
+        """
+        Download and optionally decompress a single audit log file
+        :param s3_client: shared boto3 S3 client
+        :param log_bucket:
+        :param filename: key of the log file
+        :param decompress: whether to return the decompressed content
+        :return: filename, compressed size in bytes, file content
+        """
+        log_object = aws_service_helper.s3_read_object(log_bucket, filename, s3_client)
+        if decompress:
+            return filename, len(log_object), gzip.decompress(log_object)
+        return filename, len(log_object), log_object
+
+    @staticmethod
+    def _log_throughput(num_files, num_bytes, elapsed_sec):
+        elapsed_sec = max(elapsed_sec, 1e-6)
+        logger.info(
+            f"Processed {num_files} files ({num_bytes / 1024 ** 2:.1f} MB) in {elapsed_sec:.1f} sec: "
+            f"{num_files / elapsed_sec:.1f} files/s, {num_bytes / 1024 ** 2 / elapsed_sec:.2f} MB/s"
+        )
@@ -130,6 +130,11 @@ def s3_put_object(file_content, bucket, key):
     )
 
 
+def s3_delete_object(bucket, key):
+    s3 = boto3.client("s3")
+    s3.delete_object(Bucket=bucket, Key=key)
+
+
 def s3_get_bucket_contents(bucket, prefix):
     conn = boto3.client("s3")
 
@@ -161,6 +166,20 @@ def s3_get_object(bucket, filename):
     s3 = boto3.resource("s3")
     return s3.Object(bucket, filename)
 
+
+def s3_get_client():
+    return boto3.client("s3")
+
+
+def s3_read_object(bucket, filename, s3_client=None):
+    """
+    Read the whole content of an S3 object. boto3 clients are thread safe but creating them
+    is not, so callers reading from several threads should pass in a shared client
+    """
+    if s3_client is None:
+        s3_client = s3_get_client()
+    return s3_client.get_object(Bucket=bucket, Key=filename)["Body"].read()
+
 def glue_get_table(database, table, region):
     table_get_response = boto3.client("glue", region).get_table(
             DatabaseName=database,Name=table,
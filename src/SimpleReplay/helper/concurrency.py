@@ -0,0 +1,21 @@
+from collections import deque
+
+
+def ordered_map(executor, fn, iterable, max_pending):
+    """
+    Like executor.map, but keeps at most max_pending tasks in flight. Results are
+    yielded in input order, so callers can merge them deterministically without
+    the whole input being buffered in memory
+    :param executor: concurrent.futures executor to run fn on
+    :param fn: function applied to each item
+    :param iterable: input items, consumed lazily
+    :param max_pending: maximum number of submitted but not yet consumed tasks
+    :return: generator of fn results in input order
+    """
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
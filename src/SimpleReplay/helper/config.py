@@ -129,3 +129,17 @@ def validate_config_file_for_extract(config):
             'example. '
         )
         exit(-1)
+    if config.get("workload_format", "json") not in ("json", "jsonl", "parquet"):
+        logger.error(
+            'Config file value for "workload_format" must be one of "json", "jsonl" or "parquet".'
+        )
+        exit(-1)
+    if config.get("workload_format") == "parquet":
+        try:
+            import pyarrow
+        except ImportError:
+            logger.error(
+                'Error importing pyarrow. Please ensure pyarrow is correctly installed or set "workload_format" to '
+                '"json" or "jsonl". '
+            )
+            exit(-1)
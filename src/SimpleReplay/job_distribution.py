@@ -0,0 +1,46 @@
+"""
+job_distribution.py
+====================================
+This module hands out replay jobs to the worker processes without the Manager queue. The
+workload is loaded before the workers are forked, so every worker already holds all the
+connections to replay, and only needs to know which one to replay next. That's the value of a
+counter in shared memory, which a worker takes and increments under its lock, instead of a
+pickle round trip through the Manager server process for every connection.
+"""
+
+import multiprocessing
+from queue import Empty
+
+
+class SharedJobCounter:
+    """
+    Hands out the indexes of num_jobs connections in order, through a counter in shared memory.
+    Implements the parts of the queue interface used by the replay workers, so it can take the
+    place of the job queue: get() returns {"job_id": idx} jobs, to be resolved by the worker from
+    the connections it inherited, and False once all jobs are taken.
+    """
+
+    def __init__(self, num_jobs):
+        self.num_jobs = num_jobs
+        self.next_job = multiprocessing.Value("q", 0)
+
+    def get(self, block=True, timeout=None):
+        with self.next_job.get_lock():
+            job_id = self.next_job.value
+            if job_id >= self.num_jobs:
+                return False
+            self.next_job.value = job_id + 1
+        return {"job_id": job_id}
+
+    def get_nowait(self):
+        job = self.get(block=False)
+        if job is False:
+            raise Empty
+        return job
+
+    def remaining(self):
+        """Number of jobs not taken by a worker yet"""
+        return max(self.num_jobs - self.next_job.value, 0)
+
+    def empty(self):
+        return self.remaining() == 0
@@ -0,0 +1,207 @@
+"""
+metrics_endpoint.py
+====================================
+This module serves the live figures of a running replay over HTTP, in the Prometheus text
+exposition format, so they can be scraped and graphed next to the metrics of the target
+cluster. The server runs in a thread of the replay manager process, and builds the response
+from the stats the workers keep in shared memory, so scraping doesn't slow the workers down.
+"""
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from replay_metrics import BUCKET_BOUNDS_MS
+
+logger = logging.getLogger("SimpleReplayLogger")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsWriter:
+    """Builds a response in the Prometheus text exposition format"""
+
+    def __init__(self, prefix="simplereplay_"):
+        self.prefix = prefix
+        self.lines = []
+
+    def add(self, name, metric_type, help_text, samples):
+        """
+        Add a metric
+        :param name: metric name, without the prefix
+        :param metric_type: counter, gauge or histogram
+        :param help_text: description of the metric
+        :param samples: list of (suffix, labels dict, value)
+        """
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        for suffix, labels, value in samples:
+            self.lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+
+    def add_histogram(self, name, help_text, state, labels=None):
+        """Add a histogram in milliseconds, as given by LatencyHistogram.to_dict(), converted to
+        seconds"""
+        labels = labels or {}
+        samples = []
+        cumulative = 0
+        for bound_ms, count in zip(BUCKET_BOUNDS_MS, state["counts"]):
+            cumulative += count
+            samples.append(("_bucket", dict(labels, le=format_value(bound_ms / 1000.0)), cumulative))
+        cumulative += state["counts"][-1]
+        samples.append(("_bucket", dict(labels, le="+Inf"), cumulative))
+        samples.append(("_sum", labels, state["sum_ms"] / 1000.0))
+        samples.append(("_count", labels, cumulative))
+        self.add(name, "histogram", help_text, samples)
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsServer:
+    """
+    HTTP server answering every GET request with the text returned by collect(). Runs in a
+    daemon thread until stop() is called.
+    """
+
+    def __init__(self, host, port, collect):
+        collect_metrics = collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    body = collect_metrics().encode("utf-8")
+                except Exception as e:
+                    logger.debug(f"Failed to collect metrics: {e}")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics request: {format % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Serving replay metrics at {self.address}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def replay_metrics(stats, query_counts, active_connections, peak_connections, queued_jobs):
+    """
+    Metrics of a running replay
+    :param stats: aggregated stats of the workers, as given by SharedStats.snapshot()
+    :param query_counts: queries executed per (username, database)
+    :param active_connections: number of connections currently open
+    :param peak_connections: peak number of open connections since the last progress report
+    :param queued_jobs: number of connections not yet taken by a worker, or None if unknown
+    :return: response text
+    """
+    metrics = MetricsWriter()
+    metrics.add(
+        "queries_total",
+        "counter",
+        "Queries replayed, by outcome",
+        [
+            ("", {"status": "success"}, stats["query_success"]),
+            ("", {"status": "error"}, stats["query_error"]),
+        ],
+    )
+    metrics.add(
+        "transactions_total",
+        "counter",
+        "Transactions replayed, by outcome",
+        [
+            ("", {"status": "success"}, stats["transaction_success"]),
+            ("", {"status": "error"}, stats["transaction_error"]),
+        ],
+    )
+    metrics.add(
+        "statements_executed_total",
+        "counter",
+        "Statements executed, counting each statement of a multi-statement query",
+        [("", {}, stats["executed_queries"])],
+    )
+    metrics.add(
+        "user_queries_total",
+        "counter",
+        "Queries executed, by user and database",
+        [
+            ("", {"user": username, "database": database}, count)
+            for (username, database), count in sorted(query_counts.items())
+        ],
+    )
+    metrics.add(
+        "connections_active",
+        "gauge",
+        "Connections currently open",
+        [("", {}, active_connections)],
+    )
+    metrics.add(
+        "connections_peak",
+        "gauge",
+        "Peak number of open connections since the last progress report",
+        [("", {}, peak_connections)],
+    )
+    metrics.add(
+        "connections_total",
+        "counter",
+        "Connections opened or leased from a connection pool",
+        [
+            ("", {"source": "opened"}, stats["connections_opened"]),
+            ("", {"source": "pool"}, stats["connections_reused"]),
+        ],
+    )
+    if queued_jobs is not None:
+        metrics.add(
+            "queued_connections",
+            "gauge",
+            "Connections waiting to be taken by a worker",
+            [("", {}, queued_jobs)],
+        )
+    metrics.add_histogram(
+        "scheduling_lag_seconds",
+        "How late queries started compared to the extracted workload",
+        stats["scheduling_lag_ms"],
+    )
+    metrics.add_histogram(
+        "connection_lag_seconds",
+        "How late connections started compared to the extracted workload",
+        stats["connection_lag_ms"],
+    )
+    metrics.add_histogram(
+        "connect_seconds", "Time to open or lease a connection", stats["connect_ms"]
+    )
+    metrics.add_histogram("query_seconds", "Time to execute a statement", stats["query_ms"])
+    return metrics.text()
@@ -0,0 +1,246 @@
+"""
+parquet_workload.py
+====================================
+This module reads and writes the columnar (Parquet) form of an extracted workload. The workload
+is stored as two tables, one row per transaction and one row per query, so it can be filtered
+by database, user or pid without deserializing every transaction, and queried directly for
+workload analysis. pyarrow is only needed when this format is used.
+"""
+
+import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from timestamp_parsing import parse_iso_time
+
+TRANSACTIONS_FILENAME = "SQLs.transactions.parquet"
+QUERIES_FILENAME = "SQLs.queries.parquet"
+
+# replay filter name -> archive column
+FILTER_COLUMNS = {"database_name": "db", "username": "user", "pid": "pid"}
+
+# low cardinality columns, stored and loaded dictionary encoded
+DICTIONARY_COLUMNS = ["db", "user", "pid"]
+
+_TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+TRANSACTIONS_SCHEMA = pa.schema(
+    [
+        ("xid", pa.string()),
+        ("pid", pa.string()),
+        ("db", pa.string()),
+        ("user", pa.string()),
+        ("time_interval", pa.bool_()),
+        ("start_time", _TIMESTAMP),
+        ("end_time", _TIMESTAMP),
+        ("num_queries", pa.int32()),
+    ]
+)
+
+QUERIES_SCHEMA = pa.schema(
+    [
+        ("xid", pa.string()),
+        ("pid", pa.string()),
+        ("db", pa.string()),
+        ("user", pa.string()),
+        ("record_time", _TIMESTAMP),
+        ("start_time", _TIMESTAMP),
+        ("end_time", _TIMESTAMP),
+        ("text", pa.string()),
+    ]
+)
+
+ROW_GROUP_SIZE = 100000
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _to_time(value):
+    return parse_iso_time(value) if value else None
+
+
+def _column_values(column):
+    """
+    Convert an arrow column to python values. pyarrow's own conversion is slow for dictionary
+    and timezone aware timestamp columns, so those are decoded from their indices and epoch
+    values instead
+    """
+    if pa.types.is_dictionary(column.type):
+        dictionary = column.dictionary.to_pylist()
+        return [None if i is None else dictionary[i] for i in column.indices.to_pylist()]
+    if pa.types.is_timestamp(column.type):
+        return [
+            None if value is None else _EPOCH + datetime.timedelta(microseconds=value)
+            for value in column.cast(pa.int64()).to_pylist()
+        ]
+    return column.to_pylist()
+
+
+class _TableWriter:
+    """Buffers rows column-wise and writes them out a row group at a time"""
+
+    def __init__(self, filename, schema, row_group_size):
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.columns = {name: [] for name in schema.names}
+        self.writer = pq.ParquetWriter(
+            filename, schema, compression="zstd", use_dictionary=DICTIONARY_COLUMNS
+        )
+
+    def append(self, row):
+        for name, column in self.columns.items():
+            column.append(row[name])
+        if len(self.columns["xid"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.columns["xid"]:
+            self.writer.write_table(pa.table(self.columns, schema=self.schema))
+            self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def write_transactions(transactions, transactions_filename, queries_filename, row_group_size=ROW_GROUP_SIZE):
+    """
+    Writes transactions, as generated by Extractor.iter_sql_transactions, to the transactions
+    and queries tables. Rows are written as they come, so the workload is never held in memory
+    :param transactions: iterable of transaction dicts
+    :param transactions_filename: local path of the transactions table
+    :param queries_filename: local path of the queries table
+    :param row_group_size: number of rows buffered before a row group is written
+    :return: number of transactions written
+    """
+    transactions_writer = _TableWriter(transactions_filename, TRANSACTIONS_SCHEMA, row_group_size)
+    queries_writer = _TableWriter(queries_filename, QUERIES_SCHEMA, row_group_size)
+    count = 0
+    try:
+        for transaction in transactions:
+            query_rows = []
+            for query in transaction["queries"]:
+                record_time = _to_time(query["record_time"])
+                query_rows.append(
+                    {
+                        "xid": transaction["xid"],
+                        "pid": transaction["pid"],
+                        "db": transaction["db"],
+                        "user": transaction["user"],
+                        "record_time": record_time,
+                        "start_time": _to_time(query["start_time"]),
+                        "end_time": _to_time(query["end_time"]),
+                        "text": query["text"],
+                    }
+                )
+                queries_writer.append(query_rows[-1])
+
+            transactions_writer.append(
+                {
+                    "xid": transaction["xid"],
+                    "pid": transaction["pid"],
+                    "db": transaction["db"],
+                    "user": transaction["user"],
+                    "time_interval": transaction["time_interval"],
+                    "start_time": min(
+                        (row["start_time"] or row["record_time"] for row in query_rows), default=None
+                    ),
+                    "end_time": max(
+                        (row["end_time"] or row["record_time"] for row in query_rows), default=None
+                    ),
+                    "num_queries": len(query_rows),
+                }
+            )
+            count += 1
+    finally:
+        transactions_writer.close()
+        queries_writer.close()
+    return count
+
+
+def filters_to_expression(filters):
+    """
+    Translate normalized replay filters into the pyarrow DNF filter format, so they are pushed
+    down into the Parquet reader
+    :param filters: filters as returned by replay.validate_and_normalize_filters
+    :return: list of predicates ANDed together, or None if the filters match everything
+    """
+    predicates = []
+    for name, column in FILTER_COLUMNS.items():
+        include = filters["include"].get(name, ["*"])
+        exclude = filters["exclude"].get(name, [])
+        if "*" not in include:
+            predicates.append((column, "in", [str(value) for value in include]))
+        if exclude:
+            predicates.append((column, "not in", [str(value) for value in exclude]))
+    return predicates or None
+
+
+def read_transactions(workload_directory, filters, start_time=None, end_time=None):
+    """
+    Lazily yields the transactions matching filters, each a dict in the same shape as the JSON
+    archive but with datetime values for the query times
+    :param workload_directory: local or S3 workload location
+    :param filters: filters as returned by replay.validate_and_normalize_filters
+    :param start_time: only transactions starting at or after this time are read, if set
+    :param end_time: only transactions starting before this time are read, if set
+    :return: generator of transaction dicts
+    """
+    prefix = workload_directory.rstrip("/") + "/"
+    expression = filters_to_expression(filters)
+
+    transaction_expression = list(expression or [])
+    if start_time:
+        transaction_expression.append(("start_time", ">=", start_time))
+    if end_time:
+        transaction_expression.append(("start_time", "<", end_time))
+
+    transactions = pq.read_table(
+        prefix + TRANSACTIONS_FILENAME,
+        columns=["xid", "time_interval"],
+        filters=transaction_expression or None,
+    )
+    time_intervals = dict(
+        zip(
+            transactions.column("xid").to_pylist(),
+            transactions.column("time_interval").to_pylist(),
+        )
+    )
+
+    if start_time or end_time:
+        if not time_intervals:
+            return
+        # the window applies to transaction start times, so queries are selected by transaction
+        expression = list(expression or []) + [("xid", "in", list(time_intervals))]
+
+    queries = pq.read_table(
+        prefix + QUERIES_FILENAME, filters=expression, read_dictionary=DICTIONARY_COLUMNS
+    )
+
+    # queries of a transaction are stored contiguously, so they are grouped on xid changes
+    transaction = None
+    for batch in queries.to_batches():
+        columns = {name: _column_values(batch.column(name)) for name in batch.schema.names}
+        for i, xid in enumerate(columns["xid"]):
+            if transaction is None or transaction["xid"] != xid:
+                if transaction is not None:
+                    yield transaction
+                transaction = {
+                    "xid": xid,
+                    "pid": columns["pid"][i],
+                    "db": columns["db"][i],
+                    "user": columns["user"][i],
+                    "time_interval": time_intervals.get(xid, True),
+                    "queries": [],
+                }
+            transaction["queries"].append(
+                {
+                    "record_time": columns["record_time"][i],
+                    "start_time": columns["start_time"][i],
+                    "end_time": columns["end_time"][i],
+                    "text": columns["text"][i],
+                }
+            )
+    if transaction is not None:
+        yield transaction
@@ -0,0 +1,130 @@
+"""
+query_fingerprint.py
+====================================
+This module fingerprints query texts, to match the same query across replays. A query text is
+normalized first: comments (including the replay tag) are dropped, string and numeric literals
+become ?, IN lists and multi-row VALUES lists are collapsed, and whitespace and case are
+folded. The normalized text is hashed with BLAKE2b, so a fingerprint is the same in any process
+and any run, unlike the built-in hash(). The fingerprint index of a replay holds the latency
+percentiles of each fingerprint, and is written with the replay analysis output, so replays can
+be compared per fingerprint without reading their full query history.
+"""
+
+import hashlib
+import re
+
+import numpy as np
+import pandas as pd
+
+# file of the fingerprint index, in the aggregated_data/ folder of a replay analysis
+FINGERPRINT_INDEX_FILE = "query_fingerprints.csv"
+
+# single quoted strings, which may contain doubled quotes, double quoted identifiers, which are
+# kept as they are, and comments. Matched in one pass, so comment markers in strings are ignored
+_STRING_OR_COMMENT_PATTERN = re.compile(
+    r"('(?:[^']|'')*')|(\"(?:[^\"]|\"\")*\")|(/\*.*?\*/|--[^\n]*)", re.DOTALL
+)
+_NUMBER_PATTERN = re.compile(r"(?<![\w$.])[-+]?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?(?![\w$])", re.IGNORECASE)
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_LIST_PATTERN = r"\(\s*\?(?:\s*,\s*\?)*\s*\)"
+_IN_LIST_PATTERN = re.compile(r"\bin\s*" + _LIST_PATTERN)
+_VALUES_LIST_PATTERN = re.compile(r"\bvalues\s*" + _LIST_PATTERN + r"(?:\s*,\s*" + _LIST_PATTERN + r")*")
+
+
+def _replace_string_or_comment(match):
+    if match.group(1) is not None:
+        return "?"
+    if match.group(2) is not None:
+        return match.group(2)
+    return " "
+
+
+def normalize_query(query_text):
+    """
+    Normalized text of a query, the same for all executions of a query with different literals
+    :param query_text: query text
+    :return: normalized text
+    """
+    text = _STRING_OR_COMMENT_PATTERN.sub(_replace_string_or_comment, query_text)
+    text = _NUMBER_PATTERN.sub("?", text)
+    text = _WHITESPACE_PATTERN.sub(" ", text).strip().rstrip(";").strip().lower()
+    text = _IN_LIST_PATTERN.sub("in (?)", text)
+    return _VALUES_LIST_PATTERN.sub("values (?)", text)
+
+
+def fingerprint(normalized_text):
+    """Fingerprint of a normalized query text, as a signed 64 bit integer"""
+    digest = hashlib.blake2b(normalized_text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def fingerprint_queries(query_texts):
+    """
+    Fingerprints of a column of query texts. Each distinct text is normalized and hashed once
+    :param query_texts: Series of query texts
+    :return: (Series of fingerprints, Series of normalized texts), with the index of query_texts
+    """
+    codes, texts = pd.factorize(query_texts.astype(str))
+    normalized = [normalize_query(text) for text in texts]
+    fingerprints = [fingerprint(text) for text in normalized]
+    return (
+        pd.Series(pd.Index(fingerprints, dtype="int64").take(codes), index=query_texts.index),
+        pd.Series(pd.Index(normalized, dtype=object).take(codes), index=query_texts.index),
+    )
+
+
+def fingerprint_index(query_texts, elapsed_ms, execution_ms):
+    """
+    Latency percentiles of each fingerprint of a replay
+    :param query_texts: Series of query texts
+    :param elapsed_ms: Series of elapsed times, in milliseconds
+    :param execution_ms: Series of execution times, in milliseconds
+    :return: DataFrame with one row per fingerprint, most executed first
+    """
+    fingerprints, normalized = fingerprint_queries(query_texts)
+    data = pd.DataFrame(
+        {
+            "fingerprint": fingerprints,
+            "query_text": normalized,
+            "elapsed_time": elapsed_ms.astype(float),
+            "execution_time": execution_ms.astype(float),
+        }
+    )
+    grouped = data.groupby("fingerprint", sort=False)
+    index = pd.DataFrame(
+        {
+            "query_text": grouped["query_text"].first(),
+            "queries": grouped.size(),
+            "elapsed_time_p50": grouped["elapsed_time"].quantile(0.5),
+            "elapsed_time_p95": grouped["elapsed_time"].quantile(0.95),
+            "elapsed_time_total": grouped["elapsed_time"].sum(),
+            "execution_time_p50": grouped["execution_time"].quantile(0.5),
+            "execution_time_p95": grouped["execution_time"].quantile(0.95),
+        }
+    )
+    return index.sort_values(by="queries", ascending=False, kind="stable").reset_index()
+
+
+def compare_fingerprints(baseline_index, target_index):
+    """
+    Latency changes of the fingerprints executed in both replays
+    :param baseline_index: fingerprint index of the baseline replay
+    :param target_index: fingerprint index of the target replay
+    :return: DataFrame of the columns of both indexes, suffixed _b and _t, and the change of each
+    percentile in milliseconds (_delta) and in percent of the baseline (_diff), largest change of
+    the median elapsed time first
+    """
+    df = pd.merge(
+        left=baseline_index,
+        right=target_index,
+        on="fingerprint",
+        how="inner",
+        suffixes=("_b", "_t"),
+    )
+    for column in ["elapsed_time_p50", "elapsed_time_p95", "execution_time_p50", "execution_time_p95"]:
+        df[f"{column}_delta"] = df[f"{column}_t"] - df[f"{column}_b"]
+        # a baseline of 0 ms has no relative change
+        df[f"{column}_diff"] = ((df[f"{column}_b"] - df[f"{column}_t"]) / df[f"{column}_b"] * 100).replace(
+            [np.inf, -np.inf], np.nan
+        )
+    return df.reindex(df["elapsed_time_p50_delta"].abs().sort_values(ascending=False).index)
@@ -0,0 +1,166 @@
+"""
+query_rewriter.py
+====================================
+This module rewrites the text of extracted queries before they are replayed: COPY statements get
+their replacement S3 location and IAM role from copy_replacements.csv, UNLOAD statements are
+pointed at the replay output location, and CREATE USER statements get a random password in place
+of the masked one. All rules are applied in a single pass over each query, with precompiled
+patterns, and queries that can't match any rule are skipped after two substring checks.
+"""
+
+import os
+import random
+import re
+import string
+from collections import Counter
+
+# rule names, as reported in the rewrite counts
+COPY_RULE = "copy"
+UNLOAD_RULE = "unload"
+CREATE_USER_PASSWORD_RULE = "create_user_password"
+
+_COPY_FROM_PATTERN = re.compile(r"from 's3:\/\/[^']*", re.IGNORECASE)
+_UNLOAD_TO_PATTERN = re.compile(r"to 's3:\/\/[^']*", re.IGNORECASE)
+
+# credentials of an UNLOAD statement, replaced by the IAM role of the replay. Longer
+# alternatives come first, so they win over their prefixes
+_UNLOAD_CREDENTIALS_PATTERN = re.compile(
+    r"ACCESS_KEY_ID '' SECRET_ACCESS_KEY '' SESSION_TOKEN ''"
+    r"|ACCESS_KEY_ID '' SECRET_ACCESS_KEY ''"
+    r"|with credentials as ''"
+    r"|credentials ''"
+    r"|IAM_ROLE 'arn:aws:iam::\d+:role/\S+'"
+    r"|IAM_ROLE ''",
+    re.IGNORECASE,
+)
+
+# credentials of a COPY statement, which also may have an empty iam_role
+_COPY_CREDENTIALS_PATTERN = re.compile(
+    _UNLOAD_CREDENTIALS_PATTERN.pattern + r"|iam_role''", re.IGNORECASE
+)
+
+_MASKED_PASSWORD_PATTERN = re.compile(r"PASSWORD '\*\*\*'", re.IGNORECASE)
+
+_PASSWORD_CHARACTERS = string.ascii_uppercase + string.ascii_lowercase + string.digits
+
+# reseeded in forked processes, so they don't generate the same passwords
+_password_random = random.Random()
+os.register_at_fork(after_in_child=_password_random.seed)
+
+
+class RewriteError(Exception):
+    pass
+
+
+class QueryRewriter:
+    """
+    Rewrites query texts according to the enabled rules. Instances are picklable, so the same
+    rewriter can be shipped to a pool of processes
+    :param copy_replacements: COPY replacements, mapping the original S3 location to its
+    [replacement location, IAM role], or None to leave COPY statements as they are
+    :param unload_location: location UNLOADs are written to, or None to leave UNLOAD statements
+    as they are
+    :param unload_iam_role: IAM role used by the rewritten UNLOAD statements
+    :param create_user_password: whether masked CREATE USER passwords are replaced
+    """
+
+    def __init__(
+        self,
+        copy_replacements=None,
+        unload_location=None,
+        unload_iam_role=None,
+        create_user_password=True,
+    ):
+        self.copy_replacements = copy_replacements
+        self.unload_location = unload_location
+        self.unload_iam_role = unload_iam_role
+        self.create_user_password = create_user_password
+
+    def rewrite(self, text, counts, unmatched_copy_locations):
+        """
+        Apply all enabled rules to a query text
+        :param text: query text
+        :param counts: Counter of the statements rewritten by each rule, updated in place
+        :param unmatched_copy_locations: set of COPY locations with no replacement, updated in
+        place
+        :return: the rewritten text
+        """
+        lower_text = text.lower()
+        # any query a rule applies to contains one of these
+        if "'s3:" not in lower_text and "create user" not in lower_text:
+            return text
+
+        if (
+            self.copy_replacements is not None
+            and "copy " in lower_text
+            and "from 's3:" in lower_text
+        ):
+            text = self._rewrite_copy(text, counts, unmatched_copy_locations)
+            lower_text = text.lower()
+
+        if (
+            self.unload_location is not None
+            and "unload" in lower_text
+            and "to 's3:" in lower_text
+        ):
+            text = self._rewrite_unload(text, counts)
+
+        if self.create_user_password and "create user" in lower_text:
+            text, replaced = _MASKED_PASSWORD_PATTERN.subn(_random_password, text)
+            if replaced:
+                counts[CREATE_USER_PASSWORD_RULE] += 1
+
+        return text
+
+    def _rewrite_copy(self, text, counts, unmatched_copy_locations):
+        from_text = _COPY_FROM_PATTERN.search(text)
+        if not from_text:
+            return text
+        existing_location = from_text.group()[6:]
+
+        replacement = self.copy_replacements.get(existing_location)
+        if replacement is None:
+            unmatched_copy_locations.add(existing_location)
+            return text
+        replacement_location, iam_role = replacement
+        if not iam_role:
+            raise RewriteError(
+                f"COPY replacement {existing_location} is missing IAM role or credentials"
+            )
+
+        text = text.replace(existing_location, replacement_location or existing_location)
+        text = _COPY_CREDENTIALS_PATTERN.sub(f" IAM_ROLE '{iam_role}'", text)
+        counts[COPY_RULE] += 1
+        return text
+
+    def _rewrite_unload(self, text, counts):
+        to_text = _UNLOAD_TO_PATTERN.search(text)
+        if not to_text or not to_text.group()[9:]:
+            return text
+        existing_location = to_text.group()[4:]
+        replacement_location = self.unload_location + "/UNLOADs/" + to_text.group()[9:]
+
+        new_text = text.replace(existing_location, replacement_location)
+        if new_text == text:
+            return text
+        text = _UNLOAD_CREDENTIALS_PATTERN.sub(f" IAM_ROLE '{self.unload_iam_role}'", new_text)
+        counts[UNLOAD_RULE] += 1
+        return text
+
+
+def _random_password(match):
+    return f"PASSWORD '{''.join(_password_random.choices(_PASSWORD_CHARACTERS, k=61))}aA0'"
+
+
+def rewrite_texts(rewriter, texts):
+    """
+    Rewrite a batch of query texts
+    :param rewriter: QueryRewriter
+    :param texts: iterable of query texts
+    :return: (list of rewritten texts, Counter of rewrites per rule, set of COPY locations
+    without a replacement)
+    """
+    counts = Counter()
+    unmatched_copy_locations = set()
+    rewritten = [rewriter.rewrite(text, counts, unmatched_copy_locations) for text in texts]
+    return rewritten, counts, unmatched_copy_locations
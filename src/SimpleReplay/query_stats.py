@@ -0,0 +1,139 @@
+"""
+query_stats.py
+====================================
+This module writes the per statement timings of a replay worker. Connections only append a row
+to an in-memory buffer, which a background thread of the worker writes out in batches, so
+executing a statement never waits on file I/O or on other connections. The timings are written
+to {process_idx}_times.csv, or to {process_idx}_times.parquet when pyarrow is available and the
+"parquet" format is requested.
+"""
+
+import collections
+import threading
+from pathlib import Path
+
+CSV_HEADER = "# process,query,start_time,end_time,elapsed_sec,rows\n"
+
+# how often the background thread writes out buffered rows
+FLUSH_INTERVAL_SEC = 1.0
+
+# Parquet rows are held back until this many are buffered, so row groups aren't tiny
+PARQUET_ROW_GROUP_SIZE = 50000
+
+
+class QueryStatsWriter(threading.Thread):
+    """
+    Buffers the timings of the statements executed by one worker process and writes them out
+    from a background thread. record() may be called from any thread of the worker.
+    """
+
+    def __init__(self, directory, process_idx, output_format="csv", flush_interval_sec=FLUSH_INTERVAL_SEC):
+        threading.Thread.__init__(self, name="query_stats", daemon=True)
+        self.process_idx = process_idx
+        self.output_format = output_format
+        self.flush_interval_sec = flush_interval_sec
+        # appending to and popping from a deque are atomic, so recording a row takes no lock
+        self.pending = collections.deque()
+        self.batch = []
+        self.stopped = threading.Event()
+
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        if output_format == "parquet":
+            self.filename = f"{directory}/{process_idx}_times.parquet"
+            self.parquet_writer = None
+            self.output = None
+        else:
+            self.filename = f"{directory}/{process_idx}_times.csv"
+            self.output = open(self.filename, "a")
+            if self.output.tell() == 0:
+                self.output.write(CSV_HEADER)
+
+    def record(self, query_id, start_time, end_time, rows):
+        """
+        Buffer the timing of one statement
+        :param query_id: {xid}-{statement index}
+        :param start_time: time the statement was sent
+        :param end_time: time it completed, or None if it failed
+        :param rows: number of rows returned or affected, or None if unknown
+        """
+        self.pending.append((query_id, start_time, end_time, rows))
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval_sec):
+            self.flush()
+
+    def flush(self, final=False):
+        while self.pending:
+            self.batch.append(self.pending.popleft())
+        if not self.batch:
+            return
+        if self.output_format == "parquet":
+            if final or len(self.batch) >= PARQUET_ROW_GROUP_SIZE:
+                self._write_parquet(self.batch)
+                self.batch = []
+        else:
+            self._write_csv(self.batch)
+            self.batch = []
+
+    def close(self):
+        """Stop the background thread and write out all remaining rows"""
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.flush(final=True)
+        if self.output is not None:
+            self.output.close()
+        elif self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+    def _write_csv(self, rows):
+        lines = []
+        for query_id, start_time, end_time, row_count in rows:
+            elapsed_sec = 0
+            if end_time is not None:
+                elapsed_sec = "{:.6f}".format((end_time - start_time).total_seconds())
+            lines.append(
+                "{},{},{},{},{},{}\n".format(
+                    self.process_idx,
+                    query_id,
+                    start_time,
+                    end_time,
+                    elapsed_sec,
+                    "" if row_count is None else row_count,
+                )
+            )
+        self.output.write("".join(lines))
+        self.output.flush()
+
+    def _write_parquet(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        timestamp = pa.timestamp("us", tz="UTC")
+        schema = pa.schema(
+            [
+                ("process", pa.int32()),
+                ("query", pa.string()),
+                ("start_time", timestamp),
+                ("end_time", timestamp),
+                ("elapsed_sec", pa.float64()),
+                ("rows", pa.int64()),
+            ]
+        )
+        table = pa.table(
+            {
+                "process": [self.process_idx] * len(rows),
+                "query": [row[0] for row in rows],
+                "start_time": [row[1] for row in rows],
+                "end_time": [row[2] for row in rows],
+                "elapsed_sec": [
+                    (row[2] - row[1]).total_seconds() if row[2] is not None else None
+                    for row in rows
+                ],
+                "rows": [row[3] for row in rows],
+            },
+            schema=schema,
+        )
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.filename, schema, compression="zstd")
+        self.parquet_writer.write_table(table)
@@ -1,8 +1,13 @@
 import argparse
+import asyncio
+import bisect
+import concurrent.futures
 import copy
 import csv
 import datetime
+import functools
 import hashlib
+import heapq
 import json
 import logging
 import multiprocessing
@@ -13,7 +18,6 @@ import signal
 
 import boto3
 import sqlparse
-import string
 import sys
 import threading
 import time
@@ -22,10 +26,10 @@ import yaml
 
 from boto3 import client, resource
 from botocore.exceptions import NoCredentialsError
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from multiprocessing.managers import SyncManager
-from pathlib import Path
 from queue import Empty, Full
 from urllib.parse import urlparse
 
@@ -40,11 +44,30 @@ from util import (
     load_config,
     load_file,
     retrieve_compressed_json,
+    iter_compressed_json_lines,
+    location_exists,
     get_secret,
     parse_error,
     bucket_dict,
 )
 from replay_analysis import run_replay_analysis
+from connection_pool import ConnectionPool, keeps_session_state
+from helper.concurrency import ordered_map
+from job_distribution import SharedJobCounter
+from credential_broker import CredentialBroker
+from query_rewriter import (
+    COPY_RULE,
+    CREATE_USER_PASSWORD_RULE,
+    UNLOAD_RULE,
+    QueryRewriter,
+    RewriteError,
+    rewrite_texts,
+)
+from query_stats import QueryStatsWriter
+from replay_metrics import ErrorChannel, LatencyHistogram, SharedStats, WorkerStats
+from metrics_endpoint import MetricsServer, replay_metrics
+from timestamp_parsing import from_epoch_us, parse_iso_time, parse_iso_time_us, to_epoch_us
+import workload_index
 
 import redshift_connector
 import dateutil.parser
@@ -57,6 +80,20 @@ g_queries_executed = 0
 # map username to credential strings and timestamp
 g_credentials_cache = {}
 
+# shares the credentials fetched by the replay manager with the workers
+g_credential_broker = None
+
+# idle connections of this worker, when sessions are replayed on pooled connections
+g_connection_pool = None
+
+# stats of all workers in shared memory, where workers record the queries of each user and
+# database as they execute them
+g_shared_stats = None
+
+# connections to replay. Workers forked from the replay manager inherit them, so the jobs sent to
+# them only hold the index of the connection
+g_connection_logs = []
+
 g_workers = []
 g_exit = False
 
@@ -64,6 +101,17 @@ g_copy_replacements_filename = "copy_replacements.csv"
 
 g_config = {}
 
+# number of transactions prepared by each task of the statement preparation stage
+PREPARE_BATCH_TRANSACTIONS = 2000
+# smallest workload prepared on a pool of processes. Pickling the batches to and from the pool costs
+# more than preparing them below this, a 200k query workload took 11.6 s on 8 processes and 5.6 s
+# in process
+PREPARE_POOL_MIN_TRANSACTIONS = 500_000
+
+# with the async and scheduler replay engines, how far ahead of their connection time jobs are
+# taken off the queue
+JOB_LOOKAHEAD_SEC = 30
+
 g_replay_timestamp = None
 
 g_is_serverless = False
@@ -76,7 +124,29 @@ g_cluster_endpoint_pattern = (
 )
 
 
+def intern_name(value):
+    """Share one copy of strings that repeat across a workload, like user and database names.
+    Values that aren't strings are returned as they are"""
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+
 class ConnectionLog:
+    __slots__ = (
+        "session_initiation_time",
+        "disconnection_time",
+        "application_name",
+        "database_name",
+        "username",
+        "pid",
+        "query_index",
+        "time_interval_between_transactions",
+        "time_interval_between_queries",
+        "connection_key",
+        "transactions",
+    )
+
     def __init__(
         self,
         session_initiation_time,
@@ -91,10 +161,10 @@ class ConnectionLog:
     ):
         self.session_initiation_time = session_initiation_time
         self.disconnection_time = disconnection_time
-        self.application_name = application_name
-        self.database_name = database_name
-        self.username = username
-        self.pid = pid
+        self.application_name = intern_name(application_name)
+        self.database_name = intern_name(database_name)
+        self.username = intern_name(username)
+        self.pid = intern_name(pid)
         self.query_index = 0
         self.time_interval_between_transactions = time_interval_between_transactions
         self.time_interval_between_queries = time_interval_between_queries
@@ -128,16 +198,26 @@ class ConnectionLog:
 
 
 class Transaction:
+    __slots__ = (
+        "time_interval",
+        "database_name",
+        "username",
+        "pid",
+        "xid",
+        "queries",
+        "transaction_key",
+    )
+
     def __init__(
         self, time_interval, database_name, username, pid, xid, queries, transaction_key
     ):
         self.time_interval = time_interval
-        self.database_name = database_name
-        self.username = username
-        self.pid = pid
+        self.database_name = intern_name(database_name)
+        self.username = intern_name(username)
+        self.pid = intern_name(pid)
         self.xid = xid
         self.queries = queries
-        self.transaction_key = transaction_key
+        self.transaction_key = intern_name(transaction_key)
 
     def __str__(self):
         return (
@@ -172,11 +252,34 @@ class Transaction:
 
 
 class Query:
+    """One query of a transaction. Workloads hold millions of these, so the start and end times
+    are kept as microseconds since the epoch, and identical texts share one string"""
+
+    __slots__ = ("start_us", "end_us", "time_interval", "text", "statements")
+
     def __init__(self, start_time, end_time, text):
-        self.start_time = start_time
-        self.end_time = end_time
+        self.start_us = to_epoch_us(start_time)
+        self.end_us = to_epoch_us(end_time)
         self.time_interval = 0
-        self.text = text
+        self.text = intern_name(text)
+        # tuple of (statement text, whether it is executed), filled in by prepare_statements
+        self.statements = None
+
+    @property
+    def start_time(self):
+        return from_epoch_us(self.start_us)
+
+    @start_time.setter
+    def start_time(self, start_time):
+        self.start_us = to_epoch_us(start_time)
+
+    @property
+    def end_time(self):
+        return from_epoch_us(self.end_us)
+
+    @end_time.setter
+    def end_time(self, end_time):
+        self.end_us = to_epoch_us(end_time)
 
     def __str__(self):
         return "Start time: %s, End time: %s, Time interval: %s, Text: %s" % (
@@ -187,10 +290,14 @@ class Query:
         )
 
     def offset_ms(self, ref_time):
-        return (self.start_time - ref_time).total_seconds() * 1000.0
+        return (self.start_us - to_epoch_us(ref_time)) / 1000.0
+
 
+class ConnectionReplay:
+    """Replays one extracted connection. The replay engines decide when each step is due, and
+    call connect(), execute_query(), finish_transaction() and close() at that time. All of these
+    block on the database."""
 
-class ConnectionThread(threading.Thread):
     def __init__(
         self,
         process_idx,
@@ -205,9 +312,8 @@ class ConnectionThread(threading.Thread):
         num_connections,
         peak_connections,
         connection_semaphore,
-        perf_lock,
+        query_stats,
     ):
-        threading.Thread.__init__(self)
         self.process_idx = process_idx
         self.job_id = job_id
         self.connection_log = connection_log
@@ -220,12 +326,25 @@ class ConnectionThread(threading.Thread):
         self.num_connections = num_connections
         self.peak_connections = peak_connections
         self.connection_semaphore = connection_semaphore
-        self.perf_lock = perf_lock
-
-        prepend_ids_to_logs(self.process_idx, self.job_id + 1)
-
-    @contextmanager
-    def initiate_connection(self, username):
+        self.query_stats = query_stats
+        self.scheduling_lag = LatencyHistogram()
+        self.connect_latency = LatencyHistogram()
+        self.connection_lag = LatencyHistogram()
+        self.query_latency = LatencyHistogram()
+        # connection pool key, if the connection was leased from the worker's pool
+        self.pool_key = None
+        # whether the session left state the pool can't reset, so its connection can't be reused
+        self.keeps_session_state = False
+        self.tag_suffix = statement_tag_suffix(replay_start)
+
+    def save_latencies(self):
+        self.thread_stats["scheduling_lag_ms"] = self.scheduling_lag.to_dict()
+        self.thread_stats["connect_ms"] = self.connect_latency.to_dict()
+        self.thread_stats["connection_lag_ms"] = self.connection_lag.to_dict()
+        self.thread_stats["query_ms"] = self.query_latency.to_dict()
+
+    def connect(self, username):
+        """Open the connection, returning None if it fails"""
         conn = None
 
         # check if this connection is happening at the right time
@@ -248,11 +367,15 @@ class ConnectionThread(threading.Thread):
             f"to {self.connection_log.disconnection_time}, {connection_duration_sec} sec"
         )
 
-        # save the connection difference
+        # save the connection difference. In closed loop mode, all connections are due at the
+        # start and there's no schedule to fall behind
         self.thread_stats["connection_diff_sec"] = connection_diff_sec
+        closed_loop = g_config.get("closed_loop_concurrency") is not None
+        if not closed_loop:
+            self.connection_lag.record(connection_diff_sec * 1000.0)
 
         # and emit a warning if we're behind
-        if abs(connection_diff_sec) > g_config.get("connection_tolerance_sec", 300):
+        if not closed_loop and abs(connection_diff_sec) > g_config.get("connection_tolerance_sec", 300):
             logger.warning(
                 "Connection at {} offset by {:+.3f} sec".format(
                     self.connection_log.session_initiation_time, connection_diff_sec
@@ -281,8 +404,17 @@ class ConnectionThread(threading.Thread):
             username, database=self.connection_log.database_name
         )
 
+        connect_start = time.monotonic()
         try:
-            try:
+            if g_connection_pool is not None:
+                self.pool_key = (interface, username, credentials["database"])
+                conn = g_connection_pool.lease(self.pool_key)
+            if conn is not None:
+                self.thread_stats["connections_reused"] += 1
+                logger.debug(
+                    f"Reusing pooled {interface} connection for PID: {self.connection_log.pid}"
+                )
+            else:
                 conn = db_connect(
                     interface,
                     host=credentials["host"],
@@ -293,52 +425,220 @@ class ConnectionThread(threading.Thread):
                     odbc_driver=credentials["odbc_driver"],
                     drop_return=g_config.get("drop_return"),
                 )
+                self.thread_stats["connections_opened"] += 1
                 logger.debug(
                     f"Connected using {interface} for PID: {self.connection_log.pid}"
                 )
-                self.num_connections.value += 1
-            except Exception as err:
-                hashed_cluster_url = copy.deepcopy(credentials)
-                hashed_cluster_url["password"] = "***"
-                logger.error(
-                    f"({self.job_id + 1}) Failed to initiate connection for {self.connection_log.database_name}-"
-                    f"{self.connection_log.username}-{self.connection_log.pid} ({hashed_cluster_url}): {err}"
-                )
-                self.thread_stats["connection_error_log"][
-                    f"{self.connection_log.database_name}-{self.connection_log.username}-{self.connection_log.pid}"
-                ] = f"{self.connection_log}\n\n{err}"
+            self.connect_latency.record((time.monotonic() - connect_start) * 1000.0)
+            self.num_connections.value += 1
+        except Exception as err:
+            hashed_cluster_url = copy.deepcopy(credentials)
+            hashed_cluster_url["password"] = "***"
+            logger.error(
+                f"({self.job_id + 1}) Failed to initiate connection for {self.connection_log.database_name}-"
+                f"{self.connection_log.username}-{self.connection_log.pid} ({hashed_cluster_url}): {err}"
+            )
+            self.thread_stats["connection_error_log"][
+                f"{self.connection_log.database_name}-{self.connection_log.username}-{self.connection_log.pid}"
+            ] = f"{self.connection_log}\n\n{err}"
+        return conn
+
+    def close(self, conn):
+        """Close the connection, if it was opened, and release its concurrency slot"""
+        logger.debug(f"Context closing for pid: {self.connection_log.pid}")
+        self.save_latencies()
+        if conn is not None and self.pool_key is not None and not self.keeps_session_state:
+            g_connection_pool.release(self.pool_key, conn)
+            logger.debug(f"Returned connection to the pool for PID: {self.connection_log.pid}")
+        elif conn is not None:
+            conn.close()
+            logger.debug(f"Disconnected for PID: {self.connection_log.pid}")
+        self.num_connections.value -= 1
+        if self.connection_semaphore is not None:
+            logger.debug(
+                f"Releasing semaphore ({self.num_connections.value} / "
+                f"{g_config.get('limit_concurrent_connections')} active connections)"
+            )
+            self.connection_semaphore.release()
+
+    @contextmanager
+    def initiate_connection(self, username):
+        conn = None
+        try:
+            conn = self.connect(username)
             yield conn
         except Exception as e:
             logger.error(f"Exception in connect: {e}")
         finally:
-            logger.debug(f"Context closing for pid: {self.connection_log.pid}")
-            if conn is not None:
-                conn.close()
-                logger.debug(f"Disconnected for PID: {self.connection_log.pid}")
-            self.num_connections.value -= 1
-            if self.connection_semaphore is not None:
+            self.close(conn)
+
+    def time_until_transaction_ms(self, idx):
+        """Time to wait before the transaction at idx, preserving the time between transactions"""
+        transaction = self.connection_log.transactions[idx]
+
+        # we can use this if we want to run transactions based on their offset from the start of the replay
+        # time_until_start_ms = transaction.offset_ms(self.first_event_time) -
+        # current_offset_ms(self.replay_start)
+
+        # or use this to preserve the time between transactions
+        if idx == 0:
+            return (
+                transaction.queries[0].start_us
+                - to_epoch_us(self.connection_log.session_initiation_time)
+            ) / 1000.0
+        prev_transaction = self.connection_log.transactions[idx - 1]
+        return (
+            transaction.queries[0].start_us - prev_transaction.queries[-1].end_us
+        ) / 1000.0
+
+    def time_until_query_ms(self, query):
+        """Time until the query is due, relative to the start of the replay"""
+        return query.offset_ms(self.first_event_time) - current_offset_ms(
+            self.replay_start
+        )
+
+    def time_until_disconnect_sec(self):
+        """Time until the connection is due to close, if time between transactions is preserved"""
+        if self.connection_log.time_interval_between_transactions is not True:
+            return 0
+        disconnect_offset_ms = (
+            self.connection_log.disconnection_time - self.first_event_time
+        ).total_seconds() * 1000.0
+        return (disconnect_offset_ms - current_offset_ms(self.replay_start)) / 1000.0
+
+    def save_query_stats(self, starttime, endtime, xid, query_idx, rows=None):
+        self.query_stats.record(f"{xid}-{query_idx}", starttime, endtime, rows)
+
+    def execute_query(
+        self, cursor, connection, transaction, idx, transaction_query_idx, errors
+    ):
+        """Execute the query at idx of the transaction, which may hold several statements.
+        Returns the index of the next statement within the transaction"""
+        query = transaction.queries[idx]
+        if self.connection_log.time_interval_between_transactions is True:
+            # how late the query starts compared to the extracted workload's schedule
+            self.scheduling_lag.record(-self.time_until_query_ms(query))
+        query_start = time.monotonic()
+
+        statements = query.statements
+        if statements is None:
+            # not prepared ahead of the replay
+            statements = prepare_query_statements(query.text, statement_options())
+
+        if len(statements) > 1:
+            self.thread_stats["multi_statements"] += 1
+        self.thread_stats["executed_queries"] += len(statements)
+
+        success = True
+        for s_idx, (sql_text, execute) in enumerate(statements):
+            sql_text = tag_statement(
+                sql_text, transaction.xid, transaction_query_idx, self.tag_suffix
+            )
+            transaction_query_idx += 1
+
+            substatement_txt = ""
+            if len(statements) > 1:
+                substatement_txt = f", Multistatement: {s_idx+1}/{len(statements)}"
+
+            exec_start = datetime.datetime.now(tz=datetime.timezone.utc)
+            exec_end = None
+            rows = None
+            if (
+                execute
+                and self.pool_key is not None
+                and not self.keeps_session_state
+                and keeps_session_state(sql_text)
+            ):
+                logger.debug(
+                    f"Session of PID {transaction.pid} keeps temporary tables or changes its user, its "
+                    f"connection won't be pooled"
+                )
+                self.keeps_session_state = True
+            try:
+                status = ""
+                if execute:
+                    cursor.execute(sql_text)
+                else:
+                    status = "Not "
+                exec_end = datetime.datetime.now(tz=datetime.timezone.utc)
+                if status:
+                    rows = 0
+                else:
+                    self.query_latency.record((exec_end - exec_start).total_seconds() * 1000.0)
+                    if getattr(cursor, "rowcount", -1) >= 0:
+                        # -1 if the driver can't tell the number of rows
+                        rows = cursor.rowcount
+                exec_sec = (exec_end - exec_start).total_seconds()
+
+                logger.debug(
+                    f"{status}Replayed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, XID:{transaction.xid}, Query: {idx+1}/{len(transaction.queries)}{substatement_txt} ({exec_sec} sec)"
+                )
+                success = success & True
+            except Exception as err:
+                success = False
+                errors.append([sql_text, str(err)])
                 logger.debug(
-                    f"Releasing semaphore ({self.num_connections.value} / "
-                    f"{g_config['limit_concurrent_connections']} active connections)"
+                    f"Failed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, "
+                    f"XID:{transaction.xid}, Query: {idx + 1}/{len(transaction.queries)}{substatement_txt}: {err}"
+                )
+                self.error_logger.append(
+                    parse_error(
+                        err,
+                        transaction.username,
+                        g_config["target_cluster_endpoint"].split("/")[-1],
+                        query.text,
+                    )
                 )
-                self.connection_semaphore.release()
+
+            self.save_query_stats(
+                exec_start, exec_end, transaction.xid, transaction_query_idx, rows
+            )
+        if success:
+            self.thread_stats["query_success"] += 1
+        else:
+            self.thread_stats["query_error"] += 1
+        if g_shared_stats is not None:
+            g_shared_stats.record_query(
+                self.process_idx,
+                (transaction.username, transaction.database_name),
+                (time.monotonic() - query_start) * 1000.0,
+            )
+        return transaction_query_idx
+
+    def finish_transaction(self, cursor, connection, transaction, errors):
+        cursor.close()
+        connection.commit()
+
+        if self.thread_stats["query_error"] == 0:
+            self.thread_stats["transaction_success"] += 1
+        else:
+            self.thread_stats["transaction_error"] += 1
+            self.thread_stats["transaction_error_log"][
+                transaction.get_base_filename()
+            ] = errors
+
+
+class ConnectionThread(ConnectionReplay, threading.Thread):
+    """Replays one connection on its own thread, sleeping until each step is due"""
+
+    def __init__(self, *args):
+        ConnectionReplay.__init__(self, *args)
+        threading.Thread.__init__(self)
+
+        prepend_ids_to_logs(self.process_idx, self.job_id + 1)
 
     def run(self):
         try:
             with self.initiate_connection(self.connection_log.username) as connection:
                 if connection:
                     self.execute_transactions(connection)
-                    if self.connection_log.time_interval_between_transactions is True:
-                        disconnect_offset_sec = (
-                            self.connection_log.disconnection_time
-                            - self.first_event_time
-                        ).total_seconds()
-                        if disconnect_offset_sec > current_offset_ms(self.replay_start):
-                            logger.debug(
-                                f"Waiting to disconnect {time_until_disconnect_sec} sec (pid "
-                                f"{self.connection_log.pid})"
-                            )
-                            time.sleep(time_until_disconnect_sec)
+                    time_until_disconnect_sec = self.time_until_disconnect_sec()
+                    if time_until_disconnect_sec > 0:
+                        logger.debug(
+                            f"Waiting to disconnect {time_until_disconnect_sec} sec (pid "
+                            f"{self.connection_log.pid})"
+                        )
+                        time.sleep(time_until_disconnect_sec)
                 else:
                     logger.warning("Failed to connect")
         except Exception as e:
@@ -347,21 +647,7 @@ class ConnectionThread(threading.Thread):
     def execute_transactions(self, connection):
         if self.connection_log.time_interval_between_transactions is True:
             for idx, transaction in enumerate(self.connection_log.transactions):
-                # we can use this if we want to run transactions based on their offset from the start of the replay
-                # time_until_start_ms = transaction.offset_ms(self.first_event_time) -
-                # current_offset_ms(self.replay_start)
-
-                # or use this to preserve the time between transactions
-                if idx == 0:
-                    time_until_start_ms = (
-                        transaction.start_time()
-                        - self.connection_log.session_initiation_time
-                    ).total_seconds() * 1000.0
-                else:
-                    prev_transaction = self.connection_log.transactions[idx - 1]
-                    time_until_start_ms = (
-                        transaction.start_time() - prev_transaction.end_time()
-                    ).total_seconds() * 1000.0
+                time_until_start_ms = self.time_until_transaction_ms(idx)
 
                 # wait for the transaction to start
                 if time_until_start_ms > 10:
@@ -374,47 +660,13 @@ class ConnectionThread(threading.Thread):
             for transaction in self.connection_log.transactions:
                 self.execute_transaction(transaction, connection)
 
-    def save_query_stats(self, starttime, endtime, xid, query_idx):
-        with self.perf_lock:
-            sr_dir = (
-                g_config.get("logging_dir", "simplereplay_logs")
-                + "/"
-                + g_replay_timestamp.isoformat()
-            )
-            Path(sr_dir).mkdir(parents=True, exist_ok=True)
-            filename = f"{sr_dir}/{self.process_idx}_times.csv"
-            elapsed_sec = 0
-            if endtime is not None:
-                elapsed_sec = "{:.6f}".format((endtime - starttime).total_seconds())
-            with open(filename, "a+") as fp:
-                if fp.tell() == 0:
-                    fp.write("# process,query,start_time,end_time,elapsed_sec,rows\n")
-                query_id = f"{xid}-{query_idx}"
-                fp.write(
-                    "{},{},{},{},{},{}\n".format(
-                        self.process_idx, query_id, starttime, endtime, elapsed_sec, 0
-                    )
-                )
-
-    def get_tagged_sql(self, query_text, idx, transaction, connection):
-        json_tags = {
-            "xid": transaction.xid,
-            "query_idx": idx,
-            "replay_start": g_replay_timestamp.isoformat(),
-            "source": g_config.get("source_tag", "SimpleReplay"),
-        }
-
-        return "/* {} */ {}".format(json.dumps(json_tags), query_text)
-
     def execute_transaction(self, transaction, connection):
         errors = []
         cursor = connection.cursor()
 
         transaction_query_idx = 0
         for idx, query in enumerate(transaction.queries):
-            time_until_start_ms = query.offset_ms(
-                self.first_event_time
-            ) - current_offset_ms(self.replay_start)
+            time_until_start_ms = self.time_until_query_ms(query)
             truncated_query = (
                 query.text[:60] + "..." if len(query.text) > 60 else query.text
             ).replace("\n", " ")
@@ -425,97 +677,251 @@ class ConnectionThread(threading.Thread):
             if time_until_start_ms > 10:
                 time.sleep(time_until_start_ms / 1000.0)
 
-            if g_config.get("split_multi", True):
-                split_statements = sqlparse.split(query.text)
-                # exclude empty statements. Some customers' queries have been
-                # found to end in multiple ; characters;
-                split_statements = [_ for _ in split_statements if _ != ";"]
-            else:
-                split_statements = [query.text]
+            transaction_query_idx = self.execute_query(
+                cursor, connection, transaction, idx, transaction_query_idx, errors
+            )
 
-            if len(split_statements) > 1:
-                self.thread_stats["multi_statements"] += 1
-            self.thread_stats["executed_queries"] += len(split_statements)
+            if query.time_interval > 0.0:
+                logger.debug(f"Waiting {query.time_interval} sec between queries")
+                time.sleep(query.time_interval)
 
-            success = True
-            for s_idx, sql_text in enumerate(split_statements):
-                sql_text = self.get_tagged_sql(
-                    sql_text, transaction_query_idx, transaction, connection
-                )
-                transaction_query_idx += 1
+        self.finish_transaction(cursor, connection, transaction, errors)
 
-                substatement_txt = ""
-                if len(split_statements) > 1:
-                    substatement_txt = (
-                        f", Multistatement: {s_idx+1}/{len(split_statements)}"
-                    )
 
-                exec_start = datetime.datetime.now(tz=datetime.timezone.utc)
-                exec_end = None
-                try:
-                    status = ""
-                    if (
-                        g_config["execute_copy_statements"] == "true"
-                        and "from 's3:" in sql_text.lower()
-                    ):
-                        cursor.execute(sql_text)
-                    elif (
-                        g_config["execute_unload_statements"] == "true"
-                        and "to 's3:" in sql_text.lower()
-                        and g_config["replay_output"] is not None
-                    ):
-                        cursor.execute(sql_text)
-                    elif ("from 's3:" not in sql_text.lower()) and (
-                        "to 's3:" not in sql_text.lower()
-                    ):  ## removed condition to exclude bind variables
-                        cursor.execute(sql_text)
-                    else:
-                        status = "Not "
-                    exec_end = datetime.datetime.now(tz=datetime.timezone.utc)
-                    exec_sec = (exec_end - exec_start).total_seconds()
+class AsyncConnectionReplay(ConnectionReplay):
+    """Replays one connection as an asyncio task. Waits are scheduled on the event loop, so a
+    single worker process can hold many idle connections, and only the blocking database calls
+    occupy a thread of the executor."""
+
+    async def run(self, executor):
+        loop = asyncio.get_running_loop()
 
+        def call(fn, *args):
+            return loop.run_in_executor(executor, functools.partial(fn, *args))
+
+        connection = None
+        try:
+            delay_sec = (
+                self.connection_log.offset_ms(self.first_event_time)
+                - current_offset_ms(self.replay_start)
+            ) / 1000.0
+            if delay_sec > 0.01:
+                await asyncio.sleep(delay_sec)
+
+            connection = await call(self.connect, self.connection_log.username)
+            if connection:
+                await self.execute_transactions(connection, call)
+                time_until_disconnect_sec = self.time_until_disconnect_sec()
+                if time_until_disconnect_sec > 0:
                     logger.debug(
-                        f"{status}Replayed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, XID:{transaction.xid}, Query: {idx+1}/{len(transaction.queries)}{substatement_txt} ({exec_sec} sec)"
+                        f"Waiting to disconnect {time_until_disconnect_sec} sec (pid "
+                        f"{self.connection_log.pid})"
                     )
-                    success = success & True
-                except Exception as err:
-                    success = False
-                    errors.append([sql_text, str(err)])
+                    await asyncio.sleep(time_until_disconnect_sec)
+            else:
+                logger.warning("Failed to connect")
+        except Exception as e:
+            logger.error(f"Exception thrown for pid {self.connection_log.pid}: {e}")
+        finally:
+            await call(self.close, connection)
+
+    async def execute_transactions(self, connection, call):
+        for idx, transaction in enumerate(self.connection_log.transactions):
+            if self.connection_log.time_interval_between_transactions is True:
+                time_until_start_ms = self.time_until_transaction_ms(idx)
+                if time_until_start_ms > 10:
                     logger.debug(
-                        f"Failed DB={transaction.database_name}, USER={transaction.username}, PID={transaction.pid}, "
-                        f"XID:{transaction.xid}, Query: {idx + 1}/{len(transaction.queries)}{substatement_txt}: {err}"
-                    )
-                    self.error_logger.append(
-                        parse_error(
-                            err,
-                            transaction.username,
-                            g_config["target_cluster_endpoint"].split("/")[-1],
-                            query.text,
-                        )
+                        f"Waiting {time_until_start_ms / 1000:.1f} sec for transaction to start"
                     )
+                    await asyncio.sleep(time_until_start_ms / 1000.0)
+            await self.execute_transaction(transaction, connection, call)
 
-                self.save_query_stats(
-                    exec_start, exec_end, transaction.xid, transaction_query_idx
-                )
-            if success:
-                self.thread_stats["query_success"] += 1
-            else:
-                self.thread_stats["query_error"] += 1
+    async def execute_transaction(self, transaction, connection, call):
+        errors = []
+        cursor = await call(connection.cursor)
+
+        transaction_query_idx = 0
+        for idx, query in enumerate(transaction.queries):
+            time_until_start_ms = self.time_until_query_ms(query)
+            if time_until_start_ms > 10:
+                await asyncio.sleep(time_until_start_ms / 1000.0)
+
+            transaction_query_idx = await call(
+                self.execute_query,
+                cursor,
+                connection,
+                transaction,
+                idx,
+                transaction_query_idx,
+                errors,
+            )
 
             if query.time_interval > 0.0:
                 logger.debug(f"Waiting {query.time_interval} sec between queries")
-                time.sleep(query.time_interval)
+                await asyncio.sleep(query.time_interval)
 
-        cursor.close()
-        connection.commit()
+        await call(self.finish_transaction, cursor, connection, transaction, errors)
 
-        if self.thread_stats["query_error"] == 0:
-            self.thread_stats["transaction_success"] += 1
+
+class EventScheduler(threading.Thread):
+    """Central scheduler of a worker process. Holds the due events of all its connections in a
+    heap, and hands each one to the execution pool when it is due. Times are offsets in seconds
+    from the start of the replay, measured on the monotonic clock."""
+
+    def __init__(self, replay_start, executor):
+        threading.Thread.__init__(self, name="scheduler", daemon=True)
+        self.executor = executor
+        self.events = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.dispatch_lag = LatencyHistogram()
+        # monotonic clock reading at the start of the replay
+        self.monotonic_start = time.monotonic() - current_offset_ms(replay_start) / 1000.0
+
+    def now(self):
+        return time.monotonic() - self.monotonic_start
+
+    def schedule(self, due_sec, fn, *args):
+        with self.condition:
+            # the sequence number keeps events due at the same time in submission order
+            heapq.heappush(self.events, (due_sec, self.sequence, fn, args))
+            self.sequence += 1
+            self.condition.notify()
+
+    def schedule_now(self, fn, *args):
+        self.schedule(self.now(), fn, *args)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (
+                    not self.events or self.events[0][0] > self.now()
+                ):
+                    timeout = self.events[0][0] - self.now() if self.events else None
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+                due_sec, _, fn, args = heapq.heappop(self.events)
+            self.dispatch_lag.record((self.now() - due_sec) * 1000.0)
+            self.executor.submit(fn, *args)
+
+
+class ScheduledConnectionReplay(ConnectionReplay):
+    """Replays one connection as a sequence of events (connect, transaction start, query,
+    disconnect) on an EventScheduler. Each event schedules the next one once it has run, so
+    the events of a connection never overlap. When the time between transactions is kept,
+    every event is due at its absolute time in the extracted workload, so delays don't add up
+    over the life of the connection."""
+
+    def __init__(self, scheduler, on_finished, *args):
+        ConnectionReplay.__init__(self, *args)
+        self.scheduler = scheduler
+        self.on_finished = on_finished
+        self.connection = None
+        self.cursor = None
+        self.errors = []
+        self.transaction_query_idx = 0
+        self.closed = False
+
+    def keeps_time(self):
+        return self.connection_log.time_interval_between_transactions is True
+
+    def offset_sec(self, time):
+        return (time - self.first_event_time).total_seconds()
+
+    def start(self):
+        self.scheduler.schedule(
+            self.offset_sec(self.connection_log.session_initiation_time), self.run_event, self.on_connect
+        )
+
+    def run_event(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"Exception thrown for pid {self.connection_log.pid}: {e}")
+            if fn != self.on_disconnect:
+                self.on_disconnect()
+
+    def on_connect(self):
+        self.connection = self.connect(self.connection_log.username)
+        if not self.connection:
+            logger.warning("Failed to connect")
+            self.on_disconnect()
+            return
+        self.schedule_transaction(0)
+
+    def schedule_transaction(self, idx):
+        if idx == len(self.connection_log.transactions):
+            if self.keeps_time():
+                self.scheduler.schedule(
+                    self.offset_sec(self.connection_log.disconnection_time),
+                    self.run_event,
+                    self.on_disconnect,
+                )
+            else:
+                self.scheduler.schedule_now(self.run_event, self.on_disconnect)
+            return
+
+        transaction = self.connection_log.transactions[idx]
+        if self.keeps_time():
+            self.scheduler.schedule(
+                self.offset_sec(transaction.start_time()),
+                self.run_event,
+                self.on_transaction_start,
+                idx,
+            )
         else:
-            self.thread_stats["transaction_error"] += 1
-            self.thread_stats["transaction_error_log"][
-                transaction.get_base_filename()
-            ] = errors
+            self.scheduler.schedule_now(self.run_event, self.on_transaction_start, idx)
+
+    def on_transaction_start(self, idx):
+        self.cursor = self.connection.cursor()
+        self.errors = []
+        self.transaction_query_idx = 0
+        self.on_query(idx, 0)
+
+    def schedule_query(self, idx, query_idx, earliest_sec):
+        query = self.connection_log.transactions[idx].queries[query_idx]
+        due_sec = earliest_sec
+        if self.keeps_time():
+            due_sec = max(due_sec, self.offset_sec(query.start_time))
+        self.scheduler.schedule(due_sec, self.run_event, self.on_query, idx, query_idx)
+
+    def on_query(self, idx, query_idx):
+        transaction = self.connection_log.transactions[idx]
+        query = transaction.queries[query_idx]
+        self.transaction_query_idx = self.execute_query(
+            self.cursor,
+            self.connection,
+            transaction,
+            query_idx,
+            self.transaction_query_idx,
+            self.errors,
+        )
+        if query_idx + 1 < len(transaction.queries):
+            self.schedule_query(
+                idx, query_idx + 1, self.scheduler.now() + max(query.time_interval, 0.0)
+            )
+        else:
+            self.finish_transaction(self.cursor, self.connection, transaction, self.errors)
+            self.cursor = None
+            self.schedule_transaction(idx + 1)
+
+    def on_disconnect(self):
+        # the connection is released once, even if closing it or on_finished fails
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.close(self.connection)
+        finally:
+            self.connection = None
+            self.on_finished(self)
 
 
 # exception thrown if any filters are invalid
@@ -618,12 +1024,21 @@ def parse_connections(
     workload_directory,
     time_interval_between_transactions,
     time_interval_between_queries,
+    start_time=None,
+    end_time=None,
 ):
+    """Load the connections matching the filters and connection sampling rate. If a time window
+    is given, or replay_start_offset_sec / replay_end_offset_sec are set, only connections that
+    are open at some point within the window are kept, and their times are clamped to it.
+    Returns the connections, the total number of connections and the replay window"""
     connections = []
 
     # total number of connections before filters are applied
     total_connections = 0
 
+    # time of the earliest connection of the workload, which the window offsets are relative to
+    workload_start_time = None
+
     if workload_directory.startswith("s3://"):
         workload_s3_location = workload_directory[5:].partition("/")
         bucket_name = workload_s3_location[0]
@@ -652,14 +1067,14 @@ def parse_connections(
 
         try:
             if connection_json["session_initiation_time"]:
-                session_initiation_time = dateutil.parser.isoparse(
+                session_initiation_time = parse_iso_time(
                     connection_json["session_initiation_time"]
                 ).replace(tzinfo=datetime.timezone.utc)
             else:
                 session_initiation_time = None
 
             if connection_json["disconnection_time"]:
-                disconnection_time = dateutil.parser.isoparse(
+                disconnection_time = parse_iso_time(
                     connection_json["disconnection_time"]
                 ).replace(tzinfo=datetime.timezone.utc)
             else:
@@ -679,30 +1094,202 @@ def parse_connections(
                 is_time_interval_between_queries,
                 connection_key,
             )
-            if matches_filters(connection, g_config["filters"]):
+            if session_initiation_time and (
+                workload_start_time is None or session_initiation_time < workload_start_time
+            ):
+                workload_start_time = session_initiation_time
+            if matches_filters(connection, g_config["filters"]) and connection_is_sampled(
+                connection.database_name, connection.username, connection.pid
+            ):
                 connections.append(connection)
             total_connections += 1
         except Exception as err:
             logger.error(f"Could not parse connection: \n{str(connection_json)}\n{err}")
 
+    if start_time is None and end_time is None and workload_start_time:
+        if g_config.get("replay_start_offset_sec"):
+            start_time = workload_start_time + datetime.timedelta(
+                seconds=g_config["replay_start_offset_sec"]
+            )
+        if g_config.get("replay_end_offset_sec"):
+            end_time = workload_start_time + datetime.timedelta(
+                seconds=g_config["replay_end_offset_sec"]
+            )
+
+    if start_time or end_time:
+        logger.info(f"Replaying time window {start_time or '*'} to {end_time or '*'}")
+        windowed_connections = []
+        for connection in connections:
+            if (
+                end_time
+                and connection.session_initiation_time
+                and connection.session_initiation_time >= end_time
+            ) or (
+                start_time
+                and connection.disconnection_time
+                and connection.disconnection_time < start_time
+            ):
+                continue
+            # connections opened before the window are opened at its start, so the replay
+            # doesn't wait through the part of the workload outside the window
+            if start_time and (
+                not connection.session_initiation_time
+                or connection.session_initiation_time < start_time
+            ):
+                connection.session_initiation_time = start_time
+            if end_time and (
+                not connection.disconnection_time or connection.disconnection_time > end_time
+            ):
+                connection.disconnection_time = end_time
+            windowed_connections.append(connection)
+        connections = windowed_connections
+
     connections.sort(
         key=lambda connection: connection.session_initiation_time
         or datetime.datetime.utcfromtimestamp(0).replace(tzinfo=datetime.timezone.utc)
     )
 
-    return connections, total_connections
+    return connections, total_connections, (start_time, end_time)
+
+
+def in_time_window(time, start_time=None, end_time=None):
+    """Check if time falls within [start_time, end_time). Either bound may be None"""
+    if start_time and time < start_time:
+        return False
+    if end_time and time >= end_time:
+        return False
+    return True
+
+
+def connection_is_sampled(database_name, username, pid):
+    """Deterministically sample connections by key, so every run with the same
+    connection_sample_rate replays the same connections"""
+    sample_rate = g_config.get("connection_sample_rate")
+    if sample_rate is None or sample_rate >= 1:
+        return True
+    connection_key = get_connection_key(database_name, username, pid)
+    key_hash = int(hashlib.sha1(connection_key.encode("utf-8")).hexdigest()[:8], 16)
+    return key_hash < sample_rate * 0x100000000
+
+
+def connection_matches_filters(database_name, username, pid):
+    return matches_filters(
+        Transaction(None, database_name, username, pid, None, [], None),
+        g_config["filters"],
+    ) and connection_is_sampled(database_name, username, pid)
+
+
+def is_replayed_transaction(transaction, start_time=None, end_time=None):
+    """Check if the transaction is within the time window, filters and connection sample"""
+    return (
+        transaction.start_time()
+        and in_time_window(transaction.start_time(), start_time, end_time)
+        and matches_filters(transaction, g_config["filters"])
+        and connection_is_sampled(
+            transaction.database_name, transaction.username, transaction.pid
+        )
+    )
 
 
-def parse_transactions(workload_directory):
+def parse_transactions(workload_directory, start_time=None, end_time=None):
+    """Load the transactions matching the filters and starting within the optional time window"""
     transactions = []
+    jsonl_path = workload_directory.rstrip("/") + "/" + workload_index.ARCHIVE_FILENAME
+    index_path = workload_directory.rstrip("/") + "/" + workload_index.INDEX_FILENAME
     gz_path = workload_directory.rstrip("/") + "/SQLs.json.gz"
 
-    sql_json = retrieve_compressed_json(gz_path)
-    for xid, transaction_dict in sql_json["transactions"].items():
+    # archive files found, in the order of precedence of their formats
+    archive_paths = [
+        path
+        for path in [
+            workload_directory.rstrip("/") + "/SQLs.queries.parquet",
+            index_path,
+            jsonl_path,
+            gz_path,
+        ]
+        if location_exists(path)
+    ]
+    archive_path = archive_paths[0] if archive_paths else gz_path
+    logger.info(f"Replaying the workload archive {archive_path}")
+    # the index and the chunked archive it indexes are one archive
+    ignored_paths = [
+        path for path in archive_paths[1:] if not (archive_path == index_path and path == jsonl_path)
+    ]
+    if ignored_paths:
+        logger.warning(
+            f"Ignoring the workload archives {', '.join(ignored_paths)}, left in the workload location by an "
+            f"earlier extract. Remove them if they aren't from the same extract as {archive_path}."
+        )
+
+    if archive_path.endswith(".parquet"):
+        return parse_parquet_transactions(workload_directory, start_time, end_time)
+
+    if archive_path == index_path:
+        # chunked archive, only the chunks overlapping the time window and filters are read
+        index = workload_index.read_index(index_path)
+        chunks = workload_index.select_chunks(
+            index, start_time, end_time, connection_matches_filters
+        )
+        logger.info(
+            f"Reading {len(chunks)} of {len(index['chunks'])} workload chunks from {jsonl_path}"
+        )
+        transaction_dicts = workload_index.iter_chunk_transactions(jsonl_path, chunks)
+    elif archive_path == jsonl_path:
+        # streamed archive, decoded one transaction at a time
+        transaction_dicts = iter_compressed_json_lines(jsonl_path)
+    else:
+        transaction_dicts = retrieve_compressed_json(gz_path)["transactions"].values()
+
+    for transaction_dict in transaction_dicts:
         transaction = parse_transaction(transaction_dict)
-        if transaction.start_time() and matches_filters(
-            transaction, g_config["filters"]
-        ):
+        if is_replayed_transaction(transaction, start_time, end_time):
+            transactions.append(transaction)
+
+    transactions.sort(
+        key=lambda transaction: (transaction.start_time(), transaction.xid)
+    )
+
+    return transactions
+
+
+def parse_parquet_transactions(workload_directory, start_time=None, end_time=None):
+    """Load the transactions of a Parquet workload archive. The replay filters and time window
+    are pushed down into the reader, so transactions that are filtered out are never deserialized"""
+    try:
+        import parquet_workload
+    except ImportError:
+        logger.error(
+            'Error importing pyarrow, which is required to replay a Parquet workload archive. Please ensure pyarrow is '
+            'correctly installed, or extract the workload again with "workload_format" set to "json" or "jsonl".'
+        )
+        exit(-1)
+
+    transactions = []
+    for transaction_dict in parquet_workload.read_transactions(
+        workload_directory, g_config["filters"], start_time, end_time
+    ):
+        queries = []
+        for q in transaction_dict["queries"]:
+            queries.append(
+                Query(
+                    q["start_time"] or q["record_time"],
+                    q["end_time"] or q["record_time"],
+                    q["text"],
+                )
+            )
+        queries.sort(key=lambda query: query.start_us)
+        transaction = Transaction(
+            transaction_dict["time_interval"],
+            transaction_dict["db"],
+            transaction_dict["user"],
+            transaction_dict["pid"],
+            transaction_dict["xid"],
+            queries,
+            get_connection_key(
+                transaction_dict["db"], transaction_dict["user"], transaction_dict["pid"]
+            ),
+        )
+        if is_replayed_transaction(transaction, start_time, end_time):
             transactions.append(transaction)
 
     transactions.sort(
@@ -769,15 +1356,16 @@ def parse_transaction(transaction_dict):
     queries = []
 
     for q in transaction_dict["queries"]:
-        start_time = dateutil.parser.isoparse(q["record_time"])
+        record_time = parse_iso_time_us(q["record_time"])
+        start_time = record_time
         if q["start_time"] is not None:
-            start_time = dateutil.parser.isoparse(q["start_time"])
-        end_time = dateutil.parser.isoparse(q["record_time"])
+            start_time = parse_iso_time_us(q["start_time"])
+        end_time = record_time
         if q["end_time"] is not None:
-            end_time = dateutil.parser.isoparse(q["end_time"])
+            end_time = parse_iso_time_us(q["end_time"])
         queries.append(Query(start_time, end_time, q["text"]))
 
-    queries.sort(key=lambda query: query.start_time)
+    queries.sort(key=lambda query: query.start_us)
     transaction_key = get_connection_key(
         transaction_dict["db"], transaction_dict["user"], transaction_dict["pid"]
     )
@@ -839,7 +1427,7 @@ def parse_transaction_old(sql_filename, sql_file_text):
 
     queries.append(Query(query_start_time, query_end_time, query_text.strip()))
 
-    queries.sort(key=lambda query: query.start_time)
+    queries.sort(key=lambda query: query.start_us)
 
     transaction_key = get_connection_key(database_name, username, pid)
     return Transaction(
@@ -895,6 +1483,25 @@ def parse_copy_replacements(workload_directory):
     return copy_replacements
 
 
+# counters kept in the replay stats
+COUNTER_STATS = (
+    "transaction_success",
+    "transaction_error",
+    "query_success",
+    "query_error",
+    "multi_statements",
+    "executed_queries",
+    "connections_opened",
+    "connections_reused",
+)
+
+# latency histograms kept in the replay stats
+LATENCY_STATS = ("scheduling_lag_ms", "connect_ms", "query_ms", "connection_lag_ms")
+
+# stats mapping filenames to the errors of a connection or transaction
+ERROR_LOG_STATS = ("transaction_error_log", "connection_error_log")
+
+
 def collect_stats(aggregated_stats, stats):
     """Aggregate the per-thread stats into the overall stats for this aggregated process"""
 
@@ -908,16 +1515,18 @@ def collect_stats(aggregated_stats, stats):
         aggregated_stats["connection_diff_sec"] = stats["connection_diff_sec"]
 
     # for each aggregated, add up these scalars across all threads
-    for stat in (
-        "transaction_success",
-        "transaction_error",
-        "query_success",
-        "query_error",
-    ):
+    for stat in COUNTER_STATS:
         aggregated_stats[stat] += stats[stat]
 
+    for stat in LATENCY_STATS:
+        aggregated_stats[stat] = (
+            LatencyHistogram(aggregated_stats[stat])
+            .merge(LatencyHistogram(stats[stat]))
+            .to_dict()
+        )
+
     # same for arrays.
-    for stat in ("transaction_error_log", "connection_error_log"):
+    for stat in ERROR_LOG_STATS:
         # note that per the Manager python docs, this extra copy is required to
         # get manager to notice the update
         new_stats = aggregated_stats[stat]
@@ -946,6 +1555,13 @@ def init_stats(stats_dict):
     ] = {}  # map filename to array of transaction errors
     stats_dict["multi_statements"] = 0
     stats_dict["executed_queries"] = 0  # includes multi-statement queries
+    stats_dict["connections_opened"] = 0
+    stats_dict["connections_reused"] = 0  # leased from the connection pool
+    # histograms of how late queries started compared to the extracted workload, of the time to
+    # open or lease a connection, of the time to execute a statement, and of how late
+    # connections started
+    for stat in LATENCY_STATS:
+        stats_dict[stat] = LatencyHistogram().to_dict()
     return stats_dict
 
 
@@ -961,11 +1577,42 @@ def display_stats(
     stats_str += f"Success: {stats['query_success']} ({percent(stats['query_success'], stats['query_success'] + stats['query_error']):.1f}%), "
     stats_str += f"Failed: {stats['query_error']} ({percent(stats['query_error'], stats['query_success'] + stats['query_error']):.1f}%), "
     stats_str += f"Peak connections: {peak_connections.value}"
+    for stat, name in (
+        ("scheduling_lag_ms", "Scheduling lag"),
+        ("connection_lag_ms", "Connection lag"),
+        ("query_ms", "Query latency"),
+    ):
+        latencies = LatencyHistogram(stats[stat])
+        if latencies.count:
+            stats_str += f", {name} p99: {latencies.percentile(99):.0f} ms"
     stats_str += "]"
 
     logger.info(f"{stats_str}")
 
 
+def start_connection_pool():
+    """Create the connection pool of this worker, if sessions are replayed on pooled connections"""
+    global g_connection_pool
+    if g_config.get("connection_pooling"):
+        g_connection_pool = ConnectionPool(g_config.get("connection_pool_max_idle") or 8)
+
+
+def close_connection_pool():
+    if g_connection_pool is not None:
+        g_connection_pool.close()
+
+
+def start_query_stats_writer(process_idx):
+    """Start the background writer of the per statement timings of this worker"""
+    query_stats = QueryStatsWriter(
+        g_config.get("logging_dir", "simplereplay_logs") + "/" + g_replay_timestamp.isoformat(),
+        process_idx,
+        g_config.get("query_stats_format", "csv"),
+    )
+    query_stats.start()
+    return query_stats
+
+
 def join_finished_threads(connection_threads, worker_stats, wait=False):
     # join any finished threads
     finished_threads = []
@@ -973,7 +1620,7 @@ def join_finished_threads(connection_threads, worker_stats, wait=False):
         if not t.is_alive() or wait:
             logger.debug(f"Joining thread {t.connection_log.session_initiation_time}")
             t.join()
-            collect_stats(worker_stats, connection_threads[t])
+            worker_stats.add(connection_threads[t])
             finished_threads.append(t)
 
     # remove the joined threads from the list of active ones
@@ -1010,14 +1657,17 @@ def replay_worker(
 
     threading.current_thread().name = "0"
 
-    perf_lock = threading.Lock()
+    query_stats = start_query_stats_writer(process_idx)
+    start_connection_pool()
 
     try:
         # prepend the process index to all log messages in this worker
         prepend_ids_to_logs(process_idx)
 
-        # stagger worker startup to not hammer the get_cluster_credentials api
-        time.sleep(random.randrange(1, 3))
+        # stagger worker startup to not hammer the get_cluster_credentials api, unless the
+        # credentials are shared by the credential broker
+        if g_credential_broker is None:
+            time.sleep(random.randrange(1, 3))
         logger.debug(f"Worker {process_idx} ready for jobs")
 
         # time to block waiting for jobs on the queue
@@ -1031,7 +1681,7 @@ def replay_worker(
             try:
                 if connection_semaphore is not None:
                     logger.debug(
-                        f"Checking for connection throttling ({num_connections.value} / {g_config['limit_concurrent_connections']} active connections)"
+                        f"Checking for connection throttling ({num_connections.value} / {g_config.get('limit_concurrent_connections')} active connections)"
                     )
                     sem_start = time.time()
                     connection_semaphore.acquire()
@@ -1069,6 +1719,8 @@ def replay_worker(
                 logger.debug("Got termination signal, finishing up.")
                 break
 
+            resolve_job(job)
+
             thread_stats = init_stats({})
 
             # how much time has elapsed since the replay started
@@ -1106,7 +1758,7 @@ def replay_worker(
                 num_connections,
                 peak_connections,
                 connection_semaphore,
-                perf_lock,
+                query_stats,
             )
             connection_thread.name = f"{job['job_id']}"
             connection_thread.start()
@@ -1121,37 +1773,357 @@ def replay_worker(
     except Exception as e:
         logger.error(f"Process {process_idx} threw exception: {e}")
         logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        query_stats.close()
+        close_connection_pool()
 
     if connections_processed:
         logger.debug(
-            f"Max connection offset for this process: {worker_stats['connection_diff_sec']:.3f} sec"
+            f"Max connection offset for this process: {worker_stats.snapshot()['connection_diff_sec']:.3f} sec"
         )
 
     logger.debug(f"Process {process_idx} finished")
 
 
-def put_and_retry(job, queue, timeout=10, non_workers=0):
-    """Retry adding to the queue indefinitely until it succeeds. This
-    should only raise an exception and retry if the queue limit is hit."""
-    attempt = 0
-    while True:
-        try:
-            queue.put(job, block=True, timeout=timeout)
-            break
-        except Full:
-            # check to make sure child processes are alive
-            active_workers = len(multiprocessing.active_children()) - non_workers
-            if active_workers == 0:
-                logger.error(
-                    "Queue full, but there don't appear to be any active workers.  Giving up."
-                )
-                return False
+def async_replay_worker(
+    process_idx,
+    replay_start_time,
+    first_event_time,
+    queue,
+    error_logger,
+    worker_stats,
+    default_interface,
+    odbc_driver,
+    connection_semaphore,
+    num_connections,
+    peak_connections,
+):
+    """Worker process for the async replay engine. Instead of a thread per connection, each
+    connection is an asyncio task, and the event loop's timer heap wakes it up when its next
+    event is due. Blocking database calls run on a bounded thread pool."""
+    query_stats = start_query_stats_writer(process_idx)
+    start_connection_pool()
+    try:
+        # prepend the process index to all log messages in this worker
+        prepend_ids_to_logs(process_idx)
+        asyncio.run(
+            _async_replay_worker(
+                process_idx,
+                replay_start_time,
+                first_event_time,
+                queue,
+                error_logger,
+                worker_stats,
+                default_interface,
+                odbc_driver,
+                connection_semaphore,
+                num_connections,
+                peak_connections,
+                query_stats,
+            )
+        )
+    except Exception as e:
+        logger.error(f"Process {process_idx} threw exception: {e}")
+        logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        query_stats.close()
+        close_connection_pool()
+
+    logger.debug(f"Process {process_idx} finished")
+
+
+async def _async_replay_worker(
+    process_idx,
+    replay_start_time,
+    first_event_time,
+    queue,
+    error_logger,
+    worker_stats,
+    default_interface,
+    odbc_driver,
+    connection_semaphore,
+    num_connections,
+    peak_connections,
+    query_stats,
+):
+    loop = asyncio.get_running_loop()
+
+    # database calls, and the blocking calls to the shared job queue and semaphore, each get
+    # their own pool so a full query pool never stalls fetching jobs
+    executor = ThreadPoolExecutor(max_workers=g_config.get("query_threads") or 256)
+    queue_executor = ThreadPoolExecutor(max_workers=1)
+
+    # map connection task to stats dict
+    connection_tasks = {}
+    connections_processed = 0
+
+    def task_done(task):
+        worker_stats.add(connection_tasks.pop(task))
+
+    logger.debug(f"Worker {process_idx} ready for jobs")
+
+    # time to block waiting for jobs on the queue
+    timeout_sec = 10
+
+    last_empty_queue_time = None
+
+    while True:
+        try:
+            if connection_semaphore is not None:
+                logger.debug(
+                    f"Checking for connection throttling ({num_connections.value} / {g_config.get('limit_concurrent_connections')} active connections)"
+                )
+                await loop.run_in_executor(queue_executor, connection_semaphore.acquire)
+
+            job = await loop.run_in_executor(
+                queue_executor, functools.partial(queue.get, timeout=timeout_sec)
+            )
+        except Empty:
+            if connection_semaphore is not None:
+                connection_semaphore.release()
+
+            elapsed = (
+                int(time.time() - last_empty_queue_time) if last_empty_queue_time else 0
+            )
+            # take into account the initial timeout
+            elapsed += timeout_sec
+            empty_queue_timeout_sec = g_config.get("empty_queue_timeout_sec", 120)
+            logger.debug(f"No jobs for {elapsed} seconds (timeout {empty_queue_timeout_sec})")
+            if elapsed > empty_queue_timeout_sec:
+                logger.warning(f"Queue empty for {elapsed} sec, exiting")
+                break
+            if last_empty_queue_time is None:
+                last_empty_queue_time = time.time()
+            continue
+
+        last_empty_queue_time = None
+
+        if job is False:
+            logger.debug("Got termination signal, finishing up.")
+            break
+
+        resolve_job(job)
+
+        connection_replay = AsyncConnectionReplay(
+            process_idx,
+            job["job_id"],
+            job["connection"],
+            default_interface,
+            odbc_driver,
+            replay_start_time,
+            first_event_time,
+            error_logger,
+            init_stats({}),
+            num_connections,
+            peak_connections,
+            connection_semaphore,
+            query_stats,
+        )
+        task = asyncio.create_task(connection_replay.run(executor))
+        connection_tasks[task] = connection_replay.thread_stats
+        task.add_done_callback(task_done)
+        connections_processed += 1
+
+        # don't take jobs from the queue much earlier than they are due, so connections stay
+        # spread over the workers
+        delay_sec = (
+            job["connection"].offset_ms(first_event_time)
+            - current_offset_ms(replay_start_time)
+        ) / 1000.0
+        if delay_sec > JOB_LOOKAHEAD_SEC:
+            await asyncio.sleep(delay_sec - JOB_LOOKAHEAD_SEC)
+
+    logger.debug(f"Waiting for {len(connection_tasks)} connections to finish...")
+    await asyncio.gather(*list(connection_tasks))
+
+    executor.shutdown()
+    queue_executor.shutdown()
+
+    if connections_processed:
+        logger.debug(
+            f"Max connection offset for this process: {worker_stats.snapshot()['connection_diff_sec']:.3f} sec"
+        )
+
+
+def scheduler_replay_worker(
+    process_idx,
+    replay_start_time,
+    first_event_time,
+    queue,
+    error_logger,
+    worker_stats,
+    default_interface,
+    odbc_driver,
+    connection_semaphore,
+    num_connections,
+    peak_connections,
+):
+    """Worker process for the scheduler replay engine. Jobs are taken off the queue as they come
+    close to being due, and their events are handed to a central EventScheduler, which
+    dispatches them to a pool of query_threads threads."""
+
+    executor = ThreadPoolExecutor(max_workers=g_config.get("query_threads") or 256)
+    scheduler = EventScheduler(replay_start_time, executor)
+    query_stats = start_query_stats_writer(process_idx)
+    start_connection_pool()
+    stats_lock = threading.Lock()
+    active_connections = set()
+    finished = threading.Condition(stats_lock)
+    connections_processed = 0
+
+    def connection_finished(connection_replay):
+        with stats_lock:
+            worker_stats.add(connection_replay.thread_stats)
+            active_connections.discard(connection_replay)
+            finished.notify_all()
+
+    try:
+        # prepend the process index to all log messages in this worker
+        prepend_ids_to_logs(process_idx)
+        scheduler.start()
+        logger.debug(f"Worker {process_idx} ready for jobs")
+
+        # time to block waiting for jobs on the queue
+        timeout_sec = 10
+
+        last_empty_queue_time = None
+
+        while True:
+            try:
+                if connection_semaphore is not None:
+                    logger.debug(
+                        f"Checking for connection throttling ({num_connections.value} / {g_config.get('limit_concurrent_connections')} active connections)"
+                    )
+                    connection_semaphore.acquire()
+
+                job = queue.get(timeout=timeout_sec)
+            except Empty:
+                if connection_semaphore is not None:
+                    connection_semaphore.release()
+
+                elapsed = (
+                    int(time.time() - last_empty_queue_time)
+                    if last_empty_queue_time
+                    else 0
+                )
+                # take into account the initial timeout
+                elapsed += timeout_sec
+                empty_queue_timeout_sec = g_config.get("empty_queue_timeout_sec", 120)
+                logger.debug(
+                    f"No jobs for {elapsed} seconds (timeout {empty_queue_timeout_sec})"
+                )
+                if elapsed > empty_queue_timeout_sec:
+                    logger.warning(f"Queue empty for {elapsed} sec, exiting")
+                    break
+                if last_empty_queue_time is None:
+                    last_empty_queue_time = time.time()
+                continue
+
+            last_empty_queue_time = None
+
+            if job is False:
+                logger.debug("Got termination signal, finishing up.")
+                break
+
+            resolve_job(job)
+
+            connection_replay = ScheduledConnectionReplay(
+                scheduler,
+                connection_finished,
+                process_idx,
+                job["job_id"],
+                job["connection"],
+                default_interface,
+                odbc_driver,
+                replay_start_time,
+                first_event_time,
+                error_logger,
+                init_stats({}),
+                num_connections,
+                peak_connections,
+                connection_semaphore,
+                query_stats,
+            )
+            with stats_lock:
+                active_connections.add(connection_replay)
+            connection_replay.start()
+            connections_processed += 1
+
+            # don't take jobs from the queue much earlier than they are due, so connections stay
+            # spread over the workers. Jobs already taken are dispatched by the scheduler meanwhile
+            delay_sec = (
+                job["connection"].offset_ms(first_event_time)
+                - current_offset_ms(replay_start_time)
+            ) / 1000.0
+            if delay_sec > JOB_LOOKAHEAD_SEC:
+                time.sleep(delay_sec - JOB_LOOKAHEAD_SEC)
+
+        logger.debug(f"Waiting for {len(active_connections)} connections to finish...")
+        with stats_lock:
+            while active_connections:
+                finished.wait()
+    except Exception as e:
+        logger.error(f"Process {process_idx} threw exception: {e}")
+        logger.debug("".join(traceback.format_exception(*sys.exc_info())))
+    finally:
+        scheduler.stop()
+        executor.shutdown()
+        query_stats.close()
+        close_connection_pool()
+
+    logger.debug(f"Scheduler dispatch lag for this process: {scheduler.dispatch_lag.summary()}")
+    if connections_processed:
+        logger.debug(
+            f"Max connection offset for this process: {worker_stats.snapshot()['connection_diff_sec']:.3f} sec"
+        )
+
+    logger.debug(f"Process {process_idx} finished")
+
+
+def make_job(job_id, connection):
+    """The job for replaying a connection. When workers are forked, they look the connection up
+    in g_connection_logs, so it isn't pickled and sent through the Manager"""
+    if multiprocessing.get_start_method() == "fork":
+        return {"job_id": job_id}
+    return {"job_id": job_id, "connection": connection}
+
+
+def resolve_job(job):
+    """Look up the connection of a job made by make_job"""
+    if "connection" not in job:
+        job["connection"] = g_connection_logs[job["job_id"]]
+
+
+def put_and_retry(job, queue, timeout=10, non_workers=0):
+    """Retry adding to the queue indefinitely until it succeeds. This
+    should only raise an exception and retry if the queue limit is hit."""
+    attempt = 0
+    while True:
+        try:
+            queue.put(job, block=True, timeout=timeout)
+            break
+        except Full:
+            # check to make sure child processes are alive
+            active_workers = len(multiprocessing.active_children()) - non_workers
+            if active_workers == 0:
+                logger.error(
+                    "Queue full, but there don't appear to be any active workers.  Giving up."
+                )
+                return False
             attempt += 1
             logger.info(f"Queue full, retrying attempt {attempt}")
 
     return True
 
 
+# worker process function of each replay engine
+REPLAY_ENGINES = {
+    "threads": replay_worker,
+    "async": async_replay_worker,
+    "scheduler": scheduler_replay_worker,
+}
+
+
 def sigint_handler(signum, frame):
     logger.error("Received SIGINT, shutting down...")
 
@@ -1177,10 +2149,23 @@ def start_replay(
     per_process_stats,
     total_transactions,
     total_queries,
+    closed_loop_steps=None,
 ):
     """create a queue for passing jobs to the workers.  the limit will cause
-    put() to block if the queue is full"""
-    queue = manager.Queue(maxsize=1000000)
+    put() to block if the queue is full. In closed loop mode, the throughput and latency at each
+    concurrency level are appended to closed_loop_steps"""
+    job_counter = None
+    if g_config.get("job_distribution", "queue") == "shared_counter":
+        if multiprocessing.get_start_method() == "fork":
+            # workers inherit the connections, and take their indexes from a shared counter
+            job_counter = SharedJobCounter(len(connection_logs))
+            queue = job_counter
+        else:
+            logger.warning(
+                'The "shared_counter" job distribution requires forked worker processes, using "queue" instead.'
+            )
+    if job_counter is None:
+        queue = manager.Queue(maxsize=1000000)
 
     if not num_workers:
         # get number of available cpus, leave 1 for main thread and manager
@@ -1200,30 +2185,58 @@ def start_replay(
     logger.debug(f"Initial child processes: {initial_processes}")
 
     global g_workers
+    global g_connection_logs
+    # set before the workers are started, so they inherit the connections
+    g_connection_logs = connection_logs
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     connection_semaphore = None
     num_connections = manager.Value(int, 0)
     peak_connections = manager.Value(int, 0)
-    if g_config.get("limit_concurrent_connections"):
+    closed_loop_concurrency = []
+    if g_config.get("closed_loop_concurrency") is not None:
+        # the semaphore starts at the first concurrency level, and is raised to the next level
+        # every closed_loop_step_sec
+        closed_loop_concurrency = closed_loop_levels()
+        connection_semaphore = manager.Semaphore(closed_loop_concurrency[0])
+    elif g_config.get("limit_concurrent_connections"):
         # create an IPC semaphore to limit the total concurrency
         connection_semaphore = manager.Semaphore(
             g_config.get("limit_concurrent_connections")
         )
 
+    # workers add their stats to shared memory, and send their errors over a channel of their own,
+    # so neither goes through the Manager
+    global g_shared_stats
+    shared_stats = SharedStats(
+        num_workers,
+        COUNTER_STATS,
+        LATENCY_STATS,
+        sorted({(c.username, c.database_name) for c in connection_logs}),
+    )
+    g_shared_stats = shared_stats
+    error_channel = ErrorChannel()
+    error_logs = {idx: {stat: {} for stat in ERROR_LOG_STATS} for idx in range(num_workers)}
+
+    def collect_errors():
+        for worker_idx, kind, value in error_channel.drain():
+            if kind == WorkerStats.ERROR_RECORD:
+                error_logger.append(value)
+            else:
+                error_logs[worker_idx][kind].update(value)
+
     for idx in range(num_workers):
-        per_process_stats[idx] = manager.dict()
-        init_stats(per_process_stats[idx])
+        worker_stats = WorkerStats(shared_stats, error_channel, idx, ERROR_LOG_STATS)
         g_workers.append(
             multiprocessing.Process(
-                target=replay_worker,
+                target=REPLAY_ENGINES[g_config.get("replay_engine", "threads")],
                 args=(
                     idx,
                     g_replay_timestamp,
                     first_event_time,
                     queue,
-                    error_logger,
-                    per_process_stats[idx],
+                    worker_stats,
+                    worker_stats,
                     default_interface,
                     odbc_driver,
                     connection_semaphore,
@@ -1236,24 +2249,51 @@ def start_replay(
 
     signal.signal(signal.SIGINT, sigint_handler)
 
+    def queued_jobs():
+        if job_counter is not None:
+            return job_counter.remaining()
+        try:
+            return max(queue.qsize() - num_workers, 0)
+        except NotImplementedError:
+            return None
+
+    metrics_server = None
+    if g_config.get("metrics_port") is not None:
+        try:
+            metrics_server = MetricsServer(
+                g_config.get("metrics_host") or "localhost",
+                g_config["metrics_port"],
+                lambda: replay_metrics(
+                    shared_stats.snapshot(),
+                    shared_stats.query_counts(),
+                    num_connections.value,
+                    peak_connections.value,
+                    queued_jobs(),
+                ),
+            )
+            metrics_server.start()
+        except OSError as e:
+            logger.warning(f"Couldn't serve replay metrics on port {g_config['metrics_port']}: {e}")
+
     logger.debug(f"Total connections in the connection log: {len(connection_logs)}")
 
-    # add all the jobs to the work queue
-    for idx, connection in enumerate(connection_logs):
-        # if idx > 5:
-        #     break
-        if not put_and_retry(
-            {"job_id": idx, "connection": connection},
-            queue,
-            non_workers=initial_processes,
-        ):
-            break
+    if job_counter is None:
+        # add all the jobs to the work queue
+        for idx, connection in enumerate(connection_logs):
+            # if idx > 5:
+            #     break
+            if not put_and_retry(
+                make_job(idx, connection),
+                queue,
+                non_workers=initial_processes,
+            ):
+                break
 
-    # and add one termination "job"/signal for each worker so signal them to exit when
-    # there is no more work
-    for idx in range(num_workers):
-        if not put_and_retry(False, queue, non_workers=initial_processes):
-            break
+        # and add one termination "job"/signal for each worker so signal them to exit when
+        # there is no more work
+        for idx in range(num_workers):
+            if not put_and_retry(False, queue, non_workers=initial_processes):
+                break
 
     active_processes = len(multiprocessing.active_children()) - initial_processes
     logger.debug("Active processes: {}".format(active_processes))
@@ -1262,47 +2302,96 @@ def start_replay(
     logger.debug(f"{active_processes} processes running")
     cnt = 0
 
+    step_sec = g_config.get("closed_loop_step_sec") or 60
+    step = None
+
+    def end_closed_loop_step():
+        duration_sec = time.monotonic() - step["start"]
+        latencies = shared_stats.query_latency()
+        step_result = {
+            "concurrency": step["concurrency"],
+            "duration_sec": duration_sec,
+            "complete": duration_sec >= step_sec,
+            "queries": latencies.count - step["latencies"].count,
+            "latencies": latencies.since(step["latencies"]),
+        }
+        if closed_loop_steps is not None:
+            closed_loop_steps.append(step_result)
+        logger.info(format_closed_loop_step(step_result))
+
+    def start_closed_loop_step(level):
+        return {
+            "level": level,
+            "concurrency": closed_loop_concurrency[level],
+            "start": time.monotonic(),
+            "latencies": shared_stats.query_latency(),
+        }
+
+    if closed_loop_concurrency:
+        step = start_closed_loop_step(0)
+
     while active_processes:
         cnt += 1
         active_processes = len(multiprocessing.active_children()) - initial_processes
         if cnt % 60 == 0:
             logger.debug(f"Waiting for {active_processes} processes to finish")
-            try:
-                queue_length = queue.qsize()
-                logger.debug(f"Remaining connections: {queue_length - num_workers}")
-            except NotImplementedError:
+            remaining_connections = queued_jobs()
+            if remaining_connections is not None:
+                logger.debug(f"Remaining connections: {remaining_connections}")
+            else:
                 # support for qsize is platform-dependent
                 logger.debug("Queue length not supported.")
 
+        # workers block exiting until the errors they sent are read
+        collect_errors()
+
+        # move on to the next closed loop concurrency level
+        if (
+            step
+            and step["level"] + 1 < len(closed_loop_concurrency)
+            and time.monotonic() - step["start"] >= step_sec
+        ):
+            end_closed_loop_step()
+            level = step["level"] + 1
+            for _ in range(closed_loop_concurrency[level] - step["concurrency"]):
+                connection_semaphore.release()
+            step = start_closed_loop_step(level)
+
         # aggregate stats across all threads so far
-        try:
-            aggregated_stats = init_stats({})
-            for idx, stat in per_process_stats.items():
-                collect_stats(aggregated_stats, stat)
-            if cnt % 5 == 0:
-                display_stats(
-                    aggregated_stats,
-                    len(connection_logs),
-                    total_transactions,
-                    total_queries,
-                    peak_connections,
-                )
-                peak_connections.value = num_connections.value
-        except KeyError:
-            logger.debug("No stats to display yet.")
+        if cnt % 5 == 0:
+            display_stats(
+                shared_stats.snapshot(),
+                len(connection_logs),
+                total_transactions,
+                total_queries,
+                peak_connections,
+            )
+            peak_connections.value = num_connections.value
 
         time.sleep(1)
 
+    collect_errors()
+    if step:
+        end_closed_loop_step()
+    if metrics_server is not None:
+        metrics_server.stop()
+    for idx in range(num_workers):
+        per_process_stats[idx] = shared_stats.snapshot(idx)
+        per_process_stats[idx].update(error_logs[idx])
+
     # cleanup in case of error
     remaining_events = 0
-    try:
-        # clear out the queue in case of error to prevent broken pipe
-        # exceptions from internal Queue thread
-        while not queue.empty():
-            remaining_events += 1
-            queue.get_nowait()
-    except Empty:
-        pass
+    if job_counter is not None:
+        remaining_events = job_counter.remaining()
+    else:
+        try:
+            # clear out the queue in case of error to prevent broken pipe
+            # exceptions from internal Queue thread
+            while not queue.empty():
+                remaining_events += 1
+                queue.get_nowait()
+        except Empty:
+            pass
 
     if remaining_events > 0:
         logger.error("Not all jobs processed, replay unsuccessful")
@@ -1310,6 +2399,17 @@ def start_replay(
     return True
 
 
+def format_closed_loop_step(step):
+    text = (
+        f"Closed loop at concurrency {step['concurrency']}: {step['queries']} queries in "
+        f"{step['duration_sec']:.1f} sec, {step['queries'] / max(step['duration_sec'], 0.001):.1f} QPS, "
+        f"query latency {step['latencies'].summary()}"
+    )
+    if not step["complete"]:
+        text += ". The workload ran out before the end of the step"
+    return text
+
+
 def export_errors(
     connection_errors, transaction_errors, workload_location, replay_name
 ):
@@ -1386,139 +2486,77 @@ def export_errors(
             error_file.close()
 
 
-def assign_copy_replacements(connection_logs, replacements):
-    for connection_log in connection_logs:
-        for transaction in connection_log.transactions:
-            for query in transaction.queries:
-                if "copy " in query.text.lower() and "from 's3:" in query.text.lower():
-                    from_text = re.search(
-                        r"from 's3:\/\/[^']*", query.text, re.IGNORECASE
-                    )
-                    if from_text:
-                        existing_copy_location = from_text.group()[6:]
-
-                        try:
-                            replacement_copy_location = replacements[
-                                existing_copy_location
-                            ][0]
-                        except KeyError:
-                            logger.info(
-                                f"No COPY replacement found for {existing_copy_location}"
-                            )
-                            continue
-
-                        if not replacement_copy_location:
-                            replacement_copy_location = existing_copy_location
-
-                        replacement_copy_iam_role = replacements[
-                            existing_copy_location
-                        ][1]
-                        if not replacement_copy_iam_role:
-                            logger.error(
-                                f"COPY replacement {existing_copy_location} is missing IAM role or credentials in {g_copy_replacements_filename}. Please add credentials or remove replacement."
-                            )
-                            sys.exit()
-
-                        query.text = query.text.replace(
-                            existing_copy_location, replacement_copy_location
-                        )
+def assign_transactions(connection_logs, transactions):
+    """
+    Assign each transaction to the most recent connection with the same connection key that
+    started before it. Connections must be sorted by session initiation time
+    :param connection_logs: connections to replay
+    :param transactions: transactions to assign
+    :return: number of queries of the assigned transactions
+    """
+    # truncated session start times of the connections of each connection key, in order. Session
+    # start times are truncated, since query/transaction time is truncated to seconds
+    start_times_by_key = {}
+    connections_by_key = {}
+    for c in connection_logs:
+        connection_key = get_connection_key(c.database_name, c.username, c.pid)
+        start_times_by_key.setdefault(connection_key, []).append(
+            c.session_initiation_time.replace(microsecond=0)
+        )
+        connections_by_key.setdefault(connection_key, []).append(c)
 
-                        iam_replacements = [
-                            (r"iam_role''", f" IAM_ROLE '{replacement_copy_iam_role}'"),
-                            (
-                                r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
-                                f" IAM_ROLE '{replacement_copy_iam_role}'",
-                            ),
-                            (
-                                r"credentials ''",
-                                f" IAM_ROLE '{replacement_copy_iam_role}'",
-                            ),
-                            (
-                                r"with credentials as ''",
-                                f" IAM_ROLE '{replacement_copy_iam_role}'",
-                            ),
-                            (
-                                r"IAM_ROLE ''",
-                                f" IAM_ROLE '{replacement_copy_iam_role}'",
-                            ),
-                            (
-                                r"ACCESS_KEY_ID '' SECRET_ACCESS_KEY '' SESSION_TOKEN ''",
-                                f" IAM_ROLE '{replacement_copy_iam_role}'",
-                            ),
-                            (
-                                r"ACCESS_KEY_ID '' SECRET_ACCESS_KEY ''",
-                                f" IAM_ROLE '{replacement_copy_iam_role}'",
-                            ),
-                        ]
-
-                        for r in iam_replacements:
-                            query.text = re.sub(
-                                r[0], r[1], query.text, flags=re.IGNORECASE
-                            )
-
-
-def assign_unloads(connection_logs, replay_output, replay_name, unload_iam_role):
-    for connection_log in connection_logs:
-        for transaction in connection_log.transactions:
-            for query in transaction.queries:
-                if "unload" in query.text.lower() and "to 's3:" in query.text.lower():
-                    to_text = re.search(
-                        r"to 's3:\/\/[^']*", query.text, re.IGNORECASE
-                    ).group()[9:]
-
-                    if to_text:
-                        existing_unload_location = re.search(
-                            r"to 's3:\/\/[^']*", query.text, re.IGNORECASE
-                        ).group()[4:]
-                        replacement_unload_location = (
-                            replay_output + "/" + replay_name + "/UNLOADs/" + to_text
-                        )
+    query_count = 0
+    for t in transactions:
+        connection_key = get_connection_key(t.database_name, t.username, t.pid)
+        start_times = start_times_by_key.get(connection_key, [])
+        # the last connection started at or before the transaction
+        match_idx = bisect.bisect_right(start_times, t.start_time()) - 1
+        if match_idx < 0:
+            logger.warning(
+                f"Couldn't find matching connection in {len(start_times)} connections for transaction {t}, skipping"
+            )
+            continue
+        connections_by_key[connection_key][match_idx].transactions.append(t)
+        query_count += len(t.queries)
+    return query_count
 
-                        new_query_text = query.text.replace(
-                            existing_unload_location, replacement_unload_location
-                        )
-                        if not new_query_text == query.text:
-                            query.text = new_query_text
-                            query.text = re.sub(
-                                r"IAM_ROLE 'arn:aws:iam::\d+:role/\S+'",
-                                f" IAM_ROLE '{unload_iam_role}'",
-                                query.text,
-                                flags=re.IGNORECASE,
-                            )
-                            query.text = re.sub(
-                                r"credentials ''",
-                                " IAM_ROLE '%s'" % unload_iam_role,
-                                query.text,
-                                flags=re.IGNORECASE,
-                            )
-                            query.text = re.sub(
-                                r"with credentials as ''",
-                                " IAM_ROLE '%s'" % unload_iam_role,
-                                query.text,
-                                flags=re.IGNORECASE,
-                            )
-                            query.text = re.sub(
-                                r"IAM_ROLE ''",
-                                " IAM_ROLE '%s'" % unload_iam_role,
-                                query.text,
-                                flags=re.IGNORECASE,
-                            )
-                            query.text = re.sub(
-                                r"ACCESS_KEY_ID '' SECRET_ACCESS_KEY '' SESSION_TOKEN ''",
-                                " IAM_ROLE '%s'" % unload_iam_role,
-                                query.text,
-                                flags=re.IGNORECASE,
-                            )
-                            query.text = re.sub(
-                                r"ACCESS_KEY_ID '' SECRET_ACCESS_KEY ''",
-                                " IAM_ROLE '%s'" % unload_iam_role,
-                                query.text,
-                                flags=re.IGNORECASE,
-                            )
-
-
-def assign_time_intervals(connection_logs):
+
+def scale_time(time, reference_time, speed_up_factor):
+    """Compress the time elapsed since reference_time by speed_up_factor"""
+    if time is None:
+        return None
+    return reference_time + (time - reference_time) / speed_up_factor
+
+
+def scale_epoch_us(epoch_us, reference_us, speed_up_factor):
+    """scale_time for times in microseconds since the epoch"""
+    if epoch_us is None:
+        return None
+    return reference_us + round((epoch_us - reference_us) / speed_up_factor)
+
+
+def assign_time_intervals(connection_logs, reference_time=None, speed_up_factor=1):
+    """Set the time to wait after each query. If speed_up_factor is not 1, all connection and
+    query times are first rescaled around reference_time, compressing the inter-arrival times
+    of connections, transactions and queries by that factor"""
     for connection_log in connection_logs:
+        if speed_up_factor != 1:
+            connection_log.session_initiation_time = scale_time(
+                connection_log.session_initiation_time, reference_time, speed_up_factor
+            )
+            connection_log.disconnection_time = scale_time(
+                connection_log.disconnection_time, reference_time, speed_up_factor
+            )
+            reference_us = to_epoch_us(reference_time)
+            for transaction in connection_log.transactions:
+                for query in transaction.queries:
+                    query.start_us = scale_epoch_us(
+                        query.start_us, reference_us, speed_up_factor
+                    )
+                    query.end_us = scale_epoch_us(
+                        query.end_us, reference_us, speed_up_factor
+                    )
+
         for transaction in connection_log.transactions:
             if connection_log.time_interval_between_queries == "all on":
                 is_calculate_time_interval = True
@@ -1531,43 +2569,192 @@ def assign_time_intervals(connection_logs):
             if is_calculate_time_interval:
                 for index, sql in enumerate(transaction.queries[1:]):
                     prev_sql = transaction.queries[index]
-                    prev_sql.time_interval = (
-                        sql.start_time - prev_sql.end_time
-                    ).total_seconds()
+                    prev_sql.time_interval = (sql.start_us - prev_sql.end_us) / 1e6
 
 
-def assign_create_user_password(connection_logs):
+def closed_loop_levels():
+    """Concurrency levels of the closed loop mode, from closed_loop_concurrency"""
+    levels = g_config["closed_loop_concurrency"]
+    if isinstance(levels, int):
+        return [levels]
+    return list(levels)
+
+
+def make_closed_loop(connection_logs, first_event_time):
+    """Make all connections and queries due at the start of the replay, with no waits between
+    transactions and queries, so they are replayed back to back as fast as the concurrency limit
+    allows"""
+    first_event_us = to_epoch_us(first_event_time)
     for connection_log in connection_logs:
+        connection_log.session_initiation_time = first_event_time
+        connection_log.disconnection_time = first_event_time
+        connection_log.time_interval_between_transactions = False
+        connection_log.time_interval_between_queries = "all off"
         for transaction in connection_log.transactions:
             for query in transaction.queries:
-                if "create user" in query.text.lower():
-                    random_password = "".join(
-                        random.choices(
-                            string.ascii_uppercase
-                            + string.ascii_lowercase
-                            + string.digits,
-                            k=61,
-                        )
-                    )
-                    query.text = re.sub(
-                        r"PASSWORD '\*\*\*'",
-                        f"PASSWORD '{random_password}aA0'",
-                        query.text,
-                        flags=re.IGNORECASE,
-                    )
+                query.start_us = first_event_us
+                query.end_us = first_event_us
+
+
+def statement_options():
+    """The settings that decide how queries are prepared for execution"""
+    return {
+        "split_multi": g_config.get("split_multi", True),
+        "execute_copy_statements": g_config.get("execute_copy_statements") == "true",
+        "execute_unload_statements": g_config.get("execute_unload_statements") == "true"
+        and g_config.get("replay_output") is not None,
+    }
+
+
+def statement_tag_suffix(replay_start):
+    """The end of the tag comment of replayed statements, which is the same for a whole replay"""
+    return ', "replay_start": {}, "source": {}}} */ '.format(
+        json.dumps(replay_start.isoformat()),
+        json.dumps(g_config.get("source_tag", "SimpleReplay")),
+    )
+
+
+def tag_statement(sql_text, xid, query_idx, tag_suffix):
+    """Prefix a statement with the comment identifying it in the target's logs, which holds
+    json.dumps({"xid": ..., "query_idx": ..., "replay_start": ..., "source": ...})"""
+    return '/* {"xid": ' + json.dumps(xid) + ', "query_idx": ' + str(query_idx) + tag_suffix + sql_text
+
+
+def split_sql(query_text):
+    """Split a query into its statements, like sqlparse.split. Most queries hold one statement,
+    possibly ending in ;, which is told without parsing"""
+    text = query_text.strip()
+    if text not in ("", ";") and ";" not in text[:-1] and "--" not in text:
+        return [text]
+    split_statements = sqlparse.split(query_text)
+    # exclude empty statements. Some customers' queries have been
+    # found to end in multiple ; characters;
+    return [_ for _ in split_statements if _ != ";"]
+
+
+def prepare_query_statements(query_text, options):
+    """
+    Split a query into its statements, and decide whether each one is executed. Statements are
+    tagged when they are executed, so the same statements can be shared by all queries with the
+    same text
+    :param query_text: text of the query, which may hold several statements
+    :param options: settings as returned by statement_options
+    :return: tuple of (statement text, whether the statement is executed)
+    """
+    if options["split_multi"]:
+        split_statements = split_sql(query_text)
+    else:
+        split_statements = [query_text]
+
+    statements = []
+    for sql_text in split_statements:
+        # COPY and UNLOAD statements are only executed if enabled
+        sql_lower = sql_text.lower()
+        is_copy = "from 's3:" in sql_lower
+        is_unload = "to 's3:" in sql_lower
+        execute = (
+            (options["execute_copy_statements"] and is_copy)
+            or (options["execute_unload_statements"] and is_unload)
+            or (not is_copy and not is_unload)
+        )
+        statements.append((sql_text, execute))
+    return tuple(statements)
+
+
+def _prepare_transactions(args):
+    transactions, options, rewriter = args
+    prepared = []
+    rewritten = []
+    counts = Counter()
+    unmatched_copy_locations = set()
+    # most texts repeat, so each distinct text is only prepared once
+    statements_by_text = {}
+    for query_texts in transactions:
+        if rewriter is not None:
+            query_texts, batch_counts, batch_unmatched = rewrite_texts(rewriter, query_texts)
+            counts.update(batch_counts)
+            unmatched_copy_locations.update(batch_unmatched)
+            rewritten.append(query_texts)
+        transaction_statements = []
+        for query_text in query_texts:
+            statements = statements_by_text.get(query_text)
+            if statements is None:
+                statements = prepare_query_statements(query_text, options)
+                statements_by_text[query_text] = statements
+            transaction_statements.append(statements)
+        prepared.append(transaction_statements)
+    return prepared, rewritten, counts, unmatched_copy_locations
+
+
+def prepare_statements(connection_logs, num_processes, rewriter=None):
+    """
+    Rewrite the query texts, then split and classify the statements of every query ahead of the
+    replay, so replaying a query only tags and executes them. Queries with the same text share
+    their statements. Workloads of at least PREPARE_POOL_MIN_TRANSACTIONS transactions are prepared
+    on a pool of processes if more than one is allowed, others in process
+    :param connection_logs: connections to replay
+    :param num_processes: maximum number of processes to use, 1 to prepare in process
+    :param rewriter: QueryRewriter applied to the query texts, or None
+    :return: (Counter of the statements rewritten by each rule, set of COPY locations without a
+    replacement)
+    """
+    options = statement_options()
+    transactions = [
+        transaction
+        for connection_log in connection_logs
+        for transaction in connection_log.transactions
+    ]
+    batches = [
+        transactions[i : i + PREPARE_BATCH_TRANSACTIONS]
+        for i in range(0, len(transactions), PREPARE_BATCH_TRANSACTIONS)
+    ]
+    tasks = (
+        ([[query.text for query in t.queries] for t in batch], options, rewriter)
+        for batch in batches
+    )
+
+    if num_processes > 1 and len(transactions) >= PREPARE_POOL_MIN_TRANSACTIONS:
+        num_processes = min(num_processes, len(batches))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+            results = list(
+                ordered_map(executor, _prepare_transactions, tasks, max_pending=2 * num_processes)
+            )
+    else:
+        results = [_prepare_transactions(task) for task in tasks]
+
+    counts = Counter()
+    unmatched_copy_locations = set()
+    # batches come back as copies, so identical statements are shared again here
+    statement_table = {}
+    for batch, (prepared, rewritten, batch_counts, batch_unmatched) in zip(batches, results):
+        for transaction, transaction_statements in zip(batch, prepared):
+            for query, statements in zip(transaction.queries, transaction_statements):
+                query.statements = statement_table.setdefault(statements, statements)
+        for transaction, query_texts in zip(batch, rewritten):
+            for query, query_text in zip(transaction.queries, query_texts):
+                query.text = intern_name(query_text)
+        counts.update(batch_counts)
+        unmatched_copy_locations.update(batch_unmatched)
+    return counts, unmatched_copy_locations
 
 
 def get_connection_credentials(
     username, database=None, max_attempts=10, skip_cache=False
 ):
-    credentials_timeout_sec = 3600
-    retry_delay_sec = 10
-
     # how long to cache credentials per user
     cache_timeout_sec = 1800
 
+    # check the credentials shared by the replay manager
+    user_credentials = None
+    if not skip_cache and g_credential_broker is not None:
+        user_credentials = g_credential_broker.get(username)
+
     # check the cache
-    if not skip_cache and g_credentials_cache.get(username) is not None:
+    if (
+        user_credentials is None
+        and not skip_cache
+        and g_credentials_cache.get(username) is not None
+    ):
         record = g_credentials_cache.get(username)
         if (
             datetime.datetime.now(tz=datetime.timezone.utc) - record["last_update"]
@@ -1580,7 +2767,6 @@ def get_connection_credentials(
     odbc_driver = g_config["odbc_driver"]
 
     cluster_endpoint_split = cluster_endpoint.split(".")
-    cluster_id = cluster_endpoint_split[0]
 
     # Keeping NLB just for Serverless for now
     if g_config["nlb_nat_dns"] is not None and g_is_serverless:
@@ -1591,6 +2777,61 @@ def get_connection_credentials(
     cluster_port = cluster_endpoint_split[5].split("/")[0][4:]
     database = cluster_endpoint_split[5].split("/")[1] if database is None else database
 
+    if user_credentials is None:
+        user_credentials = get_user_credentials(username, database, max_attempts)
+        cache_credentials = True
+    else:
+        logger.debug(f"Using {username} credentials from the credential broker")
+        cache_credentials = False
+    db_user = user_credentials["DbUser"]
+    db_password = user_credentials["DbPassword"]
+
+    cluster_odbc_url = "Driver={}; Server={}; Database={}; IAM=1; DbUser={}; DbPassword={}; Port={}".format(
+        odbc_driver,
+        cluster_host,
+        database,
+        db_user.split(":")[1] if ":" in db_user else db_user,
+        db_password,
+        cluster_port,
+    )
+
+    cluster_psql = {
+        "username": db_user,
+        "password": db_password,
+        "host": cluster_host,
+        "port": cluster_port,
+        "database": database,
+    }
+
+    credentials = {  # old params
+        "odbc": cluster_odbc_url,
+        "psql": cluster_psql,
+        # new params
+        "username": db_user,
+        "password": db_password,
+        "host": cluster_host,
+        "port": cluster_port,
+        "database": database,
+        "odbc_driver": g_config["odbc_driver"],
+    }
+    if cache_credentials:
+        logger.debug("Successfully retrieved database credentials for {}".format(username))
+        g_credentials_cache[username] = {
+            "last_update": datetime.datetime.now(tz=datetime.timezone.utc),
+            "target_cluster_urls": credentials,
+        }
+    return credentials
+
+
+def get_redshift_client():
+    """Redshift client of the target cluster, to get cluster credentials with. Clients are thread
+    safe, unlike the default boto3 session they are created from, so threads fetching credentials
+    share a client created beforehand"""
+    if g_is_serverless:
+        return client(
+            "redshift", region_name=g_config.get("target_cluster_region", None)
+        )
+
     additional_args = {}
     if os.environ.get("ENDPOINT_URL"):
         import urllib3
@@ -1601,6 +2842,25 @@ def get_connection_credentials(
             "endpoint_url": os.environ.get("ENDPOINT_URL"),
             "verify": False,
         }
+    return client(
+        "redshift",
+        region_name=g_config.get("target_cluster_region", None),
+        **additional_args,
+    )
+
+
+def get_user_credentials(username, database=None, max_attempts=10, rs_client=None):
+    """Fetch the database user and password of username from GetClusterCredentials, or from the
+    configured secret on Redshift Serverless. Returns a dict with DbUser and DbPassword, and raises
+    CredentialsException if they can't be retrieved. rs_client is the Redshift client to use, one
+    is created if it's None"""
+    credentials_timeout_sec = 3600
+    retry_delay_sec = 10
+
+    cluster_endpoint = g_config["target_cluster_endpoint"]
+    cluster_id = cluster_endpoint.split(".")[0]
+    if database is None:
+        database = cluster_endpoint.split(".")[5].split("/")[1]
 
     response = None
     db_user = None
@@ -1620,13 +2880,11 @@ def get_connection_credentials(
                 }
             else:
                 logger.error(f"Required secrets not found: {secret_keys}")
-                exit(-1)
+                raise CredentialsException(f"Required secrets not found: {secret_keys}")
         else:
             # Using backward compatibility method to fetch user credentials for serverless workgroup
             # rs_client = client('redshift-serverless', region_name=g_config.get("target_cluster_region", None))
-            rs_client = client(
-                "redshift", region_name=g_config.get("target_cluster_region", None)
-            )
+            rs_client = rs_client or get_redshift_client()
             for attempt in range(1, max_attempts + 1):
                 try:
                     # response = rs_client.get_credentials(dbName=database, durationSeconds = 3600, workgroupName=cluster_id)
@@ -1645,13 +2903,13 @@ def get_connection_credentials(
                         logger.error(
                             f"Error retrieving credentials for {cluster_id}: IAM credentials have expired."
                         )
-                        exit(-1)
+                        raise CredentialsException("IAM credentials have expired")
                     elif e.response["Error"]["Code"] == "ResourceNotFoundException":
                         logger.error(
                             f"Serverless endpoint could not be found "
                             f"RedshiftServerless:GetCredentials. {e}"
                         )
-                        exit(-1)
+                        raise CredentialsException(f"Serverless endpoint {cluster_id} not found")
                     else:
                         logger.error(
                             f"Got exception retrieving credentials ({e.response['Error']['Code']})"
@@ -1671,11 +2929,7 @@ def get_connection_credentials(
             db_user = response["DbUser"]
             db_password = response["DbPassword"]
     else:
-        rs_client = client(
-            "redshift",
-            region_name=g_config.get("target_cluster_region", None),
-            **additional_args,
-        )
+        rs_client = rs_client or get_redshift_client()
         for attempt in range(1, max_attempts + 1):
             try:
                 response = rs_client.get_cluster_credentials(
@@ -1691,7 +2945,7 @@ def get_connection_credentials(
                     logger.error(
                         f"Error retrieving credentials for {cluster_id}: IAM credentials have expired."
                     )
-                    exit(-1)
+                    raise CredentialsException("IAM credentials have expired")
                 else:
                     logger.error(
                         f"Got exception retrieving credentials ({e.response['Error']['Code']})"
@@ -1701,7 +2955,7 @@ def get_connection_credentials(
                 logger.error(
                     f"Cluster {cluster_id} not found. Please confirm cluster endpoint, account, and region."
                 )
-                exit(-1)
+                raise CredentialsException(f"Cluster {cluster_id} not found")
 
             if response is None or response.get("DbPassword") is None:
                 logger.warning(
@@ -1720,40 +2974,7 @@ def get_connection_credentials(
         msg = f"Failed to retrieve credentials for {username}"
         raise CredentialsException(msg)
 
-    cluster_odbc_url = "Driver={}; Server={}; Database={}; IAM=1; DbUser={}; DbPassword={}; Port={}".format(
-        odbc_driver,
-        cluster_host,
-        database,
-        db_user.split(":")[1] if ":" in db_user else db_user,
-        db_password,
-        cluster_port,
-    )
-
-    cluster_psql = {
-        "username": db_user,
-        "password": db_password,
-        "host": cluster_host,
-        "port": cluster_port,
-        "database": database,
-    }
-
-    credentials = {  # old params
-        "odbc": cluster_odbc_url,
-        "psql": cluster_psql,
-        # new params
-        "username": db_user,
-        "password": db_password,
-        "host": cluster_host,
-        "port": cluster_port,
-        "database": database,
-        "odbc_driver": g_config["odbc_driver"],
-    }
-    logger.debug("Successfully retrieved database credentials for {}".format(username))
-    g_credentials_cache[username] = {
-        "last_update": datetime.datetime.now(tz=datetime.timezone.utc),
-        "target_cluster_urls": credentials,
-    }
-    return credentials
+    return {"DbUser": db_user, "DbPassword": db_password}
 
 
 def unload_system_table(
@@ -1932,6 +3153,98 @@ def validate_config(config):
         config["secret_name"] = None
         logger.debug("SECRET_NAME property not specified.")
 
+    if config.get("query_stats_format", "csv") not in ("csv", "parquet"):
+        logger.error('Config file value for "query_stats_format" must be "csv" or "parquet".')
+        exit(-1)
+    if config.get("query_stats_format") == "parquet":
+        try:
+            import pyarrow
+        except ImportError:
+            logger.error(
+                'Error importing pyarrow. Please ensure pyarrow is correctly installed or set "query_stats_format" '
+                'to "csv".'
+            )
+            exit(-1)
+    if config.get("statement_prepare_processes") is not None and (
+        not isinstance(config["statement_prepare_processes"], int)
+        or config["statement_prepare_processes"] < 1
+    ):
+        logger.error('Config file value for "statement_prepare_processes" must be an integer greater than 0.')
+        exit(-1)
+    if config.get("connection_pool_max_idle") is not None and (
+        not isinstance(config["connection_pool_max_idle"], int)
+        or config["connection_pool_max_idle"] < 1
+    ):
+        logger.error('Config file value for "connection_pool_max_idle" must be an integer greater than 0.')
+        exit(-1)
+    if config.get("metrics_port") is not None and (
+        not isinstance(config["metrics_port"], int) or not 0 <= config["metrics_port"] <= 65535
+    ):
+        logger.error('Config file value for "metrics_port" must be a port number between 0 and 65535.')
+        exit(-1)
+    if config.get("closed_loop_concurrency") is not None:
+        levels = config["closed_loop_concurrency"]
+        if isinstance(levels, int):
+            levels = [levels]
+        if (
+            not isinstance(levels, list)
+            or not levels
+            or not all(isinstance(level, int) and level > 0 for level in levels)
+            or levels != sorted(set(levels))
+        ):
+            logger.error(
+                'Config file value for "closed_loop_concurrency" must be an integer greater than 0, or a list of '
+                "increasing integers greater than 0."
+            )
+            exit(-1)
+    if config.get("closed_loop_step_sec") is not None and (
+        not isinstance(config["closed_loop_step_sec"], (int, float))
+        or config["closed_loop_step_sec"] <= 0
+    ):
+        logger.error('Config file value for "closed_loop_step_sec" must be a number of seconds greater than 0.')
+        exit(-1)
+    if config.get("job_distribution", "queue") not in ("queue", "shared_counter"):
+        logger.error(
+            'Config file value for "job_distribution" must be "queue" or "shared_counter".'
+        )
+        exit(-1)
+    if config.get("replay_engine", "threads") not in REPLAY_ENGINES:
+        logger.error(
+            'Config file value for "replay_engine" must be "threads", "async" or "scheduler".'
+        )
+        exit(-1)
+    for option in ("replay_start_offset_sec", "replay_end_offset_sec"):
+        if config.get(option) is not None and (
+            not isinstance(config[option], (int, float)) or config[option] < 0
+        ):
+            logger.error(
+                f'Config file value for "{option}" must be a number of seconds greater than or equal to 0.'
+            )
+            exit(-1)
+    if (
+        config.get("replay_start_offset_sec") is not None
+        and config.get("replay_end_offset_sec") is not None
+        and config["replay_end_offset_sec"] <= config["replay_start_offset_sec"]
+    ):
+        logger.error(
+            'Config file value for "replay_end_offset_sec" must be greater than "replay_start_offset_sec".'
+        )
+        exit(-1)
+    if config.get("speed_up_factor") is not None and (
+        not isinstance(config["speed_up_factor"], (int, float))
+        or config["speed_up_factor"] <= 0
+    ):
+        logger.error('Config file value for "speed_up_factor" must be a number greater than 0.')
+        exit(-1)
+    if config.get("connection_sample_rate") is not None and (
+        not isinstance(config["connection_sample_rate"], (int, float))
+        or not 0 < config["connection_sample_rate"] <= 1
+    ):
+        logger.error(
+            'Config file value for "connection_sample_rate" must be a number greater than 0 and at most 1.'
+        )
+        exit(-1)
+
     config["filters"] = validate_and_normalize_filters(
         ConnectionLog, config.get("filters", {})
     )
@@ -2031,13 +3344,13 @@ def main():
     if not g_config["replay_output"]:
         g_config["replay_output"] = None
 
-    (connection_logs, total_connections) = parse_connections(
+    (connection_logs, total_connections, (window_start_time, window_end_time)) = parse_connections(
         g_config["workload_location"],
         g_config["time_interval_between_transactions"],
         g_config["time_interval_between_queries"],
     )
     logger.info(
-        f"Found {total_connections} total connections, {total_connections - len(connection_logs)} are excluded by filters. Replaying {len(connection_logs)}."
+        f"Found {total_connections} total connections, {total_connections - len(connection_logs)} are excluded by filters, time window or sampling. Replaying {len(connection_logs)}."
     )
 
     # Associate transactions with connections
@@ -2045,39 +3358,12 @@ def main():
         f"Loading transactions from {g_config['workload_location']}, this might take some time."
     )
 
-    # group all connections by connection key
-    connection_idx_by_key = {}
-    for idx, c in enumerate(connection_logs):
-        connection_key = get_connection_key(c.database_name, c.username, c.pid)
-        connection_idx_by_key.setdefault(connection_key, []).append(idx)
-
-    all_transactions = parse_transactions(g_config["workload_location"])
+    all_transactions = parse_transactions(
+        g_config["workload_location"], window_start_time, window_end_time
+    )
 
     transaction_count = len(all_transactions)
-    query_count = 0
-
-    # assign the correct connection to each transaction by looking at the most
-    # recent connection prior to the transaction start. This relies on connections
-    # being sorted.
-    for idx, t in enumerate(all_transactions):
-        connection_key = get_connection_key(t.database_name, t.username, t.pid)
-        possible_connections = connection_idx_by_key[connection_key]
-        best_match_idx = None
-        for c_idx in possible_connections:
-            # truncate session start time, since query/transaction time is truncated to seconds
-            if (
-                connection_logs[c_idx].session_initiation_time.replace(microsecond=0)
-                > t.start_time()
-            ):
-                break
-            best_match_idx = c_idx
-        if best_match_idx is None:
-            logger.warning(
-                f"Couldn't find matching connection in {len(possible_connections)} connections for transaction {t}, skipping"
-            )
-            continue
-        connection_logs[best_match_idx].transactions.append(t)
-        query_count += len(t.queries)
+    query_count = assign_transactions(connection_logs, all_transactions)
 
     logger.info(f"Found {transaction_count} transactions, {query_count} queries")
     connection_logs = [_ for _ in connection_logs if len(_.transactions) > 0]
@@ -2121,31 +3407,67 @@ def main():
         + str((last_event_time - first_event_time))
     )
 
+    copy_replacements = None
     if g_config["execute_copy_statements"] == "true":
         logger.debug("Configuring COPY replacements")
-        replacements = parse_copy_replacements(g_config["workload_location"])
-        assign_copy_replacements(connection_logs, replacements)
+        copy_replacements = parse_copy_replacements(g_config["workload_location"])
 
+    unload_location = None
     if g_config["execute_unload_statements"] == "true":
         if g_config["unload_iam_role"]:
             if g_config["replay_output"].startswith("s3://"):
                 logger.debug("Configuring UNLOADs")
-                assign_unloads(
-                    connection_logs,
-                    g_config["replay_output"],
-                    replay_id,
-                    g_config["unload_iam_role"],
-                )
+                unload_location = g_config["replay_output"] + "/" + replay_id
             else:
                 logger.debug(
                     'UNLOADs not configured since "replay_output" is not an S3 location.'
                 )
 
+    speed_up_factor = g_config.get("speed_up_factor") or 1
+    if speed_up_factor != 1:
+        last_event_time = scale_time(last_event_time, first_event_time, speed_up_factor)
+        logger.info(
+            f"Speeding up the workload {speed_up_factor}x, estimated replay execution time: "
+            + str((last_event_time - first_event_time))
+        )
+
+    if g_config.get("closed_loop_concurrency") is not None:
+        logger.info(
+            f"Replaying in closed loop mode at concurrency "
+            f"{', '.join(str(level) for level in closed_loop_levels())}, ignoring the original timing"
+        )
+        make_closed_loop(connection_logs, first_event_time)
+
     logger.debug("Configuring time intervals")
-    assign_time_intervals(connection_logs)
+    assign_time_intervals(connection_logs, first_event_time, speed_up_factor)
 
-    logger.debug("Configuring CREATE USER PASSWORD random replacements")
-    assign_create_user_password(connection_logs)
+    # COPY, UNLOAD and CREATE USER PASSWORD replacements are applied while preparing statements
+    rewriter = QueryRewriter(
+        copy_replacements=copy_replacements,
+        unload_location=unload_location,
+        unload_iam_role=g_config["unload_iam_role"],
+    )
+
+    logger.info("Preparing statements")
+    prepare_start = time.time()
+    try:
+        rewrite_counts, unmatched_copy_locations = prepare_statements(
+            connection_logs,
+            min(g_config.get("statement_prepare_processes") or 1, os.cpu_count() or 1),
+            rewriter,
+        )
+    except RewriteError as e:
+        logger.error(
+            f"{e} in {g_copy_replacements_filename}. Please add credentials or remove replacement."
+        )
+        sys.exit()
+    for location in sorted(unmatched_copy_locations):
+        logger.info(f"No COPY replacement found for {location}")
+    logger.info(
+        f"Prepared statements in {time.time() - prepare_start:.1f} sec. Statements rewritten: "
+        f"{rewrite_counts[COPY_RULE]} COPY, {rewrite_counts[UNLOAD_RULE]} UNLOAD, "
+        f"{rewrite_counts[CREATE_USER_PASSWORD_RULE]} CREATE USER PASSWORD"
+    )
 
     # test connection
     try:
@@ -2166,10 +3488,20 @@ def main():
         logger.info("No logs to replay, nothing to do.")
         sys.exit()
 
+    # fetch the credentials of all users once, and share them with the workers
+    global g_credential_broker
+    # the broker fetches credentials on several threads, which share one Redshift client
+    g_credential_broker = CredentialBroker(
+        manager, functools.partial(get_user_credentials, rs_client=get_redshift_client())
+    )
+    g_credential_broker.prefetch(connection.username for connection in connection_logs)
+    g_credential_broker.start()
+
     # Actual replay
     logger.debug("Starting replay")
-    error_list = manager.list()
+    error_list = []
     per_process_stats = {}
+    closed_loop_steps = []
     complete = False
 
     try:
@@ -2185,6 +3517,7 @@ def main():
             per_process_stats,
             transaction_count,
             query_count,
+            closed_loop_steps,
         )
         complete = True
     except KeyboardInterrupt:
@@ -2194,6 +3527,8 @@ def main():
         replay_id += "_INCOMPLETE"
         logger.error(f"Replay terminated. {e}")
 
+    g_credential_broker.stop()
+
     logger.debug("Aggregating stats")
     aggregated_stats = init_stats({})
     for idx, stat in per_process_stats.items():
@@ -2219,6 +3554,31 @@ def main():
 
     error_location = g_config.get("error_location", g_config["workload_location"])
 
+    replay_summary.append(g_credential_broker.summary())
+    replay_summary.append(
+        f"Query scheduling lag: {LatencyHistogram(aggregated_stats['scheduling_lag_ms']).summary()}"
+    )
+    replay_summary.append(
+        f"Connection setup latency: {LatencyHistogram(aggregated_stats['connect_ms']).summary()}. "
+        f"Opened {aggregated_stats['connections_opened']} connections, reused "
+        f"{aggregated_stats['connections_reused']} pooled connections."
+    )
+    replay_summary.append(
+        f"Query latency: {LatencyHistogram(aggregated_stats['query_ms']).summary()}"
+    )
+    replay_summary.append(
+        f"Connection start lag: {LatencyHistogram(aggregated_stats['connection_lag_ms']).summary()}"
+    )
+    if closed_loop_steps:
+        # latency vs concurrency, and the highest throughput held for a whole step
+        for step in closed_loop_steps:
+            replay_summary.append(format_closed_loop_step(step))
+        sustained_steps = [step for step in closed_loop_steps if step["complete"]] or closed_loop_steps
+        best_step = max(sustained_steps, key=lambda step: step["queries"] / max(step["duration_sec"], 0.001))
+        replay_summary.append(
+            f"Sustained throughput: {best_step['queries'] / max(best_step['duration_sec'], 0.001):.1f} QPS at "
+            f"concurrency {best_step['concurrency']}"
+        )
     replay_summary.append(
         f"Encountered {len(aggregated_stats['connection_error_log'])} "
         f"connection errors and {len(aggregated_stats['transaction_error_log'])} transaction errors"
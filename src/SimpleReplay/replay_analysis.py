@@ -10,8 +10,18 @@ from pandas import CategoricalDtype
 
 from boto3 import client
 from botocore.exceptions import ClientError
+from analysis_pipeline import (
+    CHECKPOINT_FILE,
+    Checkpoints,
+    Stage,
+    UnloadConnectionPool,
+    run_pipeline,
+)
 from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
 from io import StringIO
+from query_fingerprint import FINGERPRINT_INDEX_FILE, fingerprint_index
 from report_gen import pdf_gen
 from report_util import Report, styles
 from tabulate import tabulate
@@ -28,6 +38,10 @@ from util import (
 g_stylesheet = styles()
 g_columns = g_stylesheet.get("columns")
 
+UNLOAD_DIRECTORY = r"sql/serverless"
+# number of connections the system tables are unloaded over, concurrently
+UNLOAD_CONNECTIONS = 4
+
 
 def launch_analysis_v2():
     """Package install and server init"""
@@ -82,6 +96,10 @@ def run_replay_analysis(
     @param complete: bool, complete/incomplete replay run
     @param stats: dict, run details
     @param summary: str list, replay output summary from replay.py
+
+    The analysis runs as a pipeline of stages, checkpointed to {replay_path}/checkpoints.json. If it
+    fails, running it again for the same replay, or resume_replay_analysis, skips the stages that
+    completed.
     """
 
     logger = logging.getLogger("WorkloadReplicatorLogger")
@@ -98,48 +116,179 @@ def run_replay_analysis(
     logger.info(f"Running analysis for replay: {replay}")
     replay_path = f"{bucket['prefix']}analysis/{replay}"
 
-    # unload from cluster
-    queries = unload(bucket, iam_role, cluster, user, replay)
+    checkpoints = Checkpoints(
+        bucket.get("bucket_name"), f"{replay_path}/{CHECKPOINT_FILE}"
+    ).load()
+    if checkpoints.arguments is None:
+        # everything needed to resume the analysis from the command line
+        checkpoints.save_arguments(
+            {
+                "cluster_endpoint": cluster_endpoint,
+                "start_time": start_time.isoformat(),
+                "end_time": end_time.isoformat(),
+                "iam_role": iam_role,
+                "user": user,
+                "tag": tag,
+                "workload": workload,
+                "is_serverless": is_serverless,
+                "secret_name": secret_name,
+                "nlb_nat_dns": nlb_nat_dns,
+                "complete": complete,
+                "stats": stats,
+                "summary": summary,
+            }
+        )
+    elif checkpoints.state["stages"]:
+        logger.info(
+            f"Resuming analysis after completed stages: {', '.join(sorted(checkpoints.state['stages']))}"
+        )
+
+    # unloads use the replay times as given, before create_json formats them for the report
+    unload_cluster = dict(cluster)
     info = create_json(replay, cluster, workload, complete, stats, tag)
+    report = Report(cluster, replay, bucket, replay_path, tag, complete)
+
+    queries = unload_query_names()
+    # query results read into the report, the others are only unloaded for the analysis GUI
+    report_queries = {
+        table.get("sql") for table in report.tables.values() if table.get("sql")
+    }
+    report_queries.add("latency_distribution")
+    read_stages = [f"read_{q}" for q in queries if q in report_queries]
+
+    # boto3 sessions aren't thread safe, so the stages share one S3 client created here
+    s3_client = boto3.client("s3")
+    connections = UnloadConnectionPool(
+        partial(initiate_connection, username=user, cluster=unload_cluster),
+        UNLOAD_CONNECTIONS,
+    )
+    stages = [Stage("upload_info", partial(upload_info, bucket, info, f"{replay_path}/{info}", s3_client))]
+    for q in queries:
+        stages.append(
+            Stage(
+                f"unload_{q}",
+                partial(unload, bucket, iam_role, unload_cluster, connections, replay, q),
+            )
+        )
+        if q in report_queries:
+            stages.append(
+                Stage(
+                    f"read_{q}",
+                    partial(get_raw_data, report, bucket, replay_path, q, s3_client),
+                    depends_on=[f"unload_{q}"],
+                    checkpoint=False,
+                )
+            )
+    if "sys_query_history" in queries:
+        stages.append(
+            Stage(
+                "fingerprint_index",
+                partial(upload_fingerprint_index, bucket, replay_path, s3_client),
+                depends_on=["unload_sys_query_history"],
+            )
+        )
+    # the report is generated once its data was read, while the other unloads may still run
+    stages.append(
+        Stage(
+            "report",
+            partial(generate_report, report, bucket, replay_path, info, summary, s3_client),
+            depends_on=read_stages + ["upload_info"],
+        )
+    )
+    stages.append(
+        Stage(
+            "summary",
+            partial(analysis_summary, bucket.get("url"), replay, s3_client),
+            depends_on=["report"],
+            checkpoint=False,
+        )
+    )
+
+    logger.info(f"Querying {cluster.get('id')}. This may take some time.")
     try:
-        boto3.resource("s3").Bucket(bucket.get("bucket_name")).upload_file(
-            info, f"{replay_path}/{info}"
+        failed = run_pipeline(stages, checkpoints, max_workers=UNLOAD_CONNECTIONS + 2)
+    finally:
+        connections.close()
+
+    if failed:
+        logger.error(
+            f"Replay analysis failed at stages: {', '.join(failed)}. Completed stages are checkpointed, run "
+            f"`python3 replay_analysis.py --bucket {bucket.get('url')} --replay_id1 {replay} --resume` to "
+            f"resume the analysis."
         )
-    except ClientError as e:
+        exit(-1)
+    logger.info(f"Query results available in {bucket.get('url')}")
+
+
+def resume_replay_analysis(bucket_url, replay):
+    """Runs the stages of an analysis that didn't complete, with the arguments it was started with
+
+    @param bucket_url: str, S3 bucket location
+    @param replay: str, replay id
+    """
+
+    logger = logging.getLogger("SimpleReplayLogger")
+    bucket = bucket_dict(bucket_url)
+    checkpoints = Checkpoints(
+        bucket.get("bucket_name"),
+        f"{bucket['prefix']}analysis/{replay}/{CHECKPOINT_FILE}",
+    ).load()
+    arguments = checkpoints.arguments
+    if arguments is None:
         logger.error(
-            f"{e} Could not upload info. Confirm IAM permissions include S3::PutObject."
+            f"No checkpoints found for replay {replay}. The analysis can only be resumed if it was started "
+            f"with this version of Simple Replay."
         )
         exit(-1)
 
-    report = Report(cluster, replay, bucket, replay_path, tag, complete)
+    arguments["start_time"] = datetime.fromisoformat(arguments["start_time"])
+    arguments["end_time"] = datetime.fromisoformat(arguments["end_time"])
+    run_replay_analysis(replay=replay, bucket_url=bucket_url, **arguments)
+
 
+def upload_info(bucket, info, key, s3_client):
+    """Uploads the replay info file to S3
+
+    @param bucket: dict, S3 bucket location
+    @param info: str, local info file
+    @param key: str, S3 key to upload to
+    @param s3_client: boto3 S3 client
+    """
+
+    logger = logging.getLogger("SimpleReplayLogger")
     try:
-        # iterate through query csv results and import
-        for q in queries:
-            get_raw_data(report, bucket, replay_path, q)
+        s3_client.upload_file(info, bucket.get("bucket_name"), key)
+    except ClientError as e:
+        logger.error(
+            f"{e} Could not upload info. Confirm IAM permissions include S3::PutObject."
+        )
+        raise e
 
-    except Exception as e:
-        logger.error(f"{e}: Data read failed. Error in replay analysis.")
-        exit(-1)
 
-    # generate replay_id_report.pdf and info.json
+def generate_report(report, bucket, replay_path, info, summary, s3_client):
+    """Generates replay_id_report.pdf and uploads it to S3 with info.json
+
+    @param report: Report, report object with its data read
+    @param bucket: dict, S3 bucket location
+    @param replay_path: str, path of replay
+    @param info: str, local info file
+    @param summary: str list, replay output summary from replay.py
+    @param s3_client: boto3 S3 client
+    """
+
+    logger = logging.getLogger("SimpleReplayLogger")
     logger.info(f"Generating report.")
     pdf = pdf_gen(report, summary)
 
-    # upload to s3 and output presigned urls
+    # upload to s3
     try:
-        boto3.resource("s3").Bucket(bucket.get("bucket_name")).upload_file(
-            pdf, f"{replay_path}/out/{pdf}"
-        )
-        boto3.resource("s3").Bucket(bucket.get("bucket_name")).upload_file(
-            info, f"{replay_path}/out/{info}"
-        )
-        analysis_summary(bucket.get("url"), replay)
+        s3_client.upload_file(pdf, bucket.get("bucket_name"), f"{replay_path}/out/{pdf}")
+        s3_client.upload_file(info, bucket.get("bucket_name"), f"{replay_path}/out/{info}")
     except ClientError as e:
         logger.error(
             f"{e} Could not upload report. Confirm IAM permissions include S3::PutObject."
         )
-        exit(-1)
+        raise e
 
 
 def run_comparison_analysis(bucket, replay1, replay2):
@@ -243,76 +392,72 @@ def initiate_connection(username, cluster):
             conn.close()
 
 
-# def unload(unload_location, iam_role, cluster, user, path):
-def unload(unload_location, iam_role, cluster, user, replay):
-    """Iterates through sql/ and executes UNLOAD with queries on provided cluster
+def unload_query_names(directory=UNLOAD_DIRECTORY):
+    """Names of the system table queries of sql/ unloaded for the analysis
+
+    @param directory: str, directory of the query files
+    @return: str List, query file names
+    """
+
+    return [
+        os.path.splitext(file)[0]
+        for file in sorted(os.listdir(directory))
+        if file.endswith(".sql")
+    ]
+
+
+def unload(unload_location, iam_role, cluster, connections, replay, query_name, directory=UNLOAD_DIRECTORY):
+    """Executes UNLOAD with a query of sql/ on provided cluster
 
     @param unload_location: S3 bucket location for unloaded data
     @param iam_role: IAM ARN with unload permissions
     @param cluster: cluster dict
-    @param user: str, master username for cluster
-    @param path: replay path
-    @return: str List, query file names
+    @param connections: UnloadConnectionPool of the cluster
+    @param replay: str, replay id
+    @param query_name: str, query file name
+    @param directory: str, directory of the query files
     """
 
     logger = logging.getLogger("SimpleReplayLogger")
 
-    directory = r"sql/serverless"
+    with open(f"{directory}/{query_name}.sql", "r") as query_file:  # open sql file
+        logger.debug(f"Query: {query_name}")
+        query = query_file.read()  # read file contents as string
 
-    queries = []  # used to return query names
-    with initiate_connection(
-        username=user, cluster=cluster
-    ) as conn:  # initiate connection
-        cursor = conn.cursor()
-        logger.info(f"Querying {cluster.get('id')}. This may take some time.")
+    # replace start and end times in sql with variables
+    query = re.sub(r"{{START_TIME}}", f"'{cluster.get('start_time')}'", query)
+    query = re.sub(r"{{END_TIME}}", f"'{cluster.get('end_time')}'", query)
 
-        for file in sorted(os.listdir(directory)):  # iterate local sql/ directory
-            if not file.endswith(".sql"):  # validity check
-                continue
-            with open(f"{directory}/{file}", "r") as query_file:  # open sql file
-                # get file name prefix for s3 files
-                query_name = os.path.splitext(file)[
-                    0
-                ]  # get file/query name for reference
-                logger.debug(f"Query: {query_name}")
-                queries.append(query_name)
-                query = query_file.read()  # read file contents as string
-
-                # replace start and end times in sql with variables
-                query = re.sub(
-                    r"{{START_TIME}}", f"'{cluster.get('start_time')}'", query
-                )
-                query = re.sub(r"{{END_TIME}}", f"'{cluster.get('end_time')}'", query)
-
-                # format unload query with actual query from sql/
-                unload_query = (
-                    f"unload ($${query}$$) to '{unload_location.get('url')}/analysis/{replay}/raw_data/"
-                    f"{query_name}' iam_role '{iam_role}' CSV header allowoverwrite parallel off;"
-                )
-                try:
-                    cursor.execute(unload_query)  # execute unload
-                except Exception as e:
-                    logger.error(
-                        f"Could not unload {query_name} results. Confirm IAM permissions include UNLOAD "
-                        f"access for Redshift. {e}"
-                    )
-                    exit(-1)
-
-    logger.info(f"Query results available in {unload_location.get('url')}")
-    return queries
+    # format unload query with actual query from sql/
+    unload_query = (
+        f"unload ($${query}$$) to '{unload_location.get('url')}/analysis/{replay}/raw_data/"
+        f"{query_name}' iam_role '{iam_role}' CSV header allowoverwrite parallel off;"
+    )
+    with connections.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(unload_query)  # execute unload
+        except Exception as e:
+            logger.error(
+                f"Could not unload {query_name} results. Confirm IAM permissions include UNLOAD "
+                f"access for Redshift. {e}"
+            )
+            raise e
+        finally:
+            cursor.close()
 
 
-def get_raw_data(report, bucket, replay_path, query):
+def get_raw_data(report, bucket, replay_path, query, s3_client):
     """Reads and processes raw data from S3
 
     @param report: Report, report object
     @param bucket: dict, S3 bucket location
     @param replay_path: str, path of replay
     @param query: str, query name
+    @param s3_client: boto3 S3 client
     """
 
     logger = logging.getLogger("SimpleReplayLogger")
-    s3_client = boto3.client("s3")
     try:
         response = s3_client.get_object(
             Bucket=bucket.get("bucket_name"), Key=f"{replay_path}/raw_data/{query}000"
@@ -328,16 +473,53 @@ def get_raw_data(report, bucket, replay_path, query):
     else:
         for t, vals in report.tables.items():
             if vals.get("sql") == query:
-                vals["data"] = read_data(t, df, vals.get("columns"), report)
+                vals["data"] = read_data(t, df, vals.get("columns"), report, s3_client)
+
+
+def upload_fingerprint_index(bucket, replay_path, s3_client):
+    """Writes the fingerprint index of the replayed queries to aggregated_data/, so replays can be
+    compared per query fingerprint. Replays without an index are compared from their query history
+
+    @param bucket: dict, S3 bucket location
+    @param replay_path: str, path of replay
+    @param s3_client: boto3 S3 client
+    """
+
+    logger = logging.getLogger("SimpleReplayLogger")
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket.get("bucket_name"),
+            Key=f"{replay_path}/raw_data/sys_query_history000",
+        )
+        df = pd.read_csv(response.get("Body")).fillna(0)
+        # only the statements executed by the replay, in milliseconds
+        df = df[df["query_text"].astype(str).str.contains("replay_start")]
+        index = fingerprint_index(
+            df["query_text"], df["elapsed_time"] / 1000, df["execution_time"] / 1000
+        )
+
+        csv_buffer = StringIO()
+        index.to_csv(csv_buffer, index=False)
+        s3_client.put_object(
+            Bucket=bucket.get("bucket_name"),
+            Key=f"{replay_path}/aggregated_data/{FINGERPRINT_INDEX_FILE}",
+            Body=csv_buffer.getvalue(),
+        )
+        logger.debug(f"Uploaded fingerprint index of {len(index)} queries.")
+    except Exception as e:
+        # raised, so the stage isn't checkpointed as completed and runs again when the analysis is resumed
+        logger.error(f"Could not create the query fingerprint index. {e}")
+        raise e
 
 
-def read_data(table_name, df, report_columns, report):
+def read_data(table_name, df, report_columns, report, s3_client):
     """Map raw data file to formatted table
 
     @param table_name: name of table
     @param df: DataFrame of raw data
     @param report_columns: List of column names for report table
     @param report: Report object
+    @param s3_client: boto3 S3 client
     @return: DataFrame of formatted data
     """
 
@@ -377,14 +559,15 @@ def read_data(table_name, df, report_columns, report):
 
     # upload formatted dataframe to S3 as csv
     try:
-        s3_resource = boto3.resource("s3")
         file = f"{table_name.replace(' ', '')}.csv"  # set filename for saving
         csv_buffer = StringIO()
         report_table.to_csv(csv_buffer)
         logger.debug(report.bucket)
-        s3_resource.Object(
-            report.bucket.get("bucket_name"), f"{report.path}/aggregated_data/{file}"
-        ).put(Body=csv_buffer.getvalue())
+        s3_client.put_object(
+            Bucket=report.bucket.get("bucket_name"),
+            Key=f"{report.path}/aggregated_data/{file}",
+            Body=csv_buffer.getvalue(),
+        )
     except Exception as e:
         logger.error(
             f"Could not upload aggregated data. Please confirm bucket. Error occurred while processing "
@@ -394,17 +577,18 @@ def read_data(table_name, df, report_columns, report):
     return report_table
 
 
-def create_presigned_url(bucket_name, object_name):
+def create_presigned_url(bucket_name, object_name, s3_client=None):
     """Creates a presigned url for a given object
 
     @param bucket_name: str, bucket name
     @param object_name: str, object name
+    @param s3_client: boto3 S3 client, or None to create one
     @return:
     """
 
     logger = logging.getLogger("SimpleReplayLogger")
 
-    s3_client = boto3.client("s3")
+    s3_client = s3_client or boto3.client("s3")
     try:
         response = s3_client.generate_presigned_url(
             "get_object",
@@ -420,11 +604,12 @@ def create_presigned_url(bucket_name, object_name):
     return response
 
 
-def analysis_summary(bucket_url, replay):
+def analysis_summary(bucket_url, replay, s3_client=None):
     """Print presigned url for report of given replay
 
     @param bucket_url: str, S3 bucket location
     @param replay: str, replay id
+    @param s3_client: boto3 S3 client, or None to create one
     """
 
     logger = logging.getLogger("SimpleReplayLogger")
@@ -437,7 +622,7 @@ def analysis_summary(bucket_url, replay):
         f"Click or copy/paste the link into your browser to download."
     )
     r_url = create_presigned_url(
-        bucket.get("bucket_name"), f"{replay_path}{replay}_report.pdf"
+        bucket.get("bucket_name"), f"{replay_path}{replay}_report.pdf", s3_client
     )
     output_str += f"\n\nReplay Analysis Report | Click to Download:\n{r_url}\n"
     logger.info(output_str)
@@ -567,6 +752,11 @@ def main():
         help="replay id 2, required for " "comparison",
     )
     parser.add_argument("-s", "--sql", action="store_true", help="sql")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume the analysis of replay id 1 from its last completed stage",
+    )
 
     args = parser.parse_args()
 
@@ -575,7 +765,9 @@ def main():
     elif args.bucket and not (args.replay_id1 or args.replay_id2):
         list_replays(args.bucket[0])
     elif args.bucket and args.replay_id1 and not args.replay_id2:
-        if args.sql:
+        if args.resume:
+            resume_replay_analysis(args.bucket[0], args.replay_id1)
+        elif args.sql:
             list_sql(args.bucket[0], args.replay_id1)
         else:
             analysis_summary(args.bucket[0], args.replay_id1)
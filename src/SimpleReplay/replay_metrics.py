@@ -0,0 +1,287 @@
+"""
+replay_metrics.py
+====================================
+This module holds the metrics collected during a replay. Histograms use fixed, roughly
+logarithmic buckets, so they are cheap to record into, and the histograms of every connection
+and worker can be merged by adding up their counts. The workers add up their counters and
+histograms in an array of shared memory, which the replay manager reads while the replay runs,
+and send their error records to it over a queue that only they write to.
+"""
+
+import multiprocessing
+import threading
+from queue import Empty
+
+# upper bounds of the histogram buckets, in milliseconds. A last bucket holds everything above
+BUCKET_BOUNDS_MS = (
+    1,
+    2,
+    5,
+    10,
+    20,
+    50,
+    100,
+    200,
+    500,
+    1000,
+    2000,
+    5000,
+    10000,
+    30000,
+    60000,
+    300000,
+)
+
+
+def bucket_index(latency_ms):
+    """Index of the histogram bucket holding a latency"""
+    for idx, bound in enumerate(BUCKET_BOUNDS_MS):
+        if latency_ms <= bound:
+            return idx
+    return len(BUCKET_BOUNDS_MS)
+
+
+class LatencyHistogram:
+    """Histogram of latencies in milliseconds. Negative latencies (early events) count as 0"""
+
+    def __init__(self, state=None):
+        if state:
+            self.counts = list(state["counts"])
+            self.max_ms = state["max_ms"]
+            self.sum_ms = state["sum_ms"]
+        else:
+            self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+            self.max_ms = 0.0
+            self.sum_ms = 0.0
+
+    def record(self, latency_ms):
+        latency_ms = max(latency_ms, 0.0)
+        self.counts[bucket_index(latency_ms)] += 1
+        self.sum_ms += latency_ms
+        if latency_ms > self.max_ms:
+            self.max_ms = latency_ms
+
+    def merge(self, other):
+        for idx, count in enumerate(other.counts):
+            self.counts[idx] += count
+        self.sum_ms += other.sum_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        return self
+
+    def since(self, earlier):
+        """Histogram of the latencies recorded after earlier, a previous copy of this histogram.
+        The maximum can't be told apart, so the overall maximum is kept"""
+        difference = LatencyHistogram(self.to_dict())
+        for idx, count in enumerate(earlier.counts):
+            difference.counts[idx] -= count
+        difference.sum_ms -= earlier.sum_ms
+        return difference
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile, capped by the maximum"""
+        total = self.count
+        if total == 0:
+            return 0.0
+        rank = percent / 100.0 * total
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if idx < len(BUCKET_BOUNDS_MS):
+                    return min(float(BUCKET_BOUNDS_MS[idx]), self.max_ms)
+                break
+        return self.max_ms
+
+    def summary(self):
+        if self.count == 0:
+            return "no samples"
+        return (
+            f"p50 {self.percentile(50):.0f} ms, p90 {self.percentile(90):.0f} ms, "
+            f"p99 {self.percentile(99):.0f} ms, max {self.max_ms:.0f} ms "
+            f"({self.count} samples)"
+        )
+
+    def to_dict(self):
+        """Plain representation, which can be stored in the Manager shared stats"""
+        return {"counts": list(self.counts), "max_ms": self.max_ms, "sum_ms": self.sum_ms}
+
+
+class SharedStats:
+    """
+    Counters and histograms of all the workers of a replay, in one array of shared memory with a
+    row per worker. Each worker only writes its own row, so adding to it takes no IPC and no lock
+    shared with other processes, and the replay manager can read every row at any time. Stats are
+    added and read as dicts holding the counters, a connection_diff_sec value, and histograms
+    in the format of LatencyHistogram.to_dict(). Queries are also recorded as they are
+    executed, counted per key, e.g. per user and database, and into a histogram of their
+    latency.
+    """
+
+    def __init__(self, num_workers, counters, histograms, keys=()):
+        self.num_workers = num_workers
+        self.counters = tuple(counters)
+        self.histograms = tuple(histograms)
+        self.keys = tuple(keys)
+        self.key_index = {key: idx for idx, key in enumerate(self.keys)}
+        # bucket counts, then max_ms and sum_ms
+        self.histogram_size = len(BUCKET_BOUNDS_MS) + 3
+        self.diff_offset = len(self.counters)
+        self.histograms_offset = self.diff_offset + 1
+        self.query_latency_offset = (
+            self.histograms_offset + len(self.histograms) * self.histogram_size
+        )
+        self.keys_offset = self.query_latency_offset + self.histogram_size
+        self.row_size = self.keys_offset + len(self.keys)
+        self.values = multiprocessing.RawArray("d", num_workers * self.row_size)
+        # serializes the threads of a worker adding to its row
+        self.lock = threading.Lock()
+
+    def add(self, worker_idx, stats):
+        """Add the stats of a finished connection to the row of a worker"""
+        values = self.values
+        row = worker_idx * self.row_size
+        with self.lock:
+            for idx, counter in enumerate(self.counters):
+                values[row + idx] += stats[counter]
+
+            # keep the largest absolute connection difference between actual and expected
+            diff_sec = stats["connection_diff_sec"]
+            if abs(diff_sec) >= abs(values[row + self.diff_offset]):
+                values[row + self.diff_offset] = diff_sec
+
+            offset = row + self.histograms_offset
+            for histogram in self.histograms:
+                state = stats[histogram]
+                for idx, count in enumerate(state["counts"]):
+                    values[offset + idx] += count
+                offset += len(BUCKET_BOUNDS_MS) + 1
+                values[offset] = max(values[offset], state["max_ms"])
+                values[offset + 1] += state["sum_ms"]
+                offset += 2
+
+    def record_query(self, worker_idx, key, latency_ms):
+        """Record an executed query. Keys that weren't given up front are only recorded in the
+        latency histogram"""
+        values = self.values
+        row = worker_idx * self.row_size
+        latency_ms = max(latency_ms, 0.0)
+        key_idx = self.key_index.get(key)
+        with self.lock:
+            if key_idx is not None:
+                values[row + self.keys_offset + key_idx] += 1
+            offset = row + self.query_latency_offset
+            values[offset + bucket_index(latency_ms)] += 1
+            offset += len(BUCKET_BOUNDS_MS) + 1
+            values[offset] = max(values[offset], latency_ms)
+            values[offset + 1] += latency_ms
+
+    def query_latency(self):
+        """Histogram of the latency of the queries recorded by all workers"""
+        latencies = LatencyHistogram()
+        for worker in range(self.num_workers):
+            latencies.merge(self._histogram(worker * self.row_size + self.query_latency_offset))
+        return latencies
+
+    def _histogram(self, offset):
+        num_buckets = len(BUCKET_BOUNDS_MS) + 1
+        values = self.values[offset : offset + self.histogram_size]
+        return LatencyHistogram(
+            {
+                "counts": [int(count) for count in values[:num_buckets]],
+                "max_ms": values[num_buckets],
+                "sum_ms": values[num_buckets + 1],
+            }
+        )
+
+    def query_counts(self):
+        """Queries executed for each key, by all workers"""
+        counts = [0] * len(self.keys)
+        for worker in range(self.num_workers):
+            offset = worker * self.row_size + self.keys_offset
+            for idx, count in enumerate(self.values[offset : offset + len(self.keys)]):
+                counts[idx] += int(count)
+        return dict(zip(self.keys, counts))
+
+    def snapshot(self, worker_idx=None):
+        """Stats of one worker, or the aggregate of all workers. Reading doesn't wait for the
+        workers, so while they run, a snapshot may miss parts of the connections they are
+        adding."""
+        if worker_idx is None:
+            rows = range(self.num_workers)
+        else:
+            rows = [worker_idx]
+        stats = {counter: 0 for counter in self.counters}
+        stats["connection_diff_sec"] = 0
+        histograms = {histogram: LatencyHistogram() for histogram in self.histograms}
+
+        for worker in rows:
+            row = worker * self.row_size
+            for idx, counter in enumerate(self.counters):
+                stats[counter] += int(self.values[row + idx])
+            diff_sec = self.values[row + self.diff_offset]
+            if abs(diff_sec) >= abs(stats["connection_diff_sec"]):
+                stats["connection_diff_sec"] = diff_sec
+            offset = row + self.histograms_offset
+            for histogram in self.histograms:
+                histograms[histogram].merge(self._histogram(offset))
+                offset += self.histogram_size
+
+        for histogram, latencies in histograms.items():
+            stats[histogram] = latencies.to_dict()
+        return stats
+
+
+class ErrorChannel:
+    """
+    Carries the error records of the workers to the replay manager. Workers only append to it,
+    which hands the record to a background thread of the multiprocessing queue, and the replay
+    manager drains it periodically. Records are (worker index, kind, value) tuples.
+    """
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+
+    def put(self, worker_idx, kind, value):
+        self.queue.put((worker_idx, kind, value))
+
+    def drain(self):
+        """All records appended so far"""
+        records = []
+        while True:
+            try:
+                records.append(self.queue.get_nowait())
+            except Empty:
+                return records
+
+
+class WorkerStats:
+    """The stats of one worker process: counters and histograms go to its row of SharedStats,
+    errors to the ErrorChannel. Can take the place of the error list of the replay, appending
+    error records to the channel."""
+
+    ERROR_RECORD = "error"
+
+    def __init__(self, shared_stats, error_channel, worker_idx, error_logs=()):
+        self.shared_stats = shared_stats
+        self.error_channel = error_channel
+        self.worker_idx = worker_idx
+        # names of the stats holding dicts of errors, sent over the channel when not empty
+        self.error_logs = tuple(error_logs)
+
+    def add(self, stats):
+        """Add the stats of a finished connection"""
+        self.shared_stats.add(self.worker_idx, stats)
+        for error_log in self.error_logs:
+            if stats[error_log]:
+                self.error_channel.put(self.worker_idx, error_log, stats[error_log])
+
+    def append(self, record):
+        """Send an error record"""
+        self.error_channel.put(self.worker_idx, self.ERROR_RECORD, record)
+
+    def snapshot(self):
+        return self.shared_stats.snapshot(self.worker_idx)
@@ -0,0 +1,132 @@
+"""
+timestamp_parsing.py
+====================================
+This module decodes the fixed timestamp formats found in audit logs and extracted workloads.
+Each format has a fast path, and falls back to the generic parsers when a value doesn't match.
+"""
+
+import datetime
+import functools
+
+import dateutil.parser
+
+_MONTHS = {
+    "Jan": 1,
+    "Feb": 2,
+    "Mar": 3,
+    "Apr": 4,
+    "May": 5,
+    "Jun": 6,
+    "Jul": 7,
+    "Aug": 8,
+    "Sep": 9,
+    "Oct": 10,
+    "Nov": 11,
+    "Dec": 12,
+}
+
+CONNECTION_LOG_TIME_FORMAT = "%a, %d %b %Y %H:%M:%S:%f"
+
+# audit log records share timestamps at second granularity, and every query in an extracted
+# workload repeats its record time, so the common parsers are memoized
+_CACHE_SIZE = 2 ** 16
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def parse_user_activity_log_time(value):
+    """Parse a user activity log record time, e.g. 2023-01-02T03:04:05Z"""
+    if len(value) == 20 and value[4] == "-" and value[10] == "T" and value[19] == "Z":
+        try:
+            return datetime.datetime(
+                int(value[0:4]),
+                int(value[5:7]),
+                int(value[8:10]),
+                int(value[11:13]),
+                int(value[14:16]),
+                int(value[17:19]),
+                tzinfo=datetime.timezone.utc,
+            )
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def parse_start_node_log_time(value):
+    """Parse a start node log record time, e.g. 2023-01-02 03:04:05 UTC"""
+    if len(value) == 23 and value[10] == " " and value.endswith(" UTC"):
+        try:
+            return datetime.datetime(
+                int(value[0:4]),
+                int(value[5:7]),
+                int(value[8:10]),
+                int(value[11:13]),
+                int(value[14:16]),
+                int(value[17:19]),
+                tzinfo=datetime.timezone.utc,
+            )
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value)
+
+
+def parse_connection_log_time(value):
+    """Parse a connection log event time, e.g. Mon, 02 Jan 2023 03:04:05:678"""
+    try:
+        _, day, month, year, clock = value.split(" ")
+        hour, minute, second, fraction = clock.split(":")
+        if len(fraction) <= 6:
+            return datetime.datetime(
+                int(year),
+                _MONTHS[month],
+                int(day),
+                int(hour),
+                int(minute),
+                int(second),
+                int(fraction.ljust(6, "0")),
+                tzinfo=datetime.timezone.utc,
+            )
+    except (ValueError, KeyError):
+        pass
+    return datetime.datetime.strptime(value, CONNECTION_LOG_TIME_FORMAT).replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def parse_iso_time(value):
+    """Parse an ISO 8601 time as written by datetime.isoformat() into extracted workloads"""
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return dateutil.parser.isoparse(value)
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_epoch_us(time):
+    """Microseconds since the epoch of a datetime, which is taken to be in UTC if it has no
+    timezone. Times already in microseconds are returned as they are, and missing times, None
+    or empty, as None"""
+    if type(time) is int:
+        return time
+    if not time:
+        return None
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return (time - _EPOCH) // _ONE_MICROSECOND
+
+
+def from_epoch_us(epoch_us):
+    """UTC datetime of a number of microseconds since the epoch. None is passed through"""
+    if epoch_us is None:
+        return None
+    return _EPOCH + datetime.timedelta(microseconds=epoch_us)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def parse_iso_time_us(value):
+    """parse_iso_time, in microseconds since the epoch"""
+    return to_epoch_us(parse_iso_time(value))
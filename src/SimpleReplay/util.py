@@ -148,6 +148,37 @@ def retrieve_compressed_json(location):
     return json.loads(json_content)
 
 
+def iter_compressed_json_lines(location):
+    """Lazily yield the records of a gzipped json lines file from the specified location, either local or s3"""
+    if location.startswith("s3://"):
+        url = urlparse(location, allow_fragments=False)
+        s3 = boto3.resource("s3")
+        raw = s3.Object(url.netloc, url.path.lstrip("/")).get()["Body"]
+    else:
+        raw = open(location, "rb")
+    try:
+        with gzip.open(raw, mode="rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        raw.close()
+
+
+def location_exists(location):
+    """Check whether a file exists at the specified location, either local or s3"""
+    if location.startswith("s3://"):
+        url = urlparse(location, allow_fragments=False)
+        try:
+            boto3.client("s3").head_object(Bucket=url.netloc, Key=url.path.lstrip("/"))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise e
+        return True
+    return os.path.exists(location)
+
+
 def load_file(location, decode=False):
     """load a file from s3 or local. decode if the file should be interpreted as text rather than binary"""
     try:
@@ -0,0 +1,186 @@
+"""
+workload_index.py
+====================================
+This module writes and reads the chunked form of the JSON lines workload archive. SQLs.jsonl.gz
+is written as a series of independent gzip members ("chunks"), which together are still a
+regular gzip file. The SQLs.jsonl.index.json sidecar records the byte range, time range and
+connections of every chunk, so replay can decompress only the chunks that overlap the
+requested time window and filters.
+"""
+
+import gzip
+import json
+from urllib.parse import urlparse
+
+import boto3
+
+from timestamp_parsing import parse_iso_time
+
+ARCHIVE_FILENAME = "SQLs.jsonl.gz"
+INDEX_FILENAME = "SQLs.jsonl.index.json"
+INDEX_VERSION = 1
+
+# files of the SQL archive of an extracted workload, by workload_format. The Parquet filenames are
+# those of parquet_workload, which can't be imported without pyarrow
+WORKLOAD_ARCHIVE_FILENAMES = {
+    "parquet": ["SQLs.transactions.parquet", "SQLs.queries.parquet"],
+    "jsonl": [ARCHIVE_FILENAME, INDEX_FILENAME],
+    "json": ["SQLs.json.gz"],
+}
+
+# a chunk is closed when it reaches this many transactions, or when a transaction starts in a
+# different time bucket than the first one of the chunk
+CHUNK_MAX_TRANSACTIONS = 5000
+CHUNK_BUCKET_SECONDS = 60
+
+
+def transaction_start_time(transaction):
+    """Start time of a transaction dict, as used to sort and window transactions"""
+    return min(
+        parse_iso_time(query["start_time"] or query["record_time"])
+        for query in transaction["queries"]
+    )
+
+
+def _time_bucket(time):
+    return int(time.timestamp()) // CHUNK_BUCKET_SECONDS
+
+
+class ChunkedArchiveWriter:
+    """
+    Writes transaction dicts to a chunked JSON lines archive, and the index describing it.
+    Only the current chunk is held in memory.
+    """
+
+    def __init__(self, archive_filename, index_filename):
+        self.archive_filename = archive_filename
+        self.index_filename = index_filename
+        self.archive = open(archive_filename, "wb")
+        self.chunks = []
+        self.lines = []
+        self.connections = set()
+        self.start_time = None
+        self.end_time = None
+
+    def write(self, transaction):
+        start_time = transaction_start_time(transaction)
+        if self.lines and (
+                len(self.lines) >= CHUNK_MAX_TRANSACTIONS
+                or _time_bucket(start_time) != _time_bucket(self.start_time)
+        ):
+            self.flush()
+
+        self.lines.append(json.dumps(transaction) + "\n")
+        self.connections.add((transaction["db"], transaction["user"], transaction["pid"]))
+        if self.start_time is None or start_time < self.start_time:
+            self.start_time = start_time
+        if self.end_time is None or start_time > self.end_time:
+            self.end_time = start_time
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = gzip.compress("".join(self.lines).encode("utf-8"))
+        self.chunks.append(
+            {
+                "offset": self.archive.tell(),
+                "length": len(data),
+                "start_time": self.start_time.isoformat(),
+                "end_time": self.end_time.isoformat(),
+                "transactions": len(self.lines),
+                "connections": sorted(self.connections),
+            }
+        )
+        self.archive.write(data)
+        self.lines = []
+        self.connections = set()
+        self.start_time = None
+        self.end_time = None
+
+    def close(self):
+        self.flush()
+        self.archive.close()
+        with open(self.index_filename, "w") as f:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "archive": ARCHIVE_FILENAME,
+                    "chunk_bucket_seconds": CHUNK_BUCKET_SECONDS,
+                    "chunks": self.chunks,
+                },
+                f,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_index(location):
+    """Load an archive index from a local or s3 location"""
+    if location.startswith("s3://"):
+        url = urlparse(location, allow_fragments=False)
+        content = boto3.client("s3").get_object(Bucket=url.netloc, Key=url.path.lstrip("/"))["Body"].read()
+    else:
+        with open(location, "rb") as f:
+            content = f.read()
+    return json.loads(content)
+
+
+def select_chunks(index, start_time=None, end_time=None, connection_filter=None):
+    """
+    Select the chunks of an index that may contain transactions starting within the time window
+    and belonging to a connection accepted by connection_filter
+    :param index: archive index, as returned by read_index
+    :param start_time: start of the time window, or None
+    :param end_time: end of the time window, or None
+    :param connection_filter: function of (db, user, pid) returning whether the connection is
+    replayed, or None
+    :return: list of chunk entries
+    """
+    chunks = []
+    for chunk in index["chunks"]:
+        if start_time and parse_iso_time(chunk["end_time"]) < start_time:
+            continue
+        if end_time and parse_iso_time(chunk["start_time"]) > end_time:
+            continue
+        if connection_filter and not any(
+                connection_filter(*connection) for connection in chunk["connections"]
+        ):
+            continue
+        chunks.append(chunk)
+    return chunks
+
+
+def _read_range(location, offset, length, s3_client=None):
+    if location.startswith("s3://"):
+        url = urlparse(location, allow_fragments=False)
+        s3_client = s3_client or boto3.client("s3")
+        return s3_client.get_object(
+            Bucket=url.netloc,
+            Key=url.path.lstrip("/"),
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )["Body"].read()
+    with open(location, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def iter_chunk_transactions(archive_location, chunks):
+    """
+    Lazily yield the transaction dicts stored in the given chunks of the archive. Only the byte
+    ranges of those chunks are read
+    :param archive_location: local or s3 location of SQLs.jsonl.gz
+    :param chunks: chunk entries, as returned by select_chunks
+    :return: generator of transaction dicts
+    """
+    s3_client = boto3.client("s3") if archive_location.startswith("s3://") else None
+    for chunk in chunks:
+        data = gzip.decompress(
+            _read_range(archive_location, chunk["offset"], chunk["length"], s3_client)
+        )
+        for line in data.decode("utf-8").splitlines():
+            if line.strip():
+                yield json.loads(line)